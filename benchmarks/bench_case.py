@@ -0,0 +1,125 @@
+#
+# PAOFLOW
+#
+# Utility to construct and operate on Hamiltonians from the Projections of DFT wfc on Atomic Orbital bases (PAO)
+#
+# Copyright (C) 2016-2018 ERMES group (http://ermes.unt.edu, mbn@unt.edu)
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `License'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#
+
+import os, sys
+import json
+import argparse
+import numpy as np
+
+
+############# Runs one benchmark case #############
+## Usage (serial or under mpirun):
+##  "python bench_case.py case_name result.json [--supercell m1,m2,m3] [--nfft n1,n2,n3] [--nspin 2] [--paoflow path]"
+##
+## Stage timings are taken from the PAOFLOW profiler (paoflow_profile.json).
+###################################################
+
+def run_stage ( paoflow, stage ):
+
+  arry,attr = paoflow.data_controller.data_dicts()
+
+  if stage == 'dos':
+    paoflow.dos(emin=-8., emax=8., ne=1000, do_pdos=False)
+  elif stage == 'transport':
+    paoflow.transport(emin=-3., emax=3., ne=200)
+  elif stage == 'anomalous_Hall':
+    paoflow.anomalous_Hall(do_ac=True, emin=-3., emax=3., a_tensor=np.array([[0,1]]))
+  elif stage == 'epsilon':
+    # dielectric_tensor is disabled in PAOFLOW, its kernel is timed directly
+    from PAOFLOW.defs.do_epsilon import eps_loop
+    attr['delta'],attr['metal'] = 0.05,True
+    ene = np.linspace(0.01, 5., 100)
+    for ispin in range(attr['nspin']):
+      for ipol,jpol in [(0,0),(0,1)]:
+        eps_loop(paoflow.data_controller, ene, ispin, ipol, jpol)
+    paoflow.report_module_time('Epsilon')
+  else:
+    raise ValueError('Unknown benchmark stage: %s'%stage)
+
+
+def run_case ( name, case, workpath ):
+  '''
+  Run the benchmark 'case' and return its record (rank 0) or None (other ranks)
+  '''
+  from PAOFLOW import PAOFLOW
+
+  outputdir = 'output_%s'%name
+  paoflow = PAOFLOW.PAOFLOW(model=case['model'], workpath=workpath, outputdir=outputdir, verbose=False, profile=True)
+
+  arry,attr = paoflow.data_controller.data_dicts()
+  attr.update(case.get('attributes', {}))
+  # Every band of the model is kept
+  for k in ['bnd', 'nbnds']:
+    attr.setdefault(k, attr['nawf'])
+  if 'omega' not in attr:
+    attr['omega'] = attr['alat']**3*abs(np.linalg.det(arry['a_vectors']))
+  size = {'nawf':int(attr['nawf']), 'nspin':int(attr['nspin']), 'nfft':[int(n) for n in case['nfft']]}
+
+  paoflow.interpolated_hamiltonian(*case['nfft'])
+  paoflow.pao_eigh()
+  paoflow.gradient_and_momenta()
+  paoflow.adaptive_smearing()
+  for stage in case['stages']:
+    run_stage(paoflow, stage)
+  paoflow.finish_execution()
+
+  if paoflow.rank != 0:
+    return None
+
+  with open(os.path.join(workpath,outputdir,'paoflow_profile.json'), 'r') as f:
+    profile = json.load(f)
+
+  stages = {}
+  for s in profile['stages']:
+    stages[s['name']] = {'time':s['time'],
+                         'imbalance':s['busy']['imbalance'],
+                         'bytes':sum(s['bytes']),
+                         'rss_delta':max(s['rss_delta'])}
+
+  return dict(size, case=name, nranks=profile['nranks'], peak_rss=max(profile['peak_rss']),
+              total=sum(s['time'] for s in stages.values()), stages=stages)
+
+
+def main ( ):
+
+  parser = argparse.ArgumentParser(description='Run one PAOFLOW benchmark case')
+  parser.add_argument('case', help='Name of the case (see cases.py)')
+  parser.add_argument('output', help='JSON file receiving the record of the run')
+  parser.add_argument('--supercell', help='Supercell m1,m2,m3 replacing that of the case')
+  parser.add_argument('--nfft', help='Interpolation grid n1,n2,n3 replacing that of the case')
+  parser.add_argument('--nspin', type=int, help='Number of spins (1 or 2)')
+  parser.add_argument('--paoflow', help='Directory containing the PAOFLOW package to benchmark (default: installed)')
+  parser.add_argument('--workpath', default='.', help='Directory housing the PAOFLOW output')
+  args = parser.parse_args()
+
+  if args.paoflow is not None:
+    sys.path.insert(0, os.path.abspath(args.paoflow))
+  sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))
+  from cases import cases
+
+  case = dict(cases[args.case])
+  case['model'] = dict(case['model'])
+  if args.supercell is not None:
+    case['model']['supercell'] = [int(m) for m in args.supercell.split(',')]
+  if args.nfft is not None:
+    case['nfft'] = [int(n) for n in args.nfft.split(',')]
+  if args.nspin is not None:
+    case['model']['nspin'] = args.nspin
+
+  record = run_case(args.case, case, args.workpath)
+
+  if record is not None:
+    with open(args.output, 'w') as f:
+      json.dump(record, f, indent=1)
+
+if __name__ == '__main__':
+  main()
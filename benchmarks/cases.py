@@ -0,0 +1,60 @@
+#
+# PAOFLOW
+#
+# Utility to construct and operate on Hamiltonians from the Projections of DFT wfc on Atomic Orbital bases (PAO)
+#
+# Copyright (C) 2016-2018 ERMES group (http://ermes.unt.edu, mbn@unt.edu)
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `License'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#
+
+############# Synthetic benchmark cases #############
+## Each case builds a TB model of defs/models.py, optionally tiled into a supercell
+## ('supercell') and spin polarized ('nspin':2), interpolates it on the 'nfft' grid and
+## runs the common k-space stages (interpolation, eigh, gradient, momenta, smearing)
+## followed by the stages listed in 'stages'.
+## 'attributes' are set in the DataController after the model is built, every band is kept ('bnd').
+#####################################################
+
+# sp3 orbitals on a simple cubic lattice, for the Slater_Koster model
+sk_sp3 = {'a_vectors':[[1.,0.,0.],[0.,1.,0.],[0.,0.,1.]],
+          'atoms':{'0':{'name':'Si', 'tau':[0.,0.,0.], 'orbitals':['s','px','py','pz'],
+                        's':-4.2, 'px':1.7, 'py':1.7, 'pz':1.7}},
+          'hoppings':{'sss':-1.9, 'sps':1.8, 'pps':3.0, 'ppp':-1.1}}
+
+cases = {
+  'cubium':
+    {'model':{'label':'cubium', 't':1.0},
+     'nfft':[24,24,24],
+     'stages':['dos', 'transport', 'epsilon']},
+
+  'cubium_supercell':
+    {'model':{'label':'cubium', 't':1.0, 'supercell':[2,2,2]},
+     'nfft':[12,12,12],
+     'stages':['dos', 'transport', 'epsilon']},
+
+  'cubium_spin':
+    {'model':{'label':'cubium', 't':1.0, 'supercell':[2,2,1], 'nspin':2, 'zeeman':.5},
+     'nfft':[12,12,12],
+     'stages':['dos', 'transport']},
+
+  'graphene_supercell':
+    {'model':{'label':'graphene', 't':-1.0, 'supercell':[3,3,1]},
+     'nfft':[24,24,1],
+     'attributes':{'shift':5., 'dftSO':False, 'Efermi':0.},
+     'stages':['dos', 'epsilon']},
+
+  'kane_mele':
+    {'model':{'label':'Kane_Mele', 't':1.0, 'soc_par':0.1, 'r_par':0.05, 'v_par':0.1, 'alat':1.0, 'supercell':[2,2,1]},
+     'nfft':[24,24,1],
+     'attributes':{'shift':5., 'dftSO':True, 'Efermi':0.},
+     'stages':['dos', 'anomalous_Hall', 'epsilon']},
+
+  'slater_koster':
+    {'model':{'label':'Slater_Koster', 'model':sk_sp3},
+     'nfft':[16,16,16],
+     'attributes':{'Efermi':0.},
+     'stages':['dos', 'transport', 'epsilon']},
+}
@@ -0,0 +1,167 @@
+#
+# PAOFLOW
+#
+# Utility to construct and operate on Hamiltonians from the Projections of DFT wfc on Atomic Orbital bases (PAO)
+#
+# Copyright (C) 2016-2018 ERMES group (http://ermes.unt.edu, mbn@unt.edu)
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `License'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#
+
+import os, sys
+import json
+import argparse
+import subprocess
+
+
+############# Runs the PAOFLOW benchmark suite #############
+## Usage:
+##  "python run_benchmarks.py [--cases cubium,kane_mele] [--np 1,2,4] [--repeat 3] [--output results.json]"
+##  "python run_benchmarks.py --compare baseline.json [...]"         (run, then compare with a baseline)
+##  "python run_benchmarks.py --compare baseline.json results.json"  (compare two result files)
+##
+## Each case runs serially for np=1 and under 'mpirun -np N' otherwise (see --mpirun).
+## The fastest of the repeated runs is kept for each stage.
+############################################################
+
+def git_commit ( path ):
+  try:
+    return subprocess.check_output(['git','rev-parse','--short','HEAD'], cwd=path, stderr=subprocess.DEVNULL).decode().strip()
+  except Exception:
+    return 'unknown'
+
+
+def environment ( ):
+  import platform
+  import numpy as np
+  import scipy
+  from datetime import datetime
+
+  return {'date':datetime.now().isoformat(timespec='seconds'), 'host':platform.node(),
+          'python':platform.python_version(), 'numpy':np.__version__, 'scipy':scipy.__version__,
+          'cpus':os.cpu_count()}
+
+
+def run_one ( case, nproc, args, workpath ):
+  '''
+  Run 'case' on 'nproc' ranks and return its record, or None if the run failed
+  '''
+  here = os.path.dirname(os.path.abspath(__file__))
+  output = os.path.join(workpath, '%s_np%d.json'%(case,nproc))
+
+  command = [sys.executable, os.path.join(here,'bench_case.py'), case, output, '--workpath', workpath]
+  for opt in ['supercell', 'nfft', 'nspin', 'paoflow']:
+    if getattr(args,opt) is not None:
+      command += ['--'+opt, str(getattr(args,opt))]
+  if nproc > 1:
+    command = args.mpirun.format(np=nproc).split() + command
+
+  logfile = os.path.join(workpath, '%s_np%d.log'%(case,nproc))
+  with open(logfile, 'w') as log:
+    if subprocess.call(command, stdout=log, stderr=subprocess.STDOUT) != 0:
+      print('  FAILED, see %s'%logfile)
+      return None
+
+  with open(output, 'r') as f:
+    return json.load(f)
+
+
+def fastest ( records ):
+  '''
+  Merge repeated runs of a case, keeping the shortest time of each stage
+  '''
+  best = dict(records[0])
+  best['stages'] = {}
+  for name in records[0]['stages']:
+    best['stages'][name] = min((r['stages'][name] for r in records), key=lambda s : s['time'])
+  best['total'] = min(r['total'] for r in records)
+  best['repeat'] = len(records)
+  return best
+
+
+def compare ( baseline, results, threshold ):
+  '''
+  Print the stage timings of 'results' relative to 'baseline'
+
+  Returns:
+    regressions (int): Number of stages slower than 'threshold' times the baseline
+  '''
+  regressions = 0
+  print('Baseline %s (%s), results %s (%s)'%(baseline['commit'],baseline['environment']['date'],
+                                             results['commit'],results['environment']['date']))
+  base = {(r['case'],r['nranks']):r for r in baseline['runs']}
+  for r in results['runs']:
+    key = (r['case'],r['nranks'])
+    if key not in base:
+      print('%s np=%d: not in baseline'%key)
+      continue
+    print('\n%s np=%d (nawf %d, nspin %d, nfft %s)'%(key+(r['nawf'],r['nspin'],r['nfft'])))
+    for name,s in list(r['stages'].items())+[('Total',{'time':r['total']})]:
+      if name not in base[key]['stages'] and name != 'Total':
+        continue
+      t0 = base[key]['total'] if name == 'Total' else base[key]['stages'][name]['time']
+      ratio = s['time']/t0 if t0 > 0 else 1.
+      # Stages below the timer resolution are not compared
+      slow = ratio > threshold and s['time'] > 0.05
+      regressions += slow
+      print('  %-34s %9.3f s %9.3f s %7.2fx%s'%(name,t0,s['time'],ratio,('  SLOWER' if slow else '')))
+  return regressions
+
+
+def main ( ):
+
+  here = os.path.dirname(os.path.abspath(__file__))
+  sys.path.insert(0, here)
+  from cases import cases
+
+  parser = argparse.ArgumentParser(description='Run the PAOFLOW benchmark suite')
+  parser.add_argument('--cases', default=','.join(cases), help='Comma separated list of cases (default: all)')
+  parser.add_argument('--np', default='1', help='Comma separated list of rank counts')
+  parser.add_argument('--repeat', type=int, default=1, help='Number of runs of each case')
+  parser.add_argument('--supercell', help='Supercell m1,m2,m3 replacing those of the cases')
+  parser.add_argument('--nfft', help='Interpolation grid n1,n2,n3 replacing those of the cases')
+  parser.add_argument('--nspin', type=int, help='Number of spins (1 or 2)')
+  parser.add_argument('--paoflow', help='Directory containing the PAOFLOW package to benchmark (default: installed)')
+  parser.add_argument('--mpirun', default='mpirun -np {np}', help='MPI launcher, {np} is replaced by the rank count')
+  parser.add_argument('--workpath', default='benchmark_runs', help='Directory housing the runs')
+  parser.add_argument('--output', help='JSON file receiving the results (default: benchmark_<commit>.json)')
+  parser.add_argument('--compare', nargs='+', help='Baseline JSON file to compare with, or baseline and results files')
+  parser.add_argument('--threshold', type=float, default=1.1, help='Slowdown ratio reported as a regression')
+  args = parser.parse_args()
+
+  if args.compare is not None and len(args.compare) == 2:
+    baseline,results = [json.load(open(f,'r')) for f in args.compare]
+    sys.exit(1 if compare(baseline, results, args.threshold) > 0 else 0)
+
+  workpath = os.path.abspath(args.workpath)
+  os.makedirs(workpath, exist_ok=True)
+
+  source = os.path.dirname(here) if args.paoflow is None else os.path.realpath(os.path.join(args.paoflow,'PAOFLOW'))
+  results = {'commit':git_commit(source), 'environment':environment(), 'runs':[]}
+
+  failed = 0
+  for case in args.cases.split(','):
+    for nproc in [int(n) for n in args.np.split(',')]:
+      print('Running %s on %d rank%s'%(case,nproc,('' if nproc==1 else 's')))
+      records = [run_one(case, nproc, args, workpath) for _ in range(args.repeat)]
+      if None in records:
+        failed += 1
+        continue
+      results['runs'].append(fastest(records))
+      print('  %.3f s'%results['runs'][-1]['total'])
+
+  output = args.output if args.output is not None else 'benchmark_%s.json'%results['commit']
+  with open(output, 'w') as f:
+    json.dump(results, f, indent=1)
+  print('Results written to %s'%output)
+
+  regressions = 0
+  if args.compare is not None:
+    baseline = json.load(open(args.compare[0],'r'))
+    regressions = compare(baseline, results, args.threshold)
+  sys.exit(1 if failed+regressions > 0 else 0)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,169 @@
+#
+# PAOFLOW
+#
+# Utility to construct and operate on Hamiltonians from the Projections of DFT wfc on Atomic Orbital bases (PAO)
+#
+# Copyright (C) 2016-2018 ERMES group (http://ermes.unt.edu, mbn@unt.edu)
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `License'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#
+
+import os, sys
+import json
+import argparse
+import subprocess
+
+
+############# Measures the startup cost of PAOFLOW #############
+## Usage:
+##  "python startup.py [--repeat 5] [--budget-import 0.1] [--budget-modules 0.25] [--paoflow path] [--output startup.json]"
+##
+## Every measurement runs in a fresh interpreter and the fastest of the repeats is kept:
+##  import   'from PAOFLOW import PAOFLOW', beyond the import of numpy
+##  modules  import of the PAOFLOW modules of the k-space stages, beyond that of
+##           their dependencies (numpy, scipy.linalg, scipy.fftpack, scipy.constants, mpi4py)
+##  mpi      import of mpi4py, which initializes MPI (skipped with PAOFLOW_MPI=0)
+##  run      wall time of a short cubium run (interpolation, eigh, gradient, smearing, DOS, transport)
+## The exit status is 1 if 'import' or 'modules' exceed their budget, if importing PAOFLOW
+## loads anything beyond numpy, or if the k-space modules load one of the 'forbidden' modules.
+################################################################
+
+# PAOFLOW modules used by the k-space stages of a typical run
+hot_modules = ['PAOFLOW.DataController', 'PAOFLOW.defs.communication', 'PAOFLOW.defs.models',
+               'PAOFLOW.defs.checkpoint', 'PAOFLOW.defs.memory_model', 'PAOFLOW.defs.do_bands',
+               'PAOFLOW.defs.do_double_grid', 'PAOFLOW.defs.do_eigh', 'PAOFLOW.defs.do_gradient',
+               'PAOFLOW.defs.do_momentum', 'PAOFLOW.defs.do_adaptive_smearing', 'PAOFLOW.defs.do_dos',
+               'PAOFLOW.defs.do_pdos', 'PAOFLOW.defs.do_transport', 'PAOFLOW.defs.do_Boltz_tensors',
+               'PAOFLOW.defs.do_Hall', 'PAOFLOW.defs.do_epsilon', 'PAOFLOW.defs.do_Efermi',
+               'PAOFLOW.defs.tetrahedra', 'PAOFLOW.defs.broadening']
+
+# Third party modules the k-space stages must not load
+forbidden = ['sympy', 'matplotlib', 'scipy.stats', 'scipy.signal', 'scipy.optimize', 'scipy.integrate', 'pycuda', 'skcuda']
+
+dependencies = ['numpy', 'scipy.linalg', 'scipy.fftpack', 'scipy.constants']
+
+measure_import = '''
+import sys, json
+from time import perf_counter
+import numpy
+before = set(sys.modules)
+t = perf_counter()
+from PAOFLOW import PAOFLOW
+t = perf_counter() - t
+loaded = sorted({m.split('.')[0] for m in set(sys.modules)-before} - {'PAOFLOW'})
+print(json.dumps({'time':t, 'loaded':loaded}))
+'''
+
+measure_modules = '''
+import sys, json, importlib
+from time import perf_counter
+for m in %r:
+  importlib.import_module(m)
+try:
+  import mpi4py.MPI
+except ImportError:
+  pass
+t = perf_counter()
+for m in %r:
+  # Modules missing from older versions are skipped
+  try:
+    importlib.import_module(m)
+  except ModuleNotFoundError as e:
+    if e.name != m:
+      raise
+t = perf_counter() - t
+print(json.dumps({'time':t, 'loaded':sorted(m for m in sys.modules if m.split('.')[0] != 'PAOFLOW')}))
+'''
+
+measure_mpi = '''
+import json
+from time import perf_counter
+t = perf_counter()
+try:
+  from mpi4py import MPI
+except ImportError:
+  pass
+print(json.dumps({'time':perf_counter()-t}))
+'''
+
+measure_run = '''
+import json, os, tempfile
+from time import perf_counter
+t = perf_counter()
+from PAOFLOW import PAOFLOW
+with tempfile.TemporaryDirectory() as workpath:
+  paoflow = PAOFLOW.PAOFLOW(model={'label':'cubium', 't':1.0}, workpath=workpath, verbose=False)
+  init = perf_counter() - t
+  paoflow.interpolated_hamiltonian(4, 4, 4)
+  paoflow.pao_eigh()
+  paoflow.gradient_and_momenta()
+  paoflow.adaptive_smearing()
+  paoflow.dos(emin=-6., emax=6., ne=100)
+  paoflow.transport(emin=-2., emax=2., ne=50)
+  paoflow.finish_execution()
+print(json.dumps({'time':perf_counter()-t, 'init':init}))
+'''
+
+
+def run_python ( code, paoflow ):
+  '''
+  Run 'code' in a fresh interpreter and return the JSON object printed on its last line
+  '''
+  env = dict(os.environ)
+  if paoflow is not None:
+    env['PYTHONPATH'] = os.pathsep.join([os.path.abspath(paoflow)] + ([env['PYTHONPATH']] if 'PYTHONPATH' in env else []))
+  out = subprocess.run([sys.executable, '-c', code], env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
+  return json.loads(out.stdout.decode().strip().split('\n')[-1])
+
+
+def fastest ( code, paoflow, repeat ):
+  return min((run_python(code, paoflow) for _ in range(repeat)), key=lambda r : r['time'])
+
+
+def main ( ):
+
+  parser = argparse.ArgumentParser(description='Measure the startup cost of PAOFLOW')
+  parser.add_argument('--repeat', type=int, default=5, help='Number of measurements of each quantity')
+  parser.add_argument('--budget-import', type=float, default=0.1, help='Budget in seconds of \'from PAOFLOW import PAOFLOW\'')
+  parser.add_argument('--budget-modules', type=float, default=0.25, help='Budget in seconds of the import of the k-space modules')
+  parser.add_argument('--paoflow', help='Directory containing the PAOFLOW package to measure (default: installed)')
+  parser.add_argument('--output', help='JSON file receiving the measurements')
+  args = parser.parse_args()
+
+  # The first run compiles the modules, it is not measured
+  run_python(measure_import, args.paoflow)
+
+  results = {'import':fastest(measure_import, args.paoflow, args.repeat),
+             'modules':fastest(measure_modules%(dependencies,hot_modules), args.paoflow, args.repeat),
+             'mpi':fastest(measure_mpi, args.paoflow, args.repeat),
+             'run':fastest(measure_run, args.paoflow, args.repeat)}
+
+  failures = []
+  if results['import']['time'] > args.budget_import:
+    failures.append('import of PAOFLOW above budget')
+  if len(results['import']['loaded']) > 0 and results['import']['loaded'] != ['numpy']:
+    failures.append('import of PAOFLOW loads %s'%', '.join(results['import']['loaded']))
+  if results['modules']['time'] > args.budget_modules:
+    failures.append('import of the k-space modules above budget')
+  loaded = [f for f in forbidden if f in results['modules']['loaded']]
+  if len(loaded) > 0:
+    failures.append('k-space modules load %s'%', '.join(loaded))
+
+  print('import PAOFLOW      %8.3f s  (budget %.3f s)'%(results['import']['time'],args.budget_import))
+  print('k-space modules     %8.3f s  (budget %.3f s)'%(results['modules']['time'],args.budget_modules))
+  print('mpi4py              %8.3f s'%results['mpi']['time'])
+  print('cubium run          %8.3f s  (initialization %.3f s)'%(results['run']['time'],results['run']['init']))
+  for f in failures:
+    print('FAILED: %s'%f)
+
+  if args.output is not None:
+    results['modules'].pop('loaded')
+    with open(args.output, 'w') as f:
+      json.dump(dict(results, failures=failures), f, indent=1)
+
+  sys.exit(1 if len(failures) > 0 else 0)
+
+if __name__ == '__main__':
+  main()
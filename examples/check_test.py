@@ -17,19 +17,20 @@ import numpy as np
 
 ############# Verifies the output of PAOFLOW #############
 ## Usage:
-##  "python check_test.py [test_directory_pattern] [output_directory] [reference_directory]"
+##  "python check_test.py [test_directory_pattern] [output_directory] [reference_directory] [tolerance]"
 ##
 ## Default:
-##  "python check_test.py example* output Reference"
+##  "python check_test.py example* output Reference 0.01"
 ##
 ##########################################################
 
-def verifyData ( subdir, datPattern, refPattern ):
+def verifyData ( subdir, datPattern, refPattern, tolerance=0.01 ):
+
+    # tolerance: Fraction of the data range that the mean absolute error can reach to pass tests
 
     ########## User Defined Variables ##########
     showFileResult = False   # Show PASS or FAIL for each file
     showErrors = False  # Flag to print out error values
-    tolerance = 0.01  # Percentage that error can deviate from average to pass tests
     ######### End User Defined Variables ########
 
     print(('Verifying .dat files for %s' % subdir))
@@ -143,11 +144,16 @@ def main():
     if len(sys.argv) > 3:
         refPattern = sys.argv[3]
 
+    # Assign default tolerance, then look for argument
+    tolerance = 0.01
+    if len(sys.argv) > 4:
+        tolerance = float(sys.argv[4])
+
     # Verify data for each test matching the input or default pattern
     for n in range(len(alldir)):
         os.chdir(alldir[n])
         subdir = str(os.getcwd()).split('/')[len(str(os.getcwd()).split('/'))-1]
-        verifyData(subdir, datPattern, refPattern)
+        verifyData(subdir, datPattern, refPattern, tolerance)
         os.chdir('../')
 
 
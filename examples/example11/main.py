@@ -0,0 +1,49 @@
+# *************************************************************************************
+# *                                                                                   *
+# *   PAOFLOW *  Marco BUONGIORNO NARDELLI * University of North Texas 2016-2018      *
+# *                                                                                   *
+# *************************************************************************************
+#
+#  Copyright 2016-2018 - Marco BUONGIORNO NARDELLI (mbn@unt.edu) - AFLOW.ORG consortium
+#
+#  This file is part of AFLOW software.
+#
+#  AFLOW is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from PAOFLOW import PAOFLOW
+
+def main():
+
+  # Tight-binding model of a simple cubic crystal with one s orbital, its band spans [-12,0] eV
+  paoflow = PAOFLOW.PAOFLOW(model={'label':'cubium', 't':1.0}, outputdir='output', smearing='gauss', verbose=True)
+  paoflow.interpolated_hamiltonian(nfft1=24, nfft2=24, nfft3=24)
+  paoflow.pao_eigh()
+  paoflow.gradient_and_momenta(band_curvature=True)
+  paoflow.adaptive_smearing()
+
+  # DoS and PDoS with adaptive smearing and with the linear tetrahedron method
+  paoflow.dos(emin=-13., emax=1., ne=561)
+  paoflow.dos(emin=-13., emax=0., ne=521, tetrahedra=True)
+
+  # Transport and Hall tensors with adaptive smearing, and the conductivity at T=0 with tetrahedra
+  paoflow.transport(tmin=300., tmax=500., nt=3, emin=-10., emax=-2., ne=81, do_hall=True, tetrahedra=True)
+
+  # Chemical potential (Fermi energy at T=0) of two hole dopings, of 0.7 and 1 hole per cell
+  paoflow.doping(tmin=0., tmax=1000., nt=11, emin=-13., emax=0., ne=2001, doping_conc=[7.e23, 1.e24])
+
+  paoflow.finish_execution()
+
+if __name__== '__main__':
+  main()
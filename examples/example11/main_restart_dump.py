@@ -0,0 +1,42 @@
+# *************************************************************************************
+# *                                                                                   *
+# *   PAOFLOW *  Marco BUONGIORNO NARDELLI * University of North Texas 2016-2018      *
+# *                                                                                   *
+# *************************************************************************************
+#
+#  Copyright 2016-2018 - Marco BUONGIORNO NARDELLI (mbn@unt.edu) - AFLOW.ORG consortium
+#
+#  This file is part of AFLOW software.
+#
+#  AFLOW is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from PAOFLOW import PAOFLOW
+
+def main():
+
+  # The stages of main.py up to the adaptive smearing, written to the output directory of the restarted run
+  paoflow = PAOFLOW.PAOFLOW(model={'label':'cubium', 't':1.0}, outputdir='output_restart', smearing='gauss', verbose=True)
+  paoflow.interpolated_hamiltonian(nfft1=24, nfft2=24, nfft3=24)
+  paoflow.pao_eigh()
+  paoflow.gradient_and_momenta(band_curvature=True)
+  paoflow.adaptive_smearing()
+
+  # Dump PAOFLOW data for the restarted run, which may use a different number of processors
+  paoflow.restart_dump(fname_prefix='paoflow_dump')
+
+  paoflow.finish_execution()
+
+if __name__== '__main__':
+  main()
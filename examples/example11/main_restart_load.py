@@ -0,0 +1,42 @@
+# *************************************************************************************
+# *                                                                                   *
+# *   PAOFLOW *  Marco BUONGIORNO NARDELLI * University of North Texas 2016-2018      *
+# *                                                                                   *
+# *************************************************************************************
+#
+#  Copyright 2016-2018 - Marco BUONGIORNO NARDELLI (mbn@unt.edu) - AFLOW.ORG consortium
+#
+#  This file is part of AFLOW software.
+#
+#  AFLOW is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from PAOFLOW import PAOFLOW
+
+def main():
+
+  # Initialize PAOFLOW as a 'restart' run and load the dumped data
+  paoflow = PAOFLOW.PAOFLOW(restart=True)
+  paoflow.restart_load(fname_prefix='paoflow_dump')
+
+  # The remaining stages of main.py, their output must match the references
+  paoflow.dos(emin=-13., emax=1., ne=561)
+  paoflow.dos(emin=-13., emax=0., ne=521, tetrahedra=True)
+  paoflow.transport(tmin=300., tmax=500., nt=3, emin=-10., emax=-2., ne=81, do_hall=True, tetrahedra=True)
+  paoflow.doping(tmin=0., tmax=1000., nt=11, emin=-13., emax=0., ne=2001, doping_conc=[7.e23, 1.e24])
+
+  paoflow.finish_execution()
+
+if __name__== '__main__':
+  main()
@@ -0,0 +1,57 @@
+# *************************************************************************************
+# *                                                                                   *
+# *   PAOFLOW *  Marco BUONGIORNO NARDELLI * University of North Texas 2016-2018      *
+# *                                                                                   *
+# *************************************************************************************
+#
+#  Copyright 2016-2018 - Marco BUONGIORNO NARDELLI (mbn@unt.edu) - AFLOW.ORG consortium
+#
+#  This file is part of AFLOW software.
+#
+#  AFLOW is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import numpy as np
+from PAOFLOW import PAOFLOW
+
+def main():
+
+  # Kane-Mele model of a 2D topological insulator, with spin-orbit coupling
+  model = {'label':'Kane_Mele', 't':1.0, 'soc_par':0.1, 'r_par':0.05, 'v_par':0.1, 'alat':1.0}
+  paoflow = PAOFLOW.PAOFLOW(model=model, outputdir='output', smearing='gauss', verbose=True)
+
+  # The model does not set the attributes of the DFT calculation. With 1.5 electrons the Fermi energy
+  # lies in the lower bands, it is computed on the interpolated grid and taken as the zero of energy
+  arrays,attr = paoflow.data_controller.data_dicts()
+  attr.update({'bnd':attr['nawf'], 'shift':5., 'dftSO':True, 'Efermi':0., 'nelec':1.5, 'insulator':False})
+
+  # An exchange field along z on both sites (orbitals A up, A down, B up, B down) breaks
+  # time reversal symmetry, without it the anomalous Hall conductivity vanishes
+  arrays['HRs'][range(4),range(4),0,0,0,0] += .2*np.array([1.,-1.,1.,-1.])
+
+  paoflow.interpolated_hamiltonian(nfft1=18, nfft2=18, nfft3=1, reshift_Ef=True)
+  paoflow.pao_eigh()
+  paoflow.gradient_and_momenta()
+  paoflow.adaptive_smearing()
+
+  # DoS and PDoS with adaptive smearing, some states have widths far below the energy spacing
+  paoflow.dos(emin=-4., emax=4., ne=801)
+
+  # Anomalous Hall conductivity (DC and AC)
+  paoflow.anomalous_Hall(do_ac=True, emin=-3., emax=3., a_tensor=np.array([[0,1]]))
+
+  paoflow.finish_execution()
+
+if __name__== '__main__':
+  main()
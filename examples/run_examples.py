@@ -52,7 +52,8 @@ def oneRun(subdir):
 
     calcList = []
     fileList = []
-    if len(glob.glob('*.save')) == 0:
+    # Examples of tight-binding models have no DFT calculation
+    if len(glob.glob('*.save')) == 0 and os.path.exists('scf.in'):
         calcList = ['scf','nscf','proj']
         fileList = ['scf.in','nscf.in','proj.in']
 #        if 'example01' in subdir:
@@ -24,7 +24,9 @@ class DataController:
 
   error_handler = report_exception = None
 
-  def __init__ ( self, workpath, outputdir, inputfile, model, savedir, npool, smearing, acbn0, verbose, restart ):
+  comm_stats = backend = None
+
+  def __init__ ( self, workpath, outputdir, inputfile, model, savedir, npool, smearing, acbn0, verbose, restart, qe_cache=False, ooc_threshold=None, scratchdir='scratch', memory_budget=None, comm_stats=False, workers=1, pool='thread', blas_threads=None ):
     '''
     Initialize the DataController
     Arguments:
@@ -38,18 +40,33 @@ class DataController:
         smearing (str): Smearing type (None, m-p, gauss)
         verbose (bool): False supresses debugging output
         restart (bool): True if the run is being restarted from a .json data dump.
+        qe_cache (bool): If True the parsed QE data is cached in, and read from, the .save directory (opt-in, the .save directory is written to)
+        ooc_threshold (float): Size in GBytes above which the largest k-space arrays are stored in files, None keeps every array in memory
+        scratchdir (str): Directory (in the working directory path) housing the files of out-of-core arrays
+        memory_budget (float): Memory available to each rank in GBytes, None disables the memory planning
+        comm_stats (bool): If True the calls, bytes and time of every MPI operation are accounted for, per operation and per stage
+        workers (int): Number of workers running the k-point kernels and FFT batches of each process, None uses every core available to the process
+        pool (str): Type of the workers, 'thread' or 'process'
+        blas_threads (int): Number of BLAS threads of each worker, None divides the cores of the process among its workers unless OMP_NUM_THREADS is set
     Returns:
         None
     '''
     from os import mkdir
-    from mpi4py import MPI
     from os.path import join,exists
     from .ErrorHandler import ErrorHandler
+    from .defs.communication import comm
+    from .defs.backend import ExecutionBackend
 
-    self.comm = MPI.COMM_WORLD
+    self.comm = comm
     self.rank = self.comm.Get_rank()
     self.size = self.comm.Get_size()
 
+    if comm_stats:
+      from .defs import comm_stats as stats
+      self.comm_stats = stats.active = stats.CommStats(self.comm)
+
+    self.backend = ExecutionBackend(workers, pool, blas_threads, self.comm)
+
     if model is not None:
       if (inputfile is not None or savedir is not None) and self.rank == 0:
         print('\nWARNING: Model specified in addition to inputfile or savedir. Model will be used.')
@@ -71,6 +88,14 @@ class DataController:
       attr['verbose'] = verbose
       attr['workpath'] = workpath
       attr['acbn0'] = acbn0
+      attr['qe_cache'] = qe_cache
+      attr['ooc_threshold'] = ooc_threshold
+      attr['scratchdir'] = join(workpath, scratchdir)
+      # Size in GBytes of the blocks of k-points read at once from large arrays
+      attr['ooc_chunk'] = .25
+      # Batch sizes of the FFT and eigensolver loops, chosen by the memory model when a budget is set
+      attr['memory_budget'] = memory_budget
+      attr['fft_batch'] = attr['eigh_batch'] = 1
       attr['inputfile'],attr['outputdir'] = inputfile,outputdir
       attr['opath'] = join(workpath, outputdir)
       if model is None:
@@ -132,6 +157,79 @@ class DataController:
     return(self.data_arrays, self.data_attributes)
 
 
+  def ooc_array ( self, name, shape, dtype=complex ):
+    '''
+    Allocate a zero initialized array. If its size exceeds the out-of-core threshold it is
+    backed by a file in the scratch directory. The file is unlinked once mapped, so its
+    space is released with the last reference to the array.
+
+    Arguments:
+        name (str): Name of the array, used as prefix of the scratch file
+        shape (tuple): Shape of the array
+        dtype (dtype): Data type of the array
+
+    Returns:
+        arr (ndarray or memmap): The allocated array
+    '''
+    import numpy as np
+    from os import close,makedirs,remove
+    from tempfile import mkstemp
+
+    attr = self.data_attributes
+    threshold = attr.get('ooc_threshold', None)
+    nbytes = int(np.prod(shape))*np.dtype(dtype).itemsize
+
+    if threshold is None or nbytes < threshold*1.e9:
+      return np.zeros(shape, dtype=dtype)
+
+    makedirs(attr['scratchdir'], exist_ok=True)
+    fd,fname = mkstemp(prefix='%s_%d_'%(name,self.rank), suffix='.dat', dir=attr['scratchdir'])
+    close(fd)
+    arr = np.memmap(fname, dtype=dtype, mode='w+', shape=tuple(shape))
+    remove(fname)
+    return arr
+
+
+  def spill_array ( self, key ):
+    '''
+    Move the array 'key' to a file in the scratch directory if it exceeds the out-of-core threshold.
+    The first dimension is copied in blocks.
+
+    Arguments:
+        key (str): Key of the array in the arrays dictionary
+
+    Returns:
+        None
+    '''
+    import numpy as np
+
+    arr = self.data_arrays[key]
+    if isinstance(arr, np.memmap):
+      return
+
+    ooc = self.ooc_array(key, arr.shape, arr.dtype)
+    if isinstance(ooc, np.memmap):
+      for ks,ke in self.k_chunks(arr.shape[0], arr[:1].nbytes):
+        ooc[ks:ke] = arr[ks:ke]
+      self.data_arrays[key] = ooc
+
+
+  def k_chunks ( self, nk, kbytes ):
+    '''
+    Blocks of k-points for loops over large (possibly out-of-core) arrays
+
+    Arguments:
+        nk (int): Number of k-points
+        kbytes (int): Number of bytes used by a single k-point
+
+    Returns:
+        chunks (list): List of (start, stop) index pairs covering range(nk)
+    '''
+    chunk = self.data_attributes.get('ooc_chunk', .25)*1.e9
+    nchunk = max(1, int(chunk//max(kbytes,1)))
+    return [(ks,min(ks+nchunk,nk)) for ks in range(0,nk,nchunk)]
+
+
   def print_data ( self ):
     '''
     Print the data dictionary keys
@@ -183,19 +281,76 @@ class DataController:
 
   def read_qe_output ( self ):
     from os.path import exists
-    fpath = self.data_attributes['fpath']
+    from .defs.qe_cache import cache_valid,read_cache,write_cache
+
+    arry,attr = self.data_dicts()
+    fpath = attr['fpath']
 
     if exists(fpath+'/data-file-schema.xml'):
       from .defs.read_QE_xml import parse_qe_data_file_schema
-      parse_qe_data_file_schema(self, fpath+'/data-file-schema.xml')
+      fname = 'data-file-schema.xml'
+      parse = lambda : parse_qe_data_file_schema(self, fpath+'/'+fname)
     elif exists(fpath+'/data-file.xml'):
       from .defs.read_QE_xml import parse_qe_data_file
-      parse_qe_data_file(self, fpath, 'data-file.xml')
+      fname = 'data-file.xml'
+      parse = lambda : parse_qe_data_file(self, fpath, fname)
     else:
       raise Exception('data-file.xml or data-file-schema.xml were not found.\n')
 
+    if attr['qe_cache'] and cache_valid(fpath, fname):
+      qattr,qarry = read_cache(fpath, fname)
+      attr.update(qattr)
+      arry.update(qarry)
+      if attr['verbose']:
+        print('Read %s from the PAOFLOW cache'%fname)
+    else:
+      qattr,qarry = parse()
+      if attr['qe_cache']:
+        try:
+          write_cache(fpath, fname, qattr, qarry)
+        except OSError as e:
+          print('WARNING: Could not write the PAOFLOW cache for %s (%s)'%(fname,e))
+
+
+  def read_atomic_proj ( self, fname='atomic_proj.xml' ):
+    '''
+    Read the projections from atomic_proj.xml, or from its cache, distributed along k-points
+
+    Arguments:
+        fname (str): Name of the projections file in the .save directory
+
+    Returns:
+        None
+    '''
+    from os.path import join
+    from .defs.read_QE_xml import parse_qe_atomic_proj
+    from .defs.qe_cache import cache_valid,read_cache,write_cache
+
+    arry,attr = self.data_dicts()
+    fpath = attr['fpath']
+    keys = ('U','Sks') if attr['acbn0'] else ('U',)
+
+    valid = False
+    if attr['qe_cache'] and self.rank == 0:
+      valid = cache_valid(fpath, fname, keys)
+    valid = self.comm.bcast(valid, root=0)
+
+    if valid:
+      _,qarry = read_cache(fpath, fname, distributed=keys)
+      arry.update(qarry)
+      if self.rank == 0 and attr['verbose']:
+        print('Read %s from the PAOFLOW cache'%fname)
+    else:
+      qarry = parse_qe_atomic_proj(self, join(fpath,fname))
+      if attr['qe_cache']:
+        try:
+          write_cache(fpath, fname, {}, qarry, distributed=keys)
+        except OSError as e:
+          if self.rank == 0:
+            print('WARNING: Could not write the PAOFLOW cache for %s (%s)'%(fname,e))
+
 
-  def write_file_row_col ( self, fname, col1, col2 ):
+  def write_file_row_col ( self, fname, col1, col2, barrier=True ):
     '''
     Write a file with 2 columns
 
@@ -203,6 +358,7 @@ class DataController:
         fname (str): Name of the file (written to outputdir)
         col1 (ndarray): 1D array of values for the rightmost column
         col2 (ndarray): 1D array of values for the leftmost column
+        barrier (bool): If False the ranks do not wait for rank 0 to write the file
 
     Returns:
         None
@@ -219,6 +375,35 @@ class DataController:
       with open(join(attr['opath'],fname), 'w') as f:
         for i in range(len(col1)):
           f.write('%.5f %.15e\n'%(col1[i],col2[i]))
+    if barrier:
+      self.comm.Barrier()
+
+
+  def write_file_columns ( self, fname, col1, cols ):
+    '''
+    Write a file with the column col1 followed by the columns of cols
+
+    Arguments:
+        fname (str): Name of the file (written to outputdir)
+        col1 (ndarray): 1D array of values for the first column
+        cols (ndarray): 2D array of values for the following columns (shape: (ncol,len(col1)))
+
+    Returns:
+        None
+    '''
+    if self.rank == 0:
+      from os.path import join
+      if cols.shape[1] != len(col1):
+        print('ERROR: Cannot write file: %s'%fname)
+        print('Data does not have the same shape')
+        self.comm.Abort()
+
+      attr = self.data_attributes
+
+      fmt = '%.5f' + ' %.15e'*cols.shape[0] + '\n'
+      with open(join(attr['opath'],fname), 'w') as f:
+        for i in range(len(col1)):
+          f.write(fmt%((col1[i],)+tuple(cols[:,i])))
     self.comm.Barrier()
 
 
@@ -17,6 +17,7 @@
 #
 
 import numpy as np
+from .defs.stage_cache import cached_stage
 
 class PAOFLOW:
 
@@ -26,8 +27,11 @@ class PAOFLOW:
 
   start_time = reset_time = None
 
-  # Overestimate factor for guessing memory requirements
-  gb_fudge_factor = 4.
+  # (directory, maximum size in bytes) of the stage cache, None if disabled
+  stage_cache = None
+
+  # Profiler recording per stage timings, None if disabled
+  profiler = None
 
   # Function container for ErrorHandler's method
   report_exception = None
@@ -50,7 +54,7 @@ class PAOFLOW:
 
 
 
-  def __init__ ( self, workpath='./', outputdir='output', inputfile=None, savedir=None, model=None, npool=1, smearing='gauss', acbn0=False, verbose=False, restart=False):
+  def __init__ ( self, workpath='./', outputdir='output', inputfile=None, savedir=None, model=None, npool=1, smearing='gauss', acbn0=False, verbose=False, restart=False, qe_cache=False, stage_cache=None, stage_cache_size=10., ooc_threshold=None, scratchdir='scratch', memory_budget=None, profile=False, comm_stats=False, workers=1, pool='thread', blas_threads=None):
     '''
     Initialize the PAOFLOW class, either with a save directory with required QE output or with an xml inputfile
     Arguments:
@@ -64,21 +68,37 @@ class PAOFLOW:
         acbn0 (bool): If True the Hamiltonian will be Orthogonalized after construction
         verbose (bool): False supresses debugging output
         restart (bool): True if the run is being restarted from a .json data dump.
+        qe_cache (bool): If True the parsed QE data is cached in a 'paoflow_cache' directory inside the .save directory and reused by later runs, whose files have the same size and modification time (or content)
+        stage_cache (str): (optional) Directory of the stage cache. When set, the results of the projection, Hamiltonian, interpolation, diagonalization and gradient stages are stored and reused by later runs with the same inputs
+        stage_cache_size (float): Maximum size of the stage cache in GBytes. Least recently used entries are removed first
+        ooc_threshold (float): (optional) Size in GBytes above which the k-space gradient, momenta and smearing arrays are stored out-of-core, in files in 'scratchdir'
+        scratchdir (str): Directory (in the working directory path) housing the out-of-core files
+        memory_budget (float): (optional) Memory available to each rank in GBytes. When set, the FFT and eigensolver batch sizes are chosen with the per-stage memory model, and the run stops with a report of each stage's requirements if it cannot fit. The pools only split the MPI messages, so npool is raised to the MPI message limit alone and does not change the memory per rank
+        profile (bool): If True the time, communication volume, load imbalance and memory growth of each stage and kernel are recorded, and written to the output directory by finish_execution (paoflow_profile.json and paoflow_profile_trace.json)
+        comm_stats (bool): If True the calls, bytes and time of every MPI operation are accounted for, per operation, stage and calling function. The totals are printed by finish_execution and the records written to the output directory (paoflow_comm.json)
+        workers (int): Number of workers running the k-point kernels (eigh, momenta, Berry curvature, DOS) and the FFT batches of each process. None uses every core available to the process (the cores of the node divided among its ranks), so that single node runs are parallel without an MPI launcher, and hybrid runs with few ranks per node replicate less data. mpi4py is only required for runs on several processes
+        pool (str): Type of the workers, 'thread' or 'process'
+        blas_threads (int): Number of BLAS threads of each worker. None divides the cores of each process among its workers, unless the number of threads is set in the environment (OMP_NUM_THREADS, OPENBLAS_NUM_THREADS, MKL_NUM_THREADS)
     Returns:
         None
     '''
     from time import time
-    from mpi4py import MPI
+    from os.path import join
     from .defs.header import header
     from .DataController import DataController
+    from .defs.communication import comm
 
     #-------------------------------
     # Initialize Parallel Execution
     #-------------------------------
-    self.comm = MPI.COMM_WORLD
+    self.comm = comm
     self.rank = self.comm.Get_rank()
     self.size = self.comm.Get_size()
 
+    if profile:
+      from .defs import profiler
+      self.profiler = profiler.active = profiler.Profiler(self.comm)
+
     #-----------------
     # Print Header
     # Initialize Time
@@ -88,10 +108,13 @@ class PAOFLOW:
       self.start_time = self.reset_time = time()
 
     # Initialize Data Controller
-    self.data_controller = DataController(workpath, outputdir, inputfile, model, savedir, npool, smearing, acbn0, verbose, restart)
+    self.data_controller = DataController(workpath, outputdir, inputfile, model, savedir, npool, smearing, acbn0, verbose, restart, qe_cache, ooc_threshold, scratchdir, memory_budget, comm_stats, workers, pool, blas_threads)
 
     self.report_exception = self.data_controller.report_exception
 
+    if stage_cache is not None:
+      self.stage_cache = (join(workpath,stage_cache), stage_cache_size*1024.**3)
+
     if not restart:
       # Data Attributes
       attr = self.data_controller.data_attributes
@@ -113,15 +136,23 @@ class PAOFLOW:
       if restart:
         print('Run starting from Restart data.')
       else:
+        backend = self.data_controller.backend
         if self.size == 1:
-          print('Serial execution')
+          print('Serial execution' + ('' if backend.workers==1 and backend.blas_threads is None else ' (%s)'%backend))
         else:
           print('Parallel execution on %d processors and %d pool'%(self.size,attr['npool']) + ('' if attr['npool']==1 else 's'))
+          if backend.workers > 1 or backend.blas_threads is not None:
+            print('Each processor runs %s'%backend)
 
     # Do memory checks
+    if not restart and attr['memory_budget'] is not None:
+      self.plan_memory()
     if model is None and not restart and self.rank == 0:
       gbyte = self.memory_check()
-      print('Estimated maximum array size: %.2f GBytes\n' %(gbyte))
+      print('Estimated peak memory per rank: %.2f GBytes' %(gbyte))
+      if attr['ooc_threshold'] is not None:
+        print('Arrays larger than %.2f GBytes are stored out-of-core in %s'%(attr['ooc_threshold'],attr['scratchdir']))
+      print('')
 
     self.report_module_time('Initialization')
 
@@ -130,8 +161,16 @@ class PAOFLOW:
   def report_module_time ( self, mname ):
     from time import time
 
+    if self.profiler is not None:
+      self.profiler.mark()
+
     self.comm.Barrier()
 
+    if self.profiler is not None:
+      self.profiler.stage(mname)
+    if self.data_controller.comm_stats is not None:
+      self.data_controller.comm_stats.stage(mname)
+
     if self.rank == 0:
 
       # White spacing between module name and reported time
@@ -152,20 +191,17 @@ class PAOFLOW:
   def restart_dump ( self, fname_prefix='paoflow_dump' ):
     '''
       Saves the necessary information to restart a PAOFLOW run from any step in calculation.
+      The data is written to the directory 'fname_prefix', as one global .npy file per array and a JSON manifest describing their distribution. The restart may use a different number of processors.
 
       Arguments:
-          fname_prefix (str): Prefix of the filenames which will be written. Files are written to the directory housing the python script which instantiates PAOFLOW, unless otherwise specified in this argument.
+          fname_prefix (str): Name of the checkpoint directory which will be written. The directory is created in the directory housing the python script which instantiates PAOFLOW, unless otherwise specified in this argument.
 
       Returns:
           None
     '''
-    from pickle import dump,HIGHEST_PROTOCOL
-
-    fname = fname_prefix + '_%d'%self.rank + '.json'
+    from .defs.checkpoint import write_checkpoint
 
-    arry,attr = self.data_controller.data_dicts()
-    with open(fname, 'wb') as f:
-      dump([arry,attr], f, HIGHEST_PROTOCOL)
+    write_checkpoint(self.data_controller, fname_prefix)
 
     self.report_module_time('Restart DUMP')
 
@@ -174,31 +210,37 @@ class PAOFLOW:
   def restart_load ( self, fname_prefix='paoflow_dump' ):
     '''
       Loads the previously dumped save files and populates the DataController with said data.
+      Checkpoint directories written by restart_dump can be loaded on any number of processors. Per-processor files from older versions (fname_prefix_<rank>.json) are still read, with the original number of processors.
 
       Arguments:
-          fname_prefix (str): Prefix of the filenames which will be written. Files are written to the directory housing the python script which instantiates PAOFLOW, unless otherwise specified in this argument.
+          fname_prefix (str): Name of the checkpoint directory (or prefix of the per-processor files) to read.
 
       Returns:
           None
     '''
-    from os.path import exists
+    from os.path import exists,isdir
     from pickle import load
+    from .defs.checkpoint import read_checkpoint
 
-    fname = fname_prefix + '_%d'%self.rank + '.json'
-    if not exists(fname):
-      print('Restart file named %s does not exist.'%fname)
-      raise OSError('File: %s not found.'%fname)
+    if isdir(fname_prefix):
+      read_checkpoint(self.data_controller, fname_prefix)
+
+    else:
+      fname = fname_prefix + '_%d'%self.rank + '.json'
+      if not exists(fname):
+        print('Restart file named %s does not exist.'%fname)
+        raise OSError('File: %s not found.'%fname)
 
-    arry,attr = None,None
-    with open(fname, 'rb') as f:
-      arry,attr = load(f)
+      arry,attr = None,None
+      with open(fname, 'rb') as f:
+        arry,attr = load(f)
 
-    if self.size != attr['mpisize']:
-      print('Restarted runs must use the same number of cores as the original run.')
-      raise ValueError('Number of processors does not match that of the previous run.')
+      if self.size != attr['mpisize']:
+        print('Restarted runs from per-processor files must use the same number of cores as the original run.')
+        raise ValueError('Number of processors does not match that of the previous run.')
 
-    self.data_controller.data_arrays = arry
-    self.data_controller.data_attributes = attr
+      self.data_controller.data_arrays = arry
+      self.data_controller.data_attributes = attr
 
     self.report_module_time('Restart LOAD')
 
@@ -206,22 +248,53 @@ class PAOFLOW:
 
   def memory_check ( self ):
     '''
-    Estimate PAOFLOW's memory requirements with a "fudge factor" defined above
+    Estimate PAOFLOW's peak memory per rank with the per-stage memory model (see defs/memory_model.py)
 
     Arguments:
         None
 
     Returns:
-        gbyte (float): Estimated number of Gigabytes required in memory for PAOFLOW to run.
+        gbyte (float): Estimated number of Gigabytes required in memory, by each rank, for PAOFLOW to run.
     '''
-    dxdydz = 3
+    from .defs.memory_model import stage_peaks,stage_requirements
+
     B_to_GB = 1.E-9
-    ff = self.gb_fudge_factor
-    bytes_per_complex = 128//8
-    arry,attr = self.data_controller.data_dicts()
-    nd1,nd2,nd3 = attr['nk1'],attr['nk2'],attr['nk3']
-    spins,num_wave_functions = attr['nspin'],attr['nawf']
-    return num_wave_functions**2 * (nd1*nd2*nd3) * spins * dxdydz * bytes_per_complex * ff * B_to_GB
+    attr = self.data_controller.data_attributes
+    workers = self.data_controller.backend.workers
+    peaks = stage_peaks(stage_requirements(attr, self.size, attr.get('fft_batch',1), attr.get('eigh_batch',1), workers))
+    return max(p[2] for p in peaks) * B_to_GB
+
+
+
+  def plan_memory ( self ):
+    '''
+    Choose the FFT and eigensolver batch sizes fitting the memory budget, with the per-stage memory model,
+    and raise npool to the MPI message limit. Raises MemoryError, after printing the requirements of each stage, if the run cannot fit.
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    '''
+    from .defs.memory_model import memory_report,plan_memory
+
+    attr = self.data_controller.data_attributes
+
+    try:
+      plan = plan_memory(attr, self.size, attr['memory_budget'], workers=self.data_controller.backend.workers)
+    except MemoryError as e:
+      if self.rank == 0:
+        print('\nERROR: %s'%e)
+      raise e
+
+    if plan['npool'] != attr['npool'] and self.rank == 0:
+      print('Warning: %s too low. Setting npool to %s'%(attr['npool'],plan['npool']))
+    attr['npool'],attr['fft_batch'],attr['eigh_batch'] = plan['npool'],plan['fft_batch'],plan['eigh_batch']
+
+    if self.rank == 0 and attr['verbose']:
+      print(memory_report(plan['peaks'], attr['memory_budget']))
+      print('npool: %d, FFT batch: %d, eigensolver batch: %d'%(attr['npool'],attr['fft_batch'],attr['eigh_batch']))
 
 
 
@@ -237,7 +310,7 @@ class PAOFLOW:
     '''
     import resource
     from time import time
-    from mpi4py import MPI
+    from .defs.mpi import MPI
 
     if self.rank == 0:
       tt = time() - self.start_time
@@ -257,8 +330,19 @@ class PAOFLOW:
         print("Memory usage on rank 0:  %6.4f GB"%(mem[0]/1024.0**2))
         print("Maximum concurrent memory usage:  %6.4f GB"%(mem0[0]/1024.0**2))
 
+    if self.profiler is not None:
+      self.profiler.write(self.data_controller.data_attributes['opath'])
+      if self.rank == 0:
+        print('Profile written to %s'%self.data_controller.data_attributes['opath'])
+
+    if self.data_controller.comm_stats is not None:
+      self.data_controller.comm_stats.write(self.data_controller.data_attributes['opath'])
 
+    self.data_controller.backend.shutdown()
 
+
+
+  @cached_stage
   def projections ( self, internal=False ):
     '''
     Calculate the projections on the atomic basis provided by the pseudopotential or 
@@ -269,8 +353,8 @@ class PAOFLOW:
 
     from .defs.do_atwfc_proj import build_pswfc_basis_all
     from .defs.do_atwfc_proj import build_aewfc_basis
-    from .defs.do_atwfc_proj import calc_proj_k
-    from .defs.communication import load_balancing, gather_array
+    from .defs.do_atwfc_proj import calc_proj_k,build_radial_table
+    from .defs.communication import load_balancing
     
     arry,attr = self.data_controller.data_dicts()
     
@@ -284,24 +368,24 @@ class PAOFLOW:
     natwfc = len(basis)
     attr['nawf'] = natwfc
     
+    # Radial form factors are tabulated once and interpolated at every k
+    rtable = build_radial_table(basis)
+
     ini_ik,end_ik = load_balancing(self.size, self.rank,nkpnts)
     Unewaux = np.zeros((end_ik-ini_ik,nbnds,natwfc,nspin), dtype=complex)
     for ispin in range(nspin):
       for ik in range(ini_ik,end_ik):
-        Unewaux[ik-ini_ik,:,:,ispin] = calc_proj_k(self.data_controller, basis, ik, ispin)
-    
-    Unew = np.zeros((nkpnts,nbnds,natwfc,nspin), dtype=complex) if self.rank == 0 else None
-    gather_array(Unew,Unewaux)
-    if self.rank == 0: Unew = np.moveaxis(Unew,0,2)
-    Unew = self.comm.bcast(Unew, root=0)
+        Unewaux[ik-ini_ik,:,:,ispin] = calc_proj_k(self.data_controller, basis, ik, ispin, rtable)
     
-    arry['U'] = Unew
+    # U stays distributed over k-points, as when read from atomic_proj.xml
+    arry['U'] = np.ascontiguousarray(np.moveaxis(Unewaux,0,2))
     arry['basis'] = basis
     
     self.report_module_time('Projections')
 
 
 
+  @cached_stage
   def read_atomic_proj_QE ( self ):
     '''
       Read the wavefunctions and overlaps from atomic-proj.xml, written by Quantum Espresso
@@ -314,8 +398,7 @@ class PAOFLOW:
     arry,attr = self.data_controller.data_dicts()
     fpath = attr['fpath']
     if exists(join(fpath,'atomic_proj.xml')):
-      from .defs.read_QE_xml import parse_qe_atomic_proj
-      parse_qe_atomic_proj(self.data_controller, join(fpath,'atomic_proj.xml'))
+      self.data_controller.read_atomic_proj('atomic_proj.xml')
     else:
       raise Exception('atomic_proj.xml was not found.\n')
 
@@ -332,6 +415,7 @@ class PAOFLOW:
 
 
 
+  @cached_stage
   def projectability ( self, pthr=0.95, shift='auto' ):
     '''
     Calculate the Projectability Matrix to determine how many states need to be shifted
@@ -361,6 +445,7 @@ class PAOFLOW:
     
 
 
+  @cached_stage
   def pao_hamiltonian ( self, shift_type=1, insulator=False, write_binary=False, expand_wedge=True, symmetrize=False, thresh=1.e-6, max_iter=16 ):
     '''
     Construct the Tight Binding Hamiltonian
@@ -775,6 +860,7 @@ mo    '''
 
 
 
+  @cached_stage
   def interpolated_hamiltonian ( self, nfft1=0, nfft2=0, nfft3=0, reshift_Ef=False ):
     '''
     Calculate the interpolated Hamiltonian with the method of zero padding
@@ -810,13 +896,20 @@ mo    '''
 
       attr['nfft1'],attr['nfft2'],attr['nfft3'] = nfft1,nfft2,nfft3
 
-      # Adjust 'npool' if arrays exceed MPI maximum
-      int_max = 2147483647
-      temp_pool = int(np.ceil((float(nawf**2*nfft1*nfft2*nfft3*3*attr['nspin'])/float(int_max))))
-      if temp_pool > attr['npool']:
-        if self.rank == 0:
-          print("Warning: %s too low. Setting npool to %s"%(attr['npool'],temp_pool))
-        attr['npool'] = temp_pool
+      if attr.get('memory_budget', None) is not None:
+        # Choose the batch sizes for the interpolated grid, and npool for the MPI message limit
+        self.plan_memory()
+      else:
+        # Adjust 'npool' if arrays exceed MPI maximum
+        int_max = 2147483647
+        temp_pool = int(np.ceil((float(nawf**2*nfft1*nfft2*nfft3*3*attr['nspin'])/float(int_max))))
+        if temp_pool > attr['npool']:
+          if self.rank == 0:
+            print("Warning: %s too low. Setting npool to %s"%(attr['npool'],temp_pool))
+          attr['npool'] = temp_pool
+
+      # Memory requirements on the interpolated grid, reported below
+      gbyte = self.memory_check()
 
       # Fourier interpolation on extended grid (zero padding)
       do_double_grid(self.data_controller)
@@ -828,7 +921,7 @@ mo    '''
       snktot = arrays['Hksp'].shape[1]
       if reshift_Ef:
         Hksp = arrays['Hksp'].reshape((nawf,nawf,snktot,nspin))
-        Ef = E_Fermi(data_controller, Hksp, parallel=True)
+        Ef = E_Fermi(Hksp, self.data_controller, parallel=True)
         dinds = np.diag_indices(nawf)
         Hksp[dinds[0], dinds[1]] -= Ef
         arrays['Hksp'] = np.moveaxis(Hksp, 2, 0)
@@ -839,11 +932,10 @@ mo    '''
 
       # Report new memory requirements
       if self.rank == 0:
-        gbyte = self.memory_check()
         if attr['verbose']:
           print('Performing Fourier interpolation on a larger grid.')
           print('d : nk -> nfft\n1 : %d -> %d\n2 : %d -> %d\n3 : %d -> %d'%(nko1,nfft1,nko2,nfft2,nko3,nfft3))
-        print('New estimated maximum array size: %.2f GBytes'%gbyte)
+        print('New estimated peak memory per rank: %.2f GBytes'%gbyte)
 
     except Exception as e:
       self.report_exception('interpolated_hamiltonian')
@@ -854,6 +946,7 @@ mo    '''
 
 
 
+  @cached_stage
   def pao_eigh ( self, bval=0 ):
     '''
     Calculate the Eigen values and vectors of k-space Hamiltonian 'Hksp'
@@ -866,7 +959,7 @@ mo    '''
         None
     '''
     from .defs.do_eigh import do_pao_eigh
-    from .defs.communication import gather_scatter,scatter_full,gather_full
+    from .defs.communication import scatter_full
 
     arrays,attr = self.data_controller.data_dicts()
 
@@ -893,13 +986,11 @@ mo    '''
       ## DEV: Sample RunTime Here
       ## DEV: Parallelize search for amax & subtract for all processes.
       if 'HubbardU' in arrays and arrays['HubbardU'].any() != 0.0:
-        arrays['E_k'] = gather_full(arrays['E_k'], attr['npool'])
-        if self.rank == 0:
-          if attr['verbose']:
-            print('Shifting Eigenvalues to top of valence band.')
-          arrays['E_k'] -= np.amax(arrays['E_k'][:,attr['bval'],:])
-        self.comm.Barrier()
-        arrays['E_k'] = scatter_full(arrays['E_k'], attr['npool'])
+        from .defs.mpi import MPI
+        if self.rank == 0 and attr['verbose']:
+          print('Shifting Eigenvalues to top of valence band.')
+        vb = arrays['E_k'][:,attr['bval'],:]
+        arrays['E_k'] -= self.comm.allreduce((np.amax(vb) if vb.size > 0 else -np.inf), op=MPI.MAX)
     except Exception as e:
       self.report_exception('pao_eigh')
       if attr['abort_on_exception']:
@@ -909,14 +1000,52 @@ mo    '''
 
 
 
-  def gradient_and_momenta ( self,band_curvature=False ):
+  def fermi_window ( self, emin=-1., emax=1. ):
     '''
-    Calculate the Gradient of the k-space Hamiltonian, 'Hksp'
+    Restrict the momenta and the Boltzmann transport to the (k, band) pairs with an energy in [emin,emax]
+    Requires 'E_k'
+    Populates DataController with 'window_k' and 'window_bands', the compact index of these pairs
+
+    When called before gradient_and_momenta only the momenta of the k-points of the window are computed,
+    the others remain zero. The stages reading the momenta or adaptive smearing widths of every
+    k-point (the Hall conductivities, the adaptive DoS, PDoS and doping, and the dielectric tensor) then raise a ValueError.
+    The window must extend beyond the energies of the transport by the broadening of the states, about 18 k_BT
+    at the highest temperature or, with adaptive smearing, 8 of the largest widths of the states between each
+    edge of the window and the transport energies. transport raises a ValueError otherwise.
+
+    Arguments:
+        emin (float): The minimum energy of the window
+        emax (float): The maximum energy of the window
+
+    Returns:
+        None
+    '''
+    from .defs.do_fermi_window import do_fermi_window
+
+    attr = self.data_controller.data_attributes
+
+    try:
+      do_fermi_window(self.data_controller, emin, emax)
+    except Exception as e:
+      self.report_exception('fermi_window')
+      if attr['abort_on_exception']:
+        raise e
+
+    self.report_module_time('Fermi Window')
+
+
+
+  @cached_stage
+  def gradient_and_momenta ( self, band_curvature=False, bands=None, diagonal_only=False ):
+    '''
+    Calculate the Gradient of the k-space Hamiltonian, 'Hksp', and the momenta
     Requires 'Hksp'
-    Populates DataController with 'dHksp'
+    Populates DataController with 'dHksp' and 'pksp' (or 'velkp')
 
     Arguments:
-      None
+      band_curvature (bool): If True the band curvature 'd2Ed2k' is computed as well
+      bands (int): Number of lowest bands whose momenta are computed and stored, at least 'bnd'. None computes every band. The Hall conductivities and the adaptive PDOS read the smearing widths of every band
+      diagonal_only (bool): If True only the diagonal of the momenta (band velocities) is computed, and stored in 'velkp', which suffices for the adaptive smearing, DOS and transport. The dielectric tensor requires the full matrices
 
     Returns:
       None
@@ -928,6 +1057,9 @@ mo    '''
 
     arrays,attr = self.data_controller.data_dicts()
 
+    if bands is not None and bands < attr['bnd']:
+      raise ValueError('The momenta of at least the %d projectable bands (bnd) are required, bands=%d'%(attr['bnd'],bands))
+
     try:
       snktot,nawf,_,nspin = arrays['Hksp'].shape
 
@@ -952,6 +1084,7 @@ mo    '''
       arrays['dHksp'] = np.reshape(arrays['dHksp'], (snawf,attr['nkpnts'],3,nspin))
       arrays['dHksp'] = np.moveaxis(gather_scatter(arrays['dHksp'],1,attr['npool']), 0, 2)
       arrays['dHksp'] = np.reshape(arrays['dHksp'], (snktot,3,nawf,nawf,nspin), order="C")
+      self.data_controller.spill_array('dHksp')
 
       if band_curvature:
         from .defs.do_band_curvature import do_band_curvature
@@ -968,7 +1101,7 @@ mo    '''
 
     ### DEV: Proposed to remove this and calculate pksp or velkp when required
     # Compute the momentum operator p_n,m(k) (and kinetic energy operator)
-    do_momentum(self.data_controller)
+    do_momentum(self.data_controller, bands, diagonal_only)
     self.report_module_time('Momenta')
 
 
@@ -976,7 +1109,8 @@ mo    '''
   def adaptive_smearing ( self, smearing='gauss' ):
     '''
     Calculate the Adaptive Smearing parameters
-    Populates DataController with 'deltakp' and 'deltakp2'
+    Populates DataController with 'deltakp', the widths of the bands. The widths of
+    the pairs of bands, used by the AC Hall conductivities, are computed when needed (see pair_widths)
 
     Arguments:
         smearing (str): Smearing type (m-p and gauss)
@@ -1001,7 +1135,7 @@ mo    '''
 
 
 
-  def dos ( self, do_dos=True, do_pdos=True, delta=0.01, emin=-10., emax=2., ne=1000 ):
+  def dos ( self, do_dos=True, do_pdos=True, delta=0.01, emin=-10., emax=2., ne=1000, tetrahedra=False, pdos_columns=False ):
     '''
     Calculate the Density of States and Projected Density of States
       If Adaptive Smearing has been performed, the Adaptive DoS will be calculated
@@ -1013,6 +1147,8 @@ mo    '''
         emin (float): The minimum energy in the range to be computed
         emax (float): The maximum energy in the range to be computed
         ne (int): The number of points to place in the range [emin,emax]
+        tetrahedra (bool): If True the DoS and PDoS are integrated with the linear tetrahedron method (Bloechl corrections), without smearing. They converge on much coarser grids than the smeared ones
+        pdos_columns (bool): If True the PDoS of every orbital and their sum are written as the columns of a single file (e.g. pdos_0.dat), instead of one file per orbital
 
     Returns:
         None
@@ -1022,32 +1158,43 @@ mo    '''
     if 'smearing' not in attr: attr['smearing'] = None
 
     try:
-      if attr['smearing'] is None:
+      if tetrahedra:
+        if do_dos:
+          from .defs.do_dos import do_dos_tetrahedra
+          do_dos_tetrahedra(self.data_controller, emin, emax, ne)
+        if do_pdos:
+          from .defs.do_pdos import do_pdos_tetrahedra
+          do_pdos_tetrahedra(self.data_controller, emin, emax, ne, pdos_columns)
+      elif attr['smearing'] is None:
         if do_dos:
           from .defs.do_dos import do_dos
           do_dos(self.data_controller, emin, emax, ne, delta)
         if do_pdos:
           from .defs.do_pdos import do_pdos
-          do_pdos(self.data_controller, emin, emax, ne, delta)
+          do_pdos(self.data_controller, emin, emax, ne, delta, pdos_columns)
       else:
         if 'deltakp' not in arrays:
           if self.rank == 0:
             print('Perform calc_adaptive_smearing() to calculate \'deltakp\' before calling calc_dos_adaptive()')
           quit()
 
+        from .defs.do_momentum import require_momenta
+
         if do_dos:
           from .defs.do_dos import do_dos_adaptive
+          require_momenta(self.data_controller, 'dos', all_kpoints=True)
           do_dos_adaptive(self.data_controller, emin, emax, ne)
 
         if do_pdos:
           from .defs.do_pdos import do_pdos_adaptive
-          do_pdos_adaptive(self.data_controller, emin, emax, ne)
+          require_momenta(self.data_controller, 'pdos', all_bands=True)
+          do_pdos_adaptive(self.data_controller, emin, emax, ne, pdos_columns)
     except Exception as e:
       self.report_exception('dos')
       if attr['abort_on_exception']:
         raise e
 
-    mname = 'DoS%s'%('' if attr['smearing'] is None else ' (Adaptive Smearing)')
+    mname = 'DoS%s'%(' (Tetrahedra)' if tetrahedra else '' if attr['smearing'] is None else ' (Adaptive Smearing)')
     self.report_module_time(mname)
 
 
@@ -1076,10 +1223,12 @@ mo    '''
     bnd = attributes['nawf'] = attributes['bnd']
 
     arrays['E_k'] = arrays['E_k'][:,:bnd]
-    arrays['pksp'] = arrays['pksp'][:,:,:bnd,:bnd]
+    if 'pksp' in arrays:
+      arrays['pksp'] = arrays['pksp'][:,:,:bnd,:bnd]
+    else:
+      arrays['velkp'] = arrays['velkp'][:,:,:bnd]
     if 'deltakp' in arrays:
       arrays['deltakp'] = arrays['deltakp'][:,:bnd]
-      arrays['deltakp2'] = arrays['deltakp2'][:,:bnd]
 
 
 
@@ -1168,6 +1317,7 @@ mo    '''
         None
     '''
     from .defs.do_Hall import do_spin_Hall
+    from .defs.do_momentum import require_momenta
 
     arrays,attr = self.data_controller.data_dicts()
 
@@ -1181,6 +1331,7 @@ mo    '''
       self.spin_operator()
 
     try:
+      require_momenta(self.data_controller, 'spin_Hall', all_bands=True)
       do_spin_Hall(self.data_controller, twoD, do_ac)
     except Exception as e:
       self.report_exception('spin_Hall')
@@ -1207,6 +1358,7 @@ mo    '''
         None
     '''
     from .defs.do_Hall import do_anomalous_Hall
+    from .defs.do_momentum import require_momenta
 
     arrays,attr = self.data_controller.data_dicts()
 
@@ -1218,6 +1370,7 @@ mo    '''
     if 'fermi_dw' not in attr: attr['fermi_dw'] = fermi_dw
 
     try:
+      require_momenta(self.data_controller, 'anomalous_Hall', all_bands=True)
       do_anomalous_Hall(self.data_controller, do_ac)
     except Exception as e:
       self.report_exception('anomalous_Hall')
@@ -1266,15 +1419,16 @@ mo    '''
         emin (float): The minimum energy in the range
         emax (float): The maximum energy in the range
         ne (float): The number of energy increments
-        doping_conc(float): The amount of doping in 1/cm^3. Positive value for p type and negative value for n type
+        doping_conc(float or list): The amount of doping in 1/cm^3, or several amounts solved together. Positive value for p type and negative value for n type
         core_electrons(float): The number of core electrons in a system. Adding this to integrated dos allows for integration over a narrower energy window
-        fname (str): Prefix for the filename containg Doping vs Temperature
+        fname (str): Prefix for the filename containg Doping vs Temperature (one file per doping level)
 
     Returns:
-        None
+        None. The chemical potentials (ndoping,nt) are stored in the array 'doping_mu'
     '''
     from .defs.do_doping import do_doping
     from .defs.do_dos import do_dos,do_dos_adaptive
+    from .defs.do_momentum import require_momenta
     
     arrays,attr = self.data_controller.data_dicts()
 
@@ -1282,19 +1436,23 @@ mo    '''
     if 'doping_conc' not in attr: attr['doping_conc'] = doping_conc
     if 'core_electrons' not in attr: attr['core_electrons'] = core_electrons
 
+    # Energies of the DoS, which ends at 'shift', shared by the DoS and the solver
+    emax = min(attr['shift'], emax)
     ene = np.linspace(emin, emax, ne)
     temps = np.linspace(tmin, tmax, nt)
     if attr['smearing'] == None:
       do_dos(self.data_controller, emin, emax, ne, delta)
     else:
-      do_dos_adaptive(self.data_controller, emin, emax, ne, delta)
+      # The widths of the k-points outside a Fermi window are zero
+      require_momenta(self.data_controller, 'doping', all_kpoints=True)
+      do_dos_adaptive(self.data_controller, emin, emax, ne)
     do_doping(self.data_controller, temps, ene, fname)
 
     self.report_module_time('Doping')
 
 
 
-  def transport ( self, tmin=300., tmax=300., nt=1, emin=-2., emax=2., ne=500, scattering_channels=[], scattering_weights=[], tau_dict={}, do_hall=False, write_to_file=True, save_tensors=False ):
+  def transport ( self, tmin=300., tmax=300., nt=1, emin=-2., emax=2., ne=500, scattering_channels=[], scattering_weights=[], tau_dict={}, do_hall=False, write_to_file=True, save_tensors=False, tetrahedra=False ):
     '''
     Calculate the Transport Properties
 
@@ -1312,6 +1470,7 @@ mo    '''
         do_hall (bool): Set True to calculate hall coefficient
         write_to_file (bool): Set True to write tensors to file
         save_tensors (bool): Set True to save the tensors into the data controller
+        tetrahedra (bool): If True the conductivity (and Hall trace, with do_hall) at T=0 is also integrated with the linear tetrahedron method, without smearing, and written to sigmatetra (hall_tracetetra). Requires the momenta of every k-point
 
     Returns:
         None
@@ -1325,13 +1484,25 @@ mo    '''
     temps = np.linspace(tmin, tmax, nt)
     sc,sw = scattering_channels,scattering_weights
     try:
+      from .defs.do_momentum import momentum_diagonal
+
+      if tetrahedra and attr.get('momenta_window') is not None:
+        raise ValueError('The tetrahedron transport requires the momenta of every k-point, call gradient_and_momenta before fermi_window')
+
+      if 'fermi_window' in attr:
+        from .defs.do_fermi_window import transport_margin
+
+        # The states within the broadening of the transport energies must be in the window
+        wmin,wmax = attr['fermi_window']
+        lower,upper = transport_margin(self.data_controller, emin, emax, tmax, attr['smearing'])
+        if emin-lower < wmin or emax+upper > wmax:
+          raise ValueError('The transport energies [%.3f,%.3f], extended by the broadening of the states (%.3f and %.3f eV), exceed the Fermi window [%.3f,%.3f]'%(emin,emax,lower,upper,wmin,wmax))
+
       # Compute Velocities for Spin 0 Only
       bnd = attr['bnd']
-      velkp = np.zeros((arrays['pksp'].shape[0],3,bnd,attr['nspin']))
-      for n in range(bnd):
-        velkp[:,:,n,:] = np.real(arrays['pksp'][:,:,n,n,:])
+      velkp = momentum_diagonal(arrays, 0, arrays['E_k'].shape[0])[:,:,:bnd]
 
-      do_transport(self.data_controller, temps, ene, velkp, sc, sw, do_hall, write_to_file, save_tensors)
+      do_transport(self.data_controller, temps, ene, velkp, sc, sw, do_hall, write_to_file, save_tensors, tetrahedra)
 
     except Exception as e:
       self.report_exception('transport')
@@ -1362,6 +1533,7 @@ mo    '''
       print('Epsilon routine is currently under construction.')
     return
     from .defs.do_epsilon import do_dielectric_tensor
+    from .defs.do_momentum import require_momenta
 
     arrays,attr = self.data_controller.data_dicts()
 
@@ -1375,6 +1547,7 @@ mo    '''
     #-----------------------------------------------
 
     try:
+      require_momenta(self.data_controller, 'dielectric_tensor', matrices=True, all_kpoints=True)
       ene = np.linspace(emin, emax, ne)
       do_dielectric_tensor(self.data_controller, ene)
     except Exception as e:
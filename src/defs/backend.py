@@ -0,0 +1,258 @@
+#
+# PAOFLOW
+#
+# Utility to construct and operate on Hamiltonians from the Projections of DFT wfc on Atomic Orbital bases (PAO)
+#
+# Copyright (C) 2016-2018 ERMES group (http://ermes.unt.edu, mbn@unt.edu)
+#
+# Reference:
+# M. Buongiorno Nardelli, F. T. Cerasoli, M. Costa, S Curtarolo,R. De Gennaro, M. Fornari, L. Liyanage, A. Supka and H. Wang,
+# PAOFLOW: A utility to construct and operate on ab initio Hamiltonians from the Projections of electronic wavefunctions on
+# Atomic Orbital bases, including characterization of topological materials, Comp. Mat. Sci. vol. 143, 462 (2018).
+#
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `License'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#
+
+from contextlib import contextmanager
+
+# Entry points (get, set) of the thread count of the BLAS libraries, with the
+# symbol suffixes of the 64 bit integer builds of OpenBLAS
+blas_entry_points = {'openblas':[('openblas_get_num_threads'+s,'openblas_set_num_threads'+s) for s in ['','64_']] +
+                                [('scipy_openblas_get_num_threads'+s,'scipy_openblas_set_num_threads'+s) for s in ['','64_']],
+                     'mkl_rt':[('MKL_Get_Max_Threads','MKL_Set_Num_Threads')],
+                     'blis':[('bli_thread_get_num_threads','bli_thread_set_num_threads')]}
+
+# Environment variables through which users set the number of BLAS threads
+blas_variables = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS']
+
+
+def available_cores ( ):
+  '''
+  Number of cores this process may run on
+  '''
+  from os import cpu_count, sched_getaffinity
+
+  try:
+    return len(sched_getaffinity(0))
+  except (AttributeError, OSError):
+    return cpu_count() or 1
+
+
+def cores_per_rank ( comm ):
+  '''
+  Number of cores of each MPI rank: the cores a rank is bound to by the launcher, or else
+  the cores of the node divided among the ranks it runs
+  '''
+  from os import cpu_count
+  from .mpi import MPI
+
+  cores = available_cores()
+  if comm is None or comm.Get_size() == 1 or cores < (cpu_count() or 1):
+    return cores
+
+  node = comm.Split_type(MPI.COMM_TYPE_SHARED)
+  nranks = node.Get_size()
+  node.Free()
+  return max(1, cores//nranks)
+
+
+def blas_libraries ( ):
+  '''
+  (get, set) functions of the BLAS libraries loaded in the process (numpy and scipy may
+  each load their own), found in the memory map of the process. Empty where /proc is missing.
+  '''
+  import ctypes
+  from os.path import basename
+
+  try:
+    with open('/proc/self/maps') as f:
+      paths = {l.split()[-1] for l in f if '.so' in l}
+  except OSError:
+    return []
+
+  libraries = []
+  for path in sorted(paths):
+    name = basename(path)
+    for prefix,symbols in blas_entry_points.items():
+      if name.startswith('lib'+prefix):
+        try:
+          lib = ctypes.CDLL(path)
+        except OSError:
+          continue
+        for getter,setter in symbols:
+          if hasattr(lib, getter) and hasattr(lib, setter):
+            libraries.append((getattr(lib,getter),getattr(lib,setter)))
+            break
+  return libraries
+
+
+def get_blas_threads ( ):
+  '''
+  Largest number of threads of the BLAS libraries loaded in the process, None if none is found
+  '''
+  try:
+    from threadpoolctl import threadpool_info
+    threads = [l['num_threads'] for l in threadpool_info() if l['user_api'] == 'blas']
+  except ImportError:
+    threads = [getter() for getter,_ in blas_libraries()]
+  return max(threads) if len(threads) > 0 else None
+
+
+def set_blas_threads ( nthreads ):
+  '''
+  Set the number of threads of the BLAS libraries loaded in the process, through threadpoolctl
+  when it is installed or else through the entry points of OpenBLAS, MKL and BLIS
+  '''
+  try:
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(limits=nthreads, user_api='blas')
+  except ImportError:
+    for _,setter in blas_libraries():
+      setter(nthreads)
+
+
+@contextmanager
+def blas_limit ( nthreads ):
+  '''
+  Context in which the BLAS libraries run at most 'nthreads' threads, None leaves them unchanged
+  '''
+  previous = None if nthreads is None else get_blas_threads()
+  if previous is None or previous == nthreads:
+    yield
+    return
+  set_blas_threads(nthreads)
+  try:
+    yield
+  finally:
+    set_blas_threads(previous)
+
+
+class ExecutionBackend:
+  '''
+  Runs the k-point kernels of a process (eigh, momenta, Berry curvature, DOS)
+  over the k-points it holds, either inline or on a concurrent.futures pool of
+  threads or processes. Kernels are split in contiguous blocks of k-points, one
+  per worker, and their results are returned in the order of the blocks.
+  Combined with MPI, every rank runs its own pool (hybrid mode: fewer ranks per
+  node, hence fewer replicas of HRs and of the grids, each using several cores).
+
+  The BLAS threads are governed per phase so that ranks, workers and BLAS threads
+  do not oversubscribe the cores: outside of the pools BLAS uses the cores of the
+  rank, inside them it uses the cores of the rank divided among the workers.
+  '''
+
+  def __init__ ( self, workers=1, pool='thread', blas_threads=None, comm=None ):
+    '''
+    Arguments:
+      workers (int): Number of workers, None uses every core available to the rank. 1 runs the kernels inline
+      pool (str): 'thread' (numpy and LAPACK release the GIL) or 'process' (workers are forked, the blocks of k-points are sent to them)
+      blas_threads (int): Number of BLAS threads of each worker. None divides the cores of the rank among the workers, unless the number of threads is set in the environment (e.g. OMP_NUM_THREADS), which is then left unchanged
+      comm (MPI.Comm): Communicator of the ranks, used to find the ranks sharing a node
+
+    Returns:
+      None
+    '''
+    from os import environ
+
+    if pool not in ['thread', 'process']:
+      raise ValueError('Unknown worker pool \'%s\', use \'thread\' or \'process\''%pool)
+
+    self.cores = cores_per_rank(comm)
+    self.workers = self.cores if workers is None else max(1, int(workers))
+    self.pool = pool
+    self.executor = None
+
+    if blas_threads is None and not any(v in environ for v in blas_variables):
+      blas_threads = max(1, self.cores//self.workers)
+    self.blas_threads = None if blas_threads is None else max(1, int(blas_threads))
+
+    # BLAS threads of the phases run outside of the pools. scipy.linalg
+    # may load a BLAS library of its own, it is loaded first
+    if self.blas_threads is not None:
+      import scipy.linalg
+      set_blas_threads(min(self.cores, self.workers*self.blas_threads))
+
+
+  def rounds ( self, n, batch=1 ):
+    '''
+    Split n items in batches, grouped in rounds of one batch per worker. Used by
+    the FFT stages, whose batches are bounded by the memory model.
+
+    Arguments:
+      n (int): Number of items (e.g. orbital pairs)
+      batch (int): Number of items of each batch
+
+    Returns:
+      rounds (list): Lists of (start, stop) of the batches of each round
+    '''
+    batch = max(batch, 1)
+    batches = [(s,min(s+batch,n)) for s in range(0, n, batch)]
+    return [batches[r:r+self.workers] for r in range(0, len(batches), self.workers)]
+
+
+  def blocks ( self, n, batch=None ):
+    '''
+    Split n k-points in contiguous blocks
+
+    Arguments:
+      n (int): Number of k-points
+      batch (int): Maximum size of the blocks of inline runs. Pools always use one block per worker
+
+    Returns:
+      blocks (list): (start, stop) of each block, a single empty block when n is 0
+    '''
+    from .communication import load_balancing
+
+    if n == 0:
+      return [(0,0)]
+    if self.workers == 1:
+      batch = n if batch is None else max(batch,1)
+      return [(s,min(s+batch,n)) for s in range(0, n, batch)]
+    return [b for b in (load_balancing(self.workers,w,n) for w in range(self.workers)) if b[1] > b[0]]
+
+
+  def map ( self, func, *iterables ):
+    '''
+    Apply 'func' to the items of 'iterables', on the workers of the pool
+
+    Arguments:
+      func (function): Kernel, a module level function for process pools
+      iterables (list): Arguments of each call, usually the blocks of k-space arrays
+
+    Returns:
+      results (list): Return values, in the order of the arguments
+    '''
+    if self.workers == 1:
+      return list(map(func, *iterables))
+
+    if self.executor is None:
+      from concurrent import futures
+      if self.pool == 'thread':
+        self.executor = futures.ThreadPoolExecutor(max_workers=self.workers)
+      else:
+        # Forked workers set their BLAS threads once
+        initializer = None if self.blas_threads is None else set_blas_threads
+        self.executor = futures.ProcessPoolExecutor(max_workers=self.workers, initializer=initializer,
+                                                    initargs=(self.blas_threads,))
+    # Threads share the BLAS libraries of the process, limited for the duration of the phase
+    with blas_limit(self.blas_threads if self.pool == 'thread' else None):
+      return list(self.executor.map(func, *iterables))
+
+
+  def shutdown ( self ):
+    '''
+    Stop the workers of the pool, a later call to map starts a new one
+    '''
+    if self.executor is not None:
+      self.executor.shutdown()
+      self.executor = None
+
+
+  def __str__ ( self ):
+    desc = 'inline kernels' if self.workers == 1 else '%d %s workers'%(self.workers,self.pool)
+    if self.blas_threads is not None:
+      desc += ', %d BLAS thread%s'%(self.blas_threads,('' if self.blas_threads==1 else 's')) + ('' if self.workers==1 else ' each')
+    return desc
@@ -0,0 +1,271 @@
+#
+# PAOFLOW
+#
+# Utility to construct and operate on Hamiltonians from the Projections of DFT wfc on Atomic Orbital bases (PAO)
+#
+# Copyright (C) 2016-2018 ERMES group (http://ermes.unt.edu, mbn@unt.edu)
+#
+# Reference:
+# M. Buongiorno Nardelli, F. T. Cerasoli, M. Costa, S Curtarolo,R. De Gennaro, M. Fornari, L. Liyanage, A. Supka and H. Wang,
+# PAOFLOW: A utility to construct and operate on ab initio Hamiltonians from the Projections of electronic wavefunctions on
+# Atomic Orbital bases, including characterization of topological materials, Comp. Mat. Sci. vol. 143, 462 (2018).
+#
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `License'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#
+
+############# Broadened sums over eigenvalues #############
+## sum_i w_i*f((ene-E_i)/width_i)/width_i on an energy grid, for the Gaussian or
+## Methfessel-Paxton functions f, at a cost O(n + ne*log(ne)) instead of O(n*ne):
+## the E_i are binned on a histogram finer than the width (each split linearly
+## between its two nearest bins), which is convolved with f by FFT. Adaptive
+## widths are binned in log spaced classes, each E_i is shared between the two
+## classes around its width with the weights preserving its variance. Widths
+## below the smallest class (a fraction of the energy spacing) would need too fine
+## a histogram, their functions are evaluated directly on the energies.
+## Sums whose weights depend on both the state and the energy (e.g. (E_i-ene)**a
+## in the Boltzmann tensors) are evaluated by blocks of states sorted by energy,
+## on the energies within the support of f of the states of the block only.
+###########################################################
+
+import numpy as np
+
+# Histogram bins per width
+bins_per_width = 16
+# Largest ratio between the widths of consecutive classes
+class_ratio = 1.05
+# Extent of the broadening functions, in widths
+support = 8.
+# Largest number of values of the histograms (bins times weights)
+max_bins = 1 << 22
+# Largest number of (state, energy) pairs of the blocks of sparse_blocks
+max_pairs = 1 << 20
+
+
+def width_classes ( wmin, wmax, floor ):
+  '''
+  Widths of the classes of adaptive widths in [wmin,wmax], log spaced with a ratio
+  of at most class_ratio. Widths below 'floor' are raised to it.
+  '''
+  wmin = max(wmin, floor)
+  wmax = max(wmax, wmin)
+  n = int(np.ceil(np.log(wmax/wmin)/np.log(class_ratio)))
+  return wmin*(wmax/wmin)**(np.arange(n+1)/max(n,1))
+
+
+def class_weights ( widths, classes ):
+  '''
+  Class below each width and the weight u of the class above, such that
+  (1-u)*classes[c]**2 + u*classes[c+1]**2 = width**2
+  '''
+  if classes.size == 1:
+    return np.zeros(widths.shape, dtype=int),np.zeros(widths.shape, dtype=float)
+  w = np.clip(widths, classes[0], classes[-1])
+  c = np.clip(np.searchsorted(classes, w, side='right')-1, 0, classes.size-2)
+  u = (w**2-classes[c]**2)/(classes[c+1]**2-classes[c]**2)
+  return c,u
+
+
+def histogram_chunk ( E, weights, ene, de, width, smearing ):
+  '''
+  sum_i weights_i*f(ene-E_i) for the broadening function f of a single width,
+  on a chunk of the energy grid of spacing de (see broadened_histogram)
+  '''
+  from .smearing import gaussian,metpax
+
+  ne = ene.size
+  m = weights.shape[1]
+
+  # Bins 'sub' times finer than the energies, extended by the support of f
+  sub = max(1, int(np.ceil(bins_per_width*de/width)))
+  h = de/sub
+  pad = int(np.ceil(support*width/h))
+  n = (ne-1)*sub + 1 + 2*pad
+  e0 = ene[0] - pad*h
+
+  # Eigenvalues beyond the support of f do not contribute
+  p = (E-e0)/h
+  keep = (p >= 0.) & (p < n-1)
+  p,weights = p[keep],weights[keep]
+  j = p.astype(int)
+  t = (p-j)[:,None]
+  cols = np.arange(m)
+  hist = np.bincount((j[:,None]*m+cols).ravel(), weights=((1.-t)*weights).ravel(), minlength=n*m)
+  hist += np.bincount(((j+1)[:,None]*m+cols).ravel(), weights=(t*weights).ravel(), minlength=n*m)
+  hist = hist.reshape(n,m)
+
+  # Splitting the eigenvalues between bins adds on average h**2/6 to the variance
+  # of the broadening, taken out of the variance width**2/2 of the kernel
+  kernel = (metpax if smearing == 'm-p' else gaussian)(0., np.arange(-pad,pad+1)*h, np.sqrt(width**2-h**2/3.))
+
+  # Linear convolution, long enough not to wrap around
+  L = 1 << int(np.ceil(np.log2(n+2*pad)))
+  conv = np.fft.irfft(np.fft.rfft(hist, L, axis=0)*np.fft.rfft(kernel, L)[:,None], L, axis=0)
+
+  # Bin i of the convolution is at conv[i+pad], ene[k] is bin pad+k*sub
+  return conv[2*pad+np.arange(ne)*sub]
+
+
+def broadened_histogram ( E, weights, ene, width, smearing ):
+  '''
+  sum_i weights_i*f(ene-E_i) for the broadening function f of a single width. The
+  energy grid is split in chunks whose histograms hold at most max_bins values
+
+  Arguments:
+    E (ndarray): Eigenvalues (n,)
+    weights (ndarray): Weights (n,m)
+    ene (ndarray): Evenly spaced ascending energies (ne,)
+    width (float): Width of the broadening function
+    smearing (str): 'gauss' or 'm-p'
+
+  Returns:
+    sums (ndarray): Broadened sums (ne,m)
+  '''
+  ne = ene.size
+  m = weights.shape[1]
+
+  de = (ene[-1]-ene[0])/(ne-1) if ne > 1 else width
+  sub = max(1, int(np.ceil(bins_per_width*de/width)))
+  pad = int(np.ceil(support*width*sub/de))
+  chunk = max(1, (max_bins//m-2*pad)//sub)
+  if chunk >= ne:
+    return histogram_chunk(E, weights, ene, de, width, smearing)
+
+  # Eigenvalues sorted once, each chunk takes those within the support of f
+  order = np.argsort(E)
+  E,weights = E[order],weights[order]
+  sums = np.empty((ne,m), dtype=float)
+  for s in range(0, ne, chunk):
+    e = min(s+chunk, ne)
+    lo,hi = np.searchsorted(E, [ene[s]-(pad+1)*de/sub, ene[e-1]+(pad+1)*de/sub])
+    sums[s:e] = histogram_chunk(E[lo:hi], weights[lo:hi], ene[s:e], de, width, smearing)
+  return sums
+
+
+def broadened_sum ( E, ene, widths, weights=None, smearing='gauss', classes=None ):
+  '''
+  sum_i weights_i*f(ene-E_i) where f is the Gaussian or Methfessel-Paxton function of width widths_i
+
+  Arguments:
+    E (ndarray): Eigenvalues (n,)
+    ene (ndarray): Evenly spaced ascending energies (ne,)
+    widths (float or ndarray): Width of every eigenvalue, or widths (n,)
+    weights (ndarray): Weights (n,) or (n,m), None for ones
+    smearing (str): 'gauss' or 'm-p'
+    classes (ndarray): Classes of the adaptive widths (see width_classes), the same on every rank and block of eigenvalues
+
+  Returns:
+    sums (ndarray): Broadened sums (ne,) or (ne,m)
+  '''
+  E = np.ravel(E)
+  vector = weights is not None and np.ndim(weights) > 1
+  weights = np.ones((E.size,1)) if weights is None else np.reshape(weights, (E.size,-1))
+
+  if np.ndim(widths) == 0:
+    sums = broadened_histogram(E, weights, ene, float(widths), smearing)
+    return sums if vector else sums[:,0]
+
+  widths = np.ravel(widths)
+  sums = np.zeros((ene.size,weights.shape[1]), dtype=float)
+
+  # Widths below the smallest class, those of the floor of adaptive_classes, are not binned
+  narrow = widths < classes[0]
+  if np.any(narrow):
+    E_n,w_n = E[narrow],weights[narrow]
+    for i,lo,hi,f in sparse_broadening(E_n, ene, widths[narrow], smearing):
+      sums[lo:hi] += np.dot(f.T, w_n[i])
+    E,weights,widths = E[~narrow],weights[~narrow],widths[~narrow]
+
+  c,u = class_weights(widths, classes)
+  for ic in np.unique(np.concatenate((c,c[u>0.]+1))):
+    lower = (c == ic)
+    upper = (c == ic-1) & (u > 0.)
+    w = np.concatenate((weights[lower]*(1.-u[lower,None]), weights[upper]*u[upper,None]))
+    sums += broadened_histogram(np.concatenate((E[lower],E[upper])), w, ene, classes[ic], smearing)
+  return sums if vector else sums[:,0]
+
+
+def adaptive_classes ( comm, widths, ene ):
+  '''
+  Classes of the adaptive widths of every rank (see width_classes), with a floor
+  of a quarter of the energy spacing. broadened_sum evaluates the widths below the
+  floor directly, so the floor bounds the histograms without changing the sums.
+  Must be called by every rank.
+  '''
+  from .mpi import MPI
+
+  wmin = comm.allreduce((float(np.amin(widths)) if widths.size > 0 else np.inf), op=MPI.MIN)
+  wmax = comm.allreduce((float(np.amax(widths)) if widths.size > 0 else 0.), op=MPI.MAX)
+
+  de = (ene[-1]-ene[0])/max(ene.size-1,1)
+  return width_classes(wmin, wmax, .25*de)
+
+
+def sparse_blocks ( E, ene, extent ):
+  '''
+  Blocks of the eigenvalues E sorted by energy, with the range of the ascending
+  energies ene closer than 'extent' to any of them. Each block spans at most
+  max_pairs (state, energy) pairs, unless a single state spans more.
+
+  Arguments:
+    E (ndarray): Eigenvalues (n,)
+    ene (ndarray): Ascending energies (ne,)
+    extent (float or ndarray): Largest distance, for every eigenvalue or for each (n,)
+
+  Returns:
+    i (ndarray): Indices of the eigenvalues of the block
+    lo,hi (int): First and last (excluded) energies of the block
+  '''
+  order = np.argsort(E, kind='stable')
+  Es = E[order]
+  extent = np.broadcast_to(extent, E.shape)[order]
+  lo = np.searchsorted(ene, Es-extent, side='left')
+  hi = np.searchsorted(ene, Es+extent, side='right')
+
+  start = 0
+  while start < E.size:
+    # A block of k states spans at least k*(hi-lo) pairs of its first state
+    stop = min(E.size, start+max(1, max_pairs//max(1,hi[start]-lo[start])))
+    span = np.maximum.accumulate(hi[start:stop]) - np.minimum.accumulate(lo[start:stop])
+    stop = start + max(1, np.searchsorted(span*np.arange(1,stop-start+1) > max_pairs, True))
+    yield order[start:stop],int(lo[start:stop].min()),int(hi[start:stop].max())
+    start = stop
+
+
+def sparse_broadening ( E, ene, widths, smearing ):
+  '''
+  Broadening functions of the eigenvalues E on the energies ene, by blocks of
+  eigenvalues sorted by energy and of the energies within their support (see
+  sparse_blocks): the Gaussian or Methfessel-Paxton function of width 'widths',
+  or for smearing None the thermal broadening -df/dE of the Fermi-Dirac
+  distribution at temperature 'widths'. The latter decays only exponentially,
+  its tails beyond the band edges determine the Seebeck coefficient and the Hall
+  tensors there: it is evaluated on every energy.
+
+  Arguments:
+    E (ndarray): Eigenvalues (n,)
+    ene (ndarray): Ascending energies (ne,)
+    widths (float or ndarray): Width (or temperature) of every eigenvalue, or widths (n,)
+    smearing (str): 'gauss', 'm-p' or None
+
+  Returns:
+    i (ndarray): Indices of the eigenvalues of the block
+    lo,hi (int): First and last (excluded) energies of the block
+    f (ndarray): Broadening functions (i.size,hi-lo), zero beyond the support of each eigenvalue
+  '''
+  from .smearing import gaussian,metpax
+
+  widths = np.broadcast_to(np.asarray(widths, dtype=float), E.shape)
+  extent = (np.inf if smearing is None else support*widths)
+
+  for i,lo,hi in sparse_blocks(E, ene, extent):
+    w = widths[i][:,None]
+    x = E[i][:,None]-ene[lo:hi]
+    if smearing is None:
+      f = 1./(4.*w*np.cosh(x/(2.*w))**2)
+    else:
+      f = (gaussian if smearing == 'gauss' else metpax)(0., x, w)
+      f[np.abs(x) > support*w] = 0.
+    yield i,lo,hi,f
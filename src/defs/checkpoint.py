@@ -0,0 +1,244 @@
+#
+# PAOFLOW
+#
+# Utility to construct and operate on Hamiltonians from the Projections of DFT wfc on Atomic Orbital bases (PAO)
+#
+# Copyright (C) 2016-2018 ERMES group (http://ermes.unt.edu, mbn@unt.edu)
+#
+# Reference:
+# M. Buongiorno Nardelli, F. T. Cerasoli, M. Costa, S Curtarolo,R. De Gennaro, M. Fornari, L. Liyanage, A. Supka and H. Wang,
+# PAOFLOW: A utility to construct and operate on ab initio Hamiltonians from the Projections of electronic wavefunctions on
+# Atomic Orbital bases, including characterization of topological materials, Comp. Mat. Sci. vol. 143, 462 (2018).
+#
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `License'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#
+
+import numpy as np
+from os.path import exists,join
+
+# Version of the checkpoint layout, stored in the manifest
+checkpoint_version = 1
+manifest_file = 'manifest.json'
+# Pickled attributes and non-array data (rank 0 copy)
+objects_file = 'objects.pkl'
+
+# Arrays distributed over k-points with scatter_full (first dimension, unless listed in pool_axes)
+pool_keys = ('Hksp', 'E_k', 'v_k', 'dHksp', 'pksp', 'velkp', 'deltakp', 'd2Ed2k')
+# The band curvature holds its 6 components first (see do_band_curvature)
+pool_axes = {'d2Ed2k':1}
+# Arrays distributed over k-points with load_balancing (third dimension)
+block_keys = ('U', 'Sks')
+# Entries recomputed from the local eigenvalues when loading, rather than stored.
+# The rotations cached by do_momentum are dropped, the stages using them recompute their operators.
+# The index of the Fermi window (do_fermi_window) holds local k-points and is rebuilt from 'fermi_window'
+derived_keys = ('degen', 'degen_rot', 'window_k', 'window_bands')
+
+
+def data_layout ( key, value, inds ):
+  '''
+  Distribution of one entry of the DataController, as seen by the calling rank
+
+  Arguments:
+    key (str): Key of the entry in the arrays dictionary
+    value: The local value
+    inds (ndarray): Indices of k-points owned by this rank if 'value' is distributed with scatter_full (see scatter_full_indices),
+      along the axis pool_axes[key] (0 by default)
+
+  Returns:
+    layout (str): One of 'pool', 'block', 'root' or 'replicated'. write_checkpoint checks that
+    the 'replicated' arrays are equal on every rank
+  '''
+  if value is None:
+    return 'root'
+  if inds is not None and np.shape(value)[pool_axes.get(key,0)] == len(inds):
+    return 'pool'
+  if key in block_keys and isinstance(value, np.ndarray) and value.ndim > 2:
+    return 'block'
+  return 'replicated'
+
+
+def array_digest ( value ):
+  '''
+  Digest of the shape, data type and content of an array, to check that a replicated array is equal on every rank
+  '''
+  from hashlib import sha1
+  from .stage_cache import hash_value
+
+  h = sha1()
+  hash_value(h, value)
+  return h.hexdigest()
+
+
+def write_checkpoint ( data_controller, path ):
+  '''
+  Write the content of the DataController to the directory 'path'.
+  Each array is stored as a single global .npy file, written collectively by
+  every rank into its own rows. A JSON manifest records the shape, data type and
+  distribution of each array, so that the checkpoint can be loaded on any number of ranks.
+  Must be called by every rank.
+
+  Arguments:
+    data_controller (DataController): The DataController being saved
+    path (str): Directory to write the checkpoint into
+
+  Returns:
+    None
+  '''
+  import json
+  from os import makedirs,remove
+  from pickle import dump,HIGHEST_PROTOCOL
+  from .communication import comm,load_balancing,scatter_full_indices
+
+  rank,size = comm.Get_rank(),comm.Get_size()
+  arry,attr = data_controller.data_dicts()
+  npool = attr['npool']
+
+  mfile = join(path, manifest_file)
+  if rank == 0:
+    makedirs(path, exist_ok=True)
+    if exists(mfile):
+      remove(mfile)
+
+  # Every rank must agree on the set of keys, entries missing on some ranks are held by rank 0
+  keys = sorted(set().union(*comm.allgather(list(arry.keys()))))
+
+  manifest = {'version':checkpoint_version, 'mpisize':size, 'npool':npool, 'arrays':{}, 'objects':[], 'derived':[]}
+  objs = {}
+
+  for k in keys:
+    if k in derived_keys:
+      manifest['derived'].append(k)
+      continue
+
+    v = arry.get(k)
+
+    # Number of k-points if the array is distributed with scatter_full (e.g. the full grid or a band path)
+    inds = None
+    if k in pool_keys:
+      nglobal = comm.allreduce(v.shape[pool_axes.get(k,0)] if isinstance(v,np.ndarray) else 0)
+      inds = scatter_full_indices(nglobal, npool)
+
+    layouts = comm.allgather(data_layout(k,v,inds))
+    layout = layouts[0]
+    if any(l != layout for l in layouts):
+      if layout == 'root' or any(l != 'root' for l in layouts[1:]):
+        raise ValueError('Array \'%s\' is not distributed over k-points and cannot be saved.'%k)
+      layout = 'root'
+
+    if comm.bcast(not isinstance(v,np.ndarray) or v.dtype.hasobject):
+      # Python objects, and arrays of them, are pickled from rank 0
+      if rank == 0:
+        objs[k] = v
+      manifest['objects'].append({'key':k, 'layout':layout})
+      continue
+
+    afile = k + '.npy'
+    entry = {'file':afile, 'layout':layout}
+
+    if layout == 'replicated' and len(set(comm.allgather(array_digest(v)))) > 1:
+      raise ValueError('Array \'%s\' differs between ranks but is not distributed over k-points, it cannot be saved.'%k)
+
+    if layout in ('root','replicated'):
+      if rank == 0:
+        np.save(join(path,afile), v)
+        entry.update({'shape':list(v.shape), 'dtype':v.dtype.str})
+      manifest['arrays'][k] = entry
+      continue
+
+    # Distributed arrays are written into a single global array
+    axis = pool_axes.get(k,0) if layout == 'pool' else 2
+    nk = comm.allreduce(v.shape[axis])
+    shape = list(v.shape)
+    shape[axis] = nk
+    entry.update({'shape':shape, 'dtype':v.dtype.str, 'axis':axis})
+    if rank == 0:
+      np.lib.format.open_memmap(join(path,afile), mode='w+', dtype=v.dtype, shape=tuple(shape)).flush()
+    comm.Barrier()
+    if v.shape[axis] > 0:
+      arr = np.load(join(path,afile), mmap_mode='r+')
+      if layout == 'pool':
+        arr[(slice(None),)*axis+(inds,)] = v
+      else:
+        ini_ik,end_ik = load_balancing(size, rank, nk)
+        arr[:,:,ini_ik:end_ik] = v
+      arr.flush()
+      arr = None
+    comm.Barrier()
+    manifest['arrays'][k] = entry
+
+  # The manifest is written last, a partially written checkpoint is never valid
+  if rank == 0:
+    with open(join(path,objects_file), 'wb') as f:
+      dump([attr,objs], f, HIGHEST_PROTOCOL)
+    with open(mfile, 'w') as f:
+      json.dump(manifest, f, indent=1)
+  comm.Barrier()
+
+
+def read_checkpoint ( data_controller, path ):
+  '''
+  Populate the DataController with a checkpoint written by write_checkpoint.
+  The global arrays are memory mapped and each rank copies the k-points it owns
+  under the current number of ranks, which may differ from that of the run which wrote it.
+  Must be called by every rank.
+
+  Arguments:
+    data_controller (DataController): The DataController to populate
+    path (str): Directory containing the checkpoint
+
+  Returns:
+    None
+  '''
+  import json
+  from pickle import load
+  from .communication import comm,load_balancing,scatter_full_indices
+
+  rank,size = comm.Get_rank(),comm.Get_size()
+
+  mfile = join(path, manifest_file)
+  if not exists(mfile):
+    raise OSError('Checkpoint manifest %s not found.'%mfile)
+
+  with open(mfile, 'r') as f:
+    manifest = json.load(f)
+  with open(join(path,objects_file), 'rb') as f:
+    attr,objs = load(f)
+
+  if manifest['version'] > checkpoint_version:
+    raise ValueError('Checkpoint version %d is not supported.'%manifest['version'])
+
+  attr['mpisize'] = size
+  npool = attr['npool']
+
+  arry = {}
+  for o in manifest['objects']:
+    k,layout = o['key'],o['layout']
+    arry[k] = objs[k] if layout != 'root' or rank == 0 else None
+
+  for k,entry in manifest['arrays'].items():
+    layout = entry['layout']
+    if layout == 'root' and rank != 0:
+      arry[k] = None
+      continue
+    arr = np.load(join(path,entry['file']), mmap_mode='r')
+    if layout == 'pool':
+      axis = entry.get('axis', 0)
+      arr = arr[(slice(None),)*axis+(scatter_full_indices(arr.shape[axis], npool),)]
+    elif layout == 'block':
+      ini_ik,end_ik = load_balancing(size, rank, arr.shape[2])
+      arr = arr[:,:,ini_ik:end_ik]
+    arry[k] = np.array(arr)
+
+  if 'degen' in manifest['derived']:
+    from .do_eigh import get_degeneracies
+    arry['degen'] = get_degeneracies(arry['E_k'], attr['bnd'])
+
+  if 'window_k' in manifest['derived']:
+    from .do_fermi_window import window_index
+    arry['window_k'],arry['window_bands'] = window_index(arry['E_k'], *attr['fermi_window'])
+
+  data_controller.data_arrays = arry
+  data_controller.data_attributes = attr
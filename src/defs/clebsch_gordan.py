@@ -23,7 +23,7 @@ def spinor ( l, j, m, spin ):
   # the up (spin=0) or down (spin=1) coefficient.
 
   import numpy as np
-  from mpi4py import MPI
+  from .mpi import MPI
 
   rank = MPI.COMM_WORLD.Get_rank()
 
@@ -0,0 +1,224 @@
+#
+# PAOFLOW
+#
+# Utility to construct and operate on Hamiltonians from the Projections of DFT wfc on Atomic Orbital bases (PAO)
+#
+# Copyright (C) 2016-2018 ERMES group (http://ermes.unt.edu, mbn@unt.edu)
+#
+# Reference:
+# M. Buongiorno Nardelli, F. T. Cerasoli, M. Costa, S Curtarolo,R. De Gennaro, M. Fornari, L. Liyanage, A. Supka and H. Wang,
+# PAOFLOW: A utility to construct and operate on ab initio Hamiltonians from the Projections of electronic wavefunctions on
+# Atomic Orbital bases, including characterization of topological materials, Comp. Mat. Sci. vol. 143, 462 (2018).
+#
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `License'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#
+
+import sys
+import numpy as np
+from .mpi import MPI
+from time import perf_counter
+from . import profiler
+
+# The CommStats of the current run, None when the accounting is disabled
+active = None
+
+# Index of the argument holding the message of this rank in the buffer based
+# operations: the buffer it sends, or the one it receives for Scatter and Allgather
+buffer_methods = {'Bcast':0, 'Reduce':0, 'Allreduce':0, 'Scatter':1, 'Scatterv':1,
+                  'Gather':0, 'Gatherv':0, 'Allgather':1, 'Allgatherv':1, 'Alltoall':0,
+                  'Alltoallv':0, 'Send':0, 'Recv':0, 'Sendrecv':0, 'Barrier':None}
+
+# Pickle based operations, True when the message is the returned object
+object_methods = {'bcast':True, 'reduce':False, 'allreduce':False, 'scatter':True,
+                  'gather':False, 'allgather':True, 'send':False, 'recv':True, 'barrier':None}
+
+
+def buffer_bytes ( buf ):
+  '''
+  Size in bytes of a buffer specification (array, or [array, counts, displacements, type])
+  '''
+  if isinstance(buf, (list,tuple)):
+    buf = buf[0] if len(buf) > 0 else None
+  return buf.nbytes if isinstance(buf, np.ndarray) else 0
+
+
+def object_bytes ( obj ):
+  '''
+  Size in bytes of an object sent by the pickle based operations
+  '''
+  import pickle
+
+  if obj is None:
+    return 0
+  if isinstance(obj, np.ndarray):
+    return obj.nbytes
+  return len(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+
+def call_site ( ):
+  '''
+  Name of the PAOFLOW function issuing the current MPI call. Calls made
+  from the redistribution routines of communication.py are labeled
+  'caller>routine' with the outermost routine (e.g. 'do_double_grid>gather_scatter').
+  '''
+  frame = sys._getframe(2)
+  routine = None
+  while frame is not None:
+    module = frame.f_globals.get('__name__', '')
+    if module.endswith('.communication'):
+      routine = frame.f_code.co_name
+    elif not module.endswith(('.comm_stats','.profiler')):
+      break
+    frame = frame.f_back
+  caller = '<none>' if frame is None else getattr(frame.f_code, 'co_qualname', frame.f_code.co_name)
+  return caller if routine is None else '%s>%s'%(caller,routine)
+
+
+def counted ( name ):
+  '''
+  Wrap the MPI.Intracomm method 'name' so that each call is recorded by the active
+  CommStats and its bytes added to the active Profiler
+  '''
+  method = getattr(MPI.Intracomm, name)
+
+  def call ( self, *args, **kwargs ):
+    if active is None and profiler.active is None:
+      return method(self, *args, **kwargs)
+
+    t = perf_counter()
+    result = method(self, *args, **kwargs)
+    dt = perf_counter() - t
+
+    if name in buffer_methods:
+      iarg = buffer_methods[name]
+      nbytes = 0 if iarg is None or len(args) <= iarg else buffer_bytes(args[iarg])
+      if name in ['Reduce','Allreduce'] and len(args) > 1 and args[0] is MPI.IN_PLACE:
+        nbytes = buffer_bytes(args[1])
+    else:
+      returned = object_methods[name]
+      nbytes = 0 if returned is None else object_bytes(result if returned else (args[0] if len(args) > 0 else None))
+
+    profiler.count_bytes(nbytes)
+    if active is not None:
+      active.record(name, call_site(), nbytes, dt)
+    return result
+
+  call.__name__ = name
+  call.__doc__ = method.__doc__
+  return call
+
+
+class CountingComm ( MPI.Intracomm ):
+  '''
+  Communicator sharing the group and context of the one it is built from, whose
+  collective and point to point operations are accounted for by the active CommStats
+  (calls, bytes and time per operation and per stage). The accounting costs a single
+  test per call when neither the CommStats nor the Profiler is active.
+  '''
+  pass
+
+for name in list(buffer_methods)+list(object_methods):
+  setattr(CountingComm, name, counted(name))
+
+
+class CommStats:
+  '''
+  Records, on every rank, the number of calls, the bytes and the time of each
+  MPI operation, per PAOFLOW stage (the interval between two calls to
+  report_module_time) and per calling function.
+  '''
+
+  def __init__ ( self, comm ):
+    self.comm = comm
+    self.rank = comm.Get_rank()
+    self.stages = []
+    self.current = {}
+
+
+  def record ( self, op, site, nbytes, dt ):
+    entry = self.current.setdefault((op,site), [0,0,0.])
+    entry[0] += 1
+    entry[1] += nbytes
+    entry[2] += dt
+
+
+  def stage ( self, name ):
+    '''
+    Close the current stage, called by report_module_time
+
+    Arguments:
+      name (str): Name of the stage
+    '''
+    self.stages.append((name, self.current))
+    self.current = {}
+
+
+  def write ( self, opath, fname='paoflow_comm.json' ):
+    '''
+    Gather the records of every rank, print from rank 0 the totals of each stage
+    and operation, and write the detailed records (per stage, operation and
+    calling function) to a JSON file. Must be called by every rank.
+
+    Arguments:
+      opath (str): Output directory
+      fname (str): Name of the JSON file
+
+    Returns:
+      None
+    '''
+    global active
+    import json
+    from os.path import join
+
+    # The gathers of the report are not accounted for
+    if active is self:
+      active = None
+
+    stages = self.comm.gather(self.stages)
+    if self.rank != 0:
+      return
+
+    nranks = len(stages)
+    summary = {'nranks':nranks, 'stages':[]}
+    totals = {}
+    # Every rank closes the same sequence of stages
+    for i,(name,_) in enumerate(stages[0]):
+      rs = [r[i][1] for r in stages]
+      records = []
+      for op,site in sorted(set().union(*rs)):
+        v = [r.get((op,site), [0,0,0.]) for r in rs]
+        records.append({'op':op, 'site':site,
+                        'calls':[c[0] for c in v], 'bytes':[c[1] for c in v], 'time':[c[2] for c in v]})
+        t = totals.setdefault(op, [0,0,0.])
+        t[0] += max(c[0] for c in v)
+        t[1] += sum(c[1] for c in v)
+        t[2] += max(c[2] for c in v)
+      summary['stages'].append({'name':name, 'records':records})
+
+    with open(join(opath,fname), 'w') as f:
+      json.dump(summary, f, indent=1)
+
+    def mbytes ( n ):
+      return n/1024.**2
+
+    # Calls are counted on the busiest rank, bytes summed over ranks and times taken on the slowest rank
+    print('\nCommunication on %d rank%s (calls, MBytes summed over ranks, seconds on the slowest rank)'%(nranks,('' if nranks==1 else 's')))
+    for s in summary['stages']:
+      if len(s['records']) == 0:
+        continue
+      ops = {}
+      for r in s['records']:
+        o = ops.setdefault(r['op'], [0,0,0.])
+        o[0] += max(r['calls'])
+        o[1] += sum(r['bytes'])
+        o[2] += max(r['time'])
+      print('  %s'%s['name'])
+      for op,(c,b,t) in sorted(ops.items(), key=lambda o : -o[1][1]):
+        print('    %-12s %8d %12.3f %10.3f'%(op,c,mbytes(b),t))
+    print('  Total')
+    for op,(c,b,t) in sorted(totals.items(), key=lambda o : -o[1][1]):
+      print('    %-12s %8d %12.3f %10.3f'%(op,c,mbytes(b),t))
+    print('Communication records written to %s'%join(opath,fname), flush=True)
@@ -18,9 +18,13 @@
 
 import numpy as np
 import time
-from mpi4py import MPI
+from .mpi import MPI
+from .profiler import kernel
+from .comm_stats import CountingComm
 
-comm = MPI.COMM_WORLD
+# Every PAOFLOW module communicates through 'comm', which accounts for the
+# MPI operations when the communication statistics or the profiler are enabled
+comm = CountingComm(MPI.COMM_WORLD)
 rank = comm.Get_rank()
 size = comm.Get_size()
 
@@ -110,6 +114,24 @@ def gather_array ( arr, arraux, sroot=0 ):
     comm.Gatherv([arraux, mpidtype], [arr, lsizes[:,0], lsizes[:,1], mpidtype], root=sroot)
 
 
+# Gathers first dimension of an array distributed with load_balancing onto every process
+def allgather_array ( arr ):
+
+    # Total length of the distributed dimension
+    nsize = comm.allreduce(arr.shape[0])
+
+    lsizes = load_sizes(size, nsize, int(np.prod(arr.shape[1:])))
+    full = np.empty((nsize,)+arr.shape[1:], dtype=arr.dtype)
+
+    # Get the datatype for the MPI transfer
+    mpidtype = MPI._typedict[np.dtype(arr.dtype).char]
+
+    comm.Allgatherv([np.ascontiguousarray(arr), mpidtype], [full, lsizes[:,0], lsizes[:,1], mpidtype])
+
+    return full
+
+
+@kernel('scatter')
 def scatter_full(arr,npool,sroot=0):
 
     if rank==sroot:
@@ -159,6 +181,27 @@ def scatter_full(arr,npool,sroot=0):
     return temp
 
 
+# Global indices of the first dimension held by 'rank' after scatter_full
+def scatter_full_indices(nsize,npool,size=size,rank=rank):
+
+    nchunks = nsize//size
+
+    inds = []
+    chunk_e = 0
+    if nchunks!=0:
+        for pool in range(npool):
+            chunk_s,chunk_e = load_balancing(npool,pool,nchunks)
+            start,stop = load_balancing(size,rank,(chunk_e-chunk_s)*size)
+            inds.append(chunk_s*size+np.arange(start,stop))
+
+    if nsize%size!=0:
+        start,stop = load_balancing(size,rank,nsize-chunk_e*size)
+        inds.append(chunk_e*size+np.arange(start,stop))
+
+    return np.concatenate(inds).astype(int) if len(inds)>0 else np.empty((0,),dtype=int)
+
+
+@kernel('gather')
 def gather_full(arr,npool,sroot=0):
 
     first_ind_per_proc = np.array([arr.shape[0]])
@@ -200,6 +243,7 @@ def gather_full(arr,npool,sroot=0):
         return temp
 
 
+@kernel('transpose')
 def gather_scatter(arr,scatter_axis,npool):
     #scatter indices for scatter_axis to each proc
     axis_ind = np.array(list(range(arr.shape[scatter_axis])),dtype=int)
@@ -271,3 +315,68 @@ def gen_window(array,root=0):
     comm.Barrier()
     
     return win_array
+
+
+# Exchange of the rows of an array distributed over k-points (first dimension, as
+# scatter_full) that a rank reads but does not hold, e.g. the neighbors of its
+# k-points across the boundaries of its slab of the grid
+class Halo:
+
+    def __init__ ( self, inds, halo ):
+        '''
+        Arguments:
+            inds (ndarray): Ascending global indices of the rows held by this rank
+            halo (ndarray): Ascending global indices of the rows read by this rank, held by others
+        '''
+        # Contiguous ranges of the rows held by each rank
+        breaks = np.flatnonzero(np.diff(inds) != 1) + 1
+        ranges = [(s[0],s[-1]+1) for s in np.split(inds, breaks) if s.size > 0]
+        layout = comm.allgather((ranges,halo))
+
+        def held ( ind, ranges ):
+            mask = np.zeros(ind.size, dtype=bool)
+            for s,e in ranges:
+                mask |= (ind >= s) & (ind < e)
+            return mask
+
+        self.halo = halo
+        # Local rows sent to each rank, and rows of the halo received from each rank
+        self.send = [np.searchsorted(inds, h[held(h,ranges)]) for _,h in layout]
+        self.recv = [np.flatnonzero(held(halo,r)) for r,_ in layout]
+
+
+    def alltoallv ( self, sbuf, srows, rbuf, rrows ):
+        row = int(np.prod(sbuf.shape[1:]))
+        scounts = np.array([s.size*row for s in srows], dtype=int)
+        rcounts = np.array([r.size*row for r in rrows], dtype=int)
+        mpidtype = MPI._typedict[np.dtype(sbuf.dtype).char]
+        comm.Alltoallv([sbuf, scounts, np.cumsum(scounts)-scounts, mpidtype],
+                       [rbuf, rcounts, np.cumsum(rcounts)-rcounts, mpidtype])
+
+
+    def exchange ( self, arr ):
+        '''
+        Rows of the halo of the array 'arr' (nk,...) distributed over the ranks
+
+        Returns:
+            values (ndarray): Rows (nhalo,...), in the order of the halo
+        '''
+        sbuf = np.ascontiguousarray(arr[np.concatenate(self.send)])
+        rbuf = np.empty((self.halo.size,)+arr.shape[1:], dtype=arr.dtype)
+        self.alltoallv(sbuf, self.send, rbuf, self.recv)
+
+        values = np.empty_like(rbuf)
+        values[np.concatenate(self.recv)] = rbuf
+        return values
+
+
+    def reduce ( self, arr, values ):
+        '''
+        Add the contributions 'values' (nhalo,...) of this rank to the rows of its halo
+        to the array 'arr' (nk,...) of the ranks holding them, in place
+        '''
+        sbuf = np.ascontiguousarray(values[np.concatenate(self.recv)])
+        rbuf = np.empty((sum(s.size for s in self.send),)+arr.shape[1:], dtype=arr.dtype)
+        self.alltoallv(sbuf, self.recv, rbuf, self.send)
+
+        np.add.at(arr, np.concatenate(self.send), rbuf)
@@ -17,10 +17,10 @@
 #
 
 import numpy as np
-from scipy import signal
-from mpi4py import MPI
+from .mpi import MPI
+from .profiler import region
 
-comm = MPI.COMM_WORLD
+from .communication import comm
 rank = comm.Get_rank()
 
 def do_Boltz_tensors ( data_controller, smearing, temp, ene, velkp, ispin, channels, weights):
@@ -42,7 +42,8 @@ def do_Boltz_tensors ( data_controller, smearing, temp, ene, velkp, ispin, chann
 
   L0 = zoz(rank)
   L0aux = fLloop(0)
-  comm.Reduce(L0aux, L0, op=MPI.SUM)
+  with region('reduction'):
+    comm.Reduce(L0aux, L0, op=MPI.SUM)
   L0aux = None
 
   if rank == 0:
@@ -50,14 +51,20 @@ def do_Boltz_tensors ( data_controller, smearing, temp, ene, velkp, ispin, chann
     sym = lambda L : (L[0,1], L[0,2], L[1,2])
     L0[1,0],L0[2,0],L0[2,1] = sym(L0)
 
+  # The tetrahedron method gives the conductivity only, its T=0 transport distribution
+  if smearing == 'tetrahedra':
+    return (L0, None, None) if rank==0 else (None, None, None)
+
   L1 = zoz(rank)
   L1aux = fLloop(1)
-  comm.Reduce(L1aux, L1, op=MPI.SUM)
+  with region('reduction'):
+    comm.Reduce(L1aux, L1, op=MPI.SUM)
   L1aux = None
 
   L2 = zoz(rank)
   L2aux = fLloop(2)
-  comm.Reduce(L2aux, L2, op=MPI.SUM)
+  with region('reduction'):
+    comm.Reduce(L2aux, L2, op=MPI.SUM)
   L2aux = None
 
   if rank == 0:
@@ -84,7 +91,8 @@ def do_Boltz_tensors_hall ( data_controller, smearing, temp, ene, velkp, ispin,
 
   L0_hall = zoz(rank)
   L0_hall_aux = L_loop_hall(data_controller, temp, smearing, ene, velkp, t_tensor, 0, ispin)
-  comm.Reduce(L0_hall_aux, L0_hall, op=MPI.SUM)
+  with region('reduction'):
+    comm.Reduce(L0_hall_aux, L0_hall, op=MPI.SUM)
   L0_hall_aux = None
   
   return L0_hall if rank==0 else None
@@ -146,39 +154,41 @@ def get_tau ( data_controller, temp, channels, weights ):
 
 
 def L_loop ( data_controller, temp, smearing, ene, velkp, t_tensor, alpha, ispin ):
-  from .smearing import gaussian,metpax
+  from .broadening import sparse_broadening
+  from .do_fermi_window import window_kpoints
   # We assume tau=1 in the constant relaxation time approximation
 
   arrays,attributes = data_controller.data_dicts()
 
   esize = ene.size
 
-  snktot = arrays['E_k'].shape[0]
-
   bnd = attributes['bnd']
   kq_wght = 1./attributes['nkpnts']
-  if smearing is not None and smearing != 'gauss' and smearing != 'm-p':
+  if smearing is not None and smearing not in ('gauss', 'm-p', 'tetrahedra'):
     print('%s Smearing Not Implemented.'%smearing)
     comm.Abort()
 
   L = np.zeros((3,3,esize), dtype=float)
 
+  if smearing == 'tetrahedra':
+    # The delta weights of the tetrahedron method replace the smearing and kq_wght, every k-point contributes
+    from .tetrahedra import tetrahedron_integral
+    tau = arrays['scattering_tau'][:,:,ispin]
+    tv = np.array([tau*velkp[:,i,:bnd,ispin]*velkp[:,j,:bnd,ispin] for i,j in t_tensor])
+    L[t_tensor[:,0],t_tensor[:,1]] = tetrahedron_integral(data_controller, tv, ene, ispin, alpha)
+    return L
+
   for n in range(bnd):
-    Eaux = np.reshape(np.repeat(arrays['E_k'][:,n,ispin],esize), (snktot,esize))
-    delk = (np.reshape(np.repeat(arrays['deltakp'][:,n,ispin],esize), (snktot,esize)) if smearing!=None else None)
-    EtoAlpha = np.power(Eaux[:,:]-ene, alpha)
-    if smearing is None:
-      Eaux -= ene
-      smearA = 1/(4*temp*(np.cosh(Eaux/(2*temp))**2))
-    else:
-      if smearing == 'gauss':
-        smearA = gaussian(Eaux, ene, delk)
-      elif smearing == 'm-p':
-        smearA = metpax(Eaux, ene, delk)
-    for l in range(t_tensor.shape[0]):
-      i = t_tensor[l][0]
-      j = t_tensor[l][1]
-      L[i,j,:] += np.sum(kq_wght*arrays['scattering_tau'][:,n,ispin]*velkp[:,i,n,ispin]*velkp[:,j,n,ispin]*(smearA*EtoAlpha).T, axis=1)
+    # Only the k-points of the Fermi window contribute (see do_fermi_window)
+    k = window_kpoints(arrays, n)
+    E = arrays['E_k'][k,n,ispin]
+    widths = (arrays['deltakp'][k,n,ispin] if smearing!=None else temp)
+    tv = np.array([kq_wght*arrays['scattering_tau'][k,n,ispin]*velkp[k,i,n,ispin]*velkp[k,j,n,ispin] for i,j in t_tensor])
+
+    # Only the energies within the support of the broadening of each state contribute
+    for ik,lo,hi,smearA in sparse_broadening(E, ene, widths, smearing):
+      smearA *= np.power(E[ik][:,None]-ene[lo:hi], alpha)
+      L[t_tensor[:,0],t_tensor[:,1],lo:hi] += tv[:,ik] @ smearA
   '''
   # noise reduction using a running average (correlation function)
   # Only possible for sigma vs chemical potential
@@ -191,11 +201,13 @@ def L_loop ( data_controller, temp, smearing, ene, velkp, t_tensor, alpha, ispin
   '''
   return L
 
+# Non-zero terms (q, r, epsilon_pqr) of the Levi-Civita symbol, for each p
+levi_civita = [[((p+1)%3,(p+2)%3,1),((p+2)%3,(p+1)%3,-1)] for p in range(3)]
+
 def L_loop_hall ( data_controller, temp, smearing, ene, velkp, t_tensor, alpha, ispin ):
   from scipy.constants import hbar
-  from sympy import Eijk
-  from .smearing import gaussian,metpax
-  from os.path import join
+  from .broadening import sparse_broadening
+  from .do_fermi_window import window_kpoints
 
   arrays,attributes = data_controller.data_dicts()
 
@@ -207,12 +219,11 @@ def L_loop_hall ( data_controller, temp, smearing, ene, velkp, t_tensor, alpha,
   bnd = attributes['bnd']
   nspin = attributes['nspin']
   kq_wght = 1./attributes['nkpnts']
-  if smearing is not None and smearing != 'gauss' and smearing != 'm-p':
+  if smearing is not None and smearing not in ('gauss', 'm-p', 'tetrahedra'):
     print('%s Smearing Not Implemented.'%smearing)
     comm.Abort()
 
   L_hall = np.zeros((3,3,3,esize), dtype=float)
-  sig_hall = np.zeros((3,3,3,snktot,bnd,nspin))
 
   M_inv = np.zeros((3,3,snktot,bnd,nspin))
   eff_mass_inv = arrays['d2Ed2k']
@@ -231,22 +242,35 @@ def L_loop_hall ( data_controller, temp, smearing, ene, velkp, t_tensor, alpha,
       M_inv[i,j]=eff_mass_inv[5]
       M_inv[j,i]=eff_mass_inv[5]
 
+  if smearing == 'tetrahedra':
+    # The delta weights of the tetrahedron method replace the smearing and kq_wght, every k-point contributes
+    from .tetrahedra import tetrahedron_integral
+    sig = np.zeros((3,3,3,snktot,bnd), dtype=float)
+    for i in range(3):
+      for j in range(3):
+        for p in range(3):
+          for q,r,e in levi_civita[p]:
+            sig[i,j,p] += e*velkp[:,i,:bnd,ispin]*velkp[:,r,:bnd,ispin]*M_inv[j,q,:,:,ispin]
+    sig *= arrays['scattering_tau'][:,:,ispin]**2
+    L_hall[...] = tetrahedron_integral(data_controller, sig, ene, ispin)
+    return L_hall
+
   for n in range(bnd):
-    Eaux = np.reshape(np.repeat(arrays['E_k'][:,n,ispin],esize), (snktot,esize))
-    delk = (np.reshape(np.repeat(arrays['deltakp'][:,n,ispin],esize), (snktot,esize)) if smearing!=None else None)
-    if smearing is None:
-      Eaux -= ene
-      smearA = 1/(4*temp*(np.cosh(Eaux/(2*temp))**2))
-    else:
-      if smearing == 'gauss':
-        smearA = gaussian(Eaux, ene, delk)
-      elif smearing == 'm-p':
-        smearA = metpax(Eaux, ene, delk)
+    # Only the k-points of the Fermi window contribute (see do_fermi_window)
+    k = window_kpoints(arrays, n)
+    E = arrays['E_k'][k,n,ispin]
+    widths = (arrays['deltakp'][k,n,ispin] if smearing!=None else temp)
+    v,M = velkp[k,:,n,ispin],M_inv[:,:,k,n,ispin]
+    sig_hall = np.zeros((3,3,3,E.size), dtype=float)
     for i in range(3):
       for j in range(3):
         for p in range(3):
-          for q in range(3):
-            for r  in range(3):
-              sig_hall[i,j,p,:,n,ispin] += (int(Eijk(p,q,r))*velkp[:,i,n,ispin]*velkp[:,r,n,ispin]*M_inv[j,q,:,n,ispin])
-          L_hall[i,j,p,:] += np.sum(kq_wght*arrays['scattering_tau'][:,n,ispin]**2*sig_hall[i,j,p,:,n,ispin]*(smearA).T, axis=1)
+          # Only the non-zero terms of the Levi-Civita symbol contribute
+          for q,r,e in levi_civita[p]:
+            sig_hall[i,j,p] += e*v[:,i]*v[:,r]*M[j,q]
+    sig = kq_wght*arrays['scattering_tau'][k,n,ispin]**2*sig_hall
+
+    # Only the energies within the support of the broadening of each state contribute
+    for ik,lo,hi,smearA in sparse_broadening(E, ene, widths, smearing):
+      L_hall[:,:,:,lo:hi] += sig[:,:,:,ik] @ smearA
   return L_hall
@@ -17,88 +17,154 @@
 #
 
 import numpy as np
-from mpi4py import MPI
-from .smearing import intmetpax
+from .mpi import MPI
+from .smearing import intmetpax,metpax
 
-comm = MPI.COMM_WORLD
+from .communication import comm
 rank = comm.Get_rank()
 
-def E_Fermi ( Hksp, data_controller, parallel=False ):
-  # Calculate the Fermi energy using a braketing algorithm
-
-  arry,attr = data_controller.data_dicts()
-
-  insulator = attr['insulator']
-  nktot,nbnd = attr['nkpnts'],attr['bnd']
-  nelec,dftSO = attr['nelec'],attr['dftSO']
-  nawf,_,snktot,nspin = Hksp.shape
-  eig = np.zeros((nawf,snktot,nspin))
-  Hksp = Hksp.reshape((nawf,nawf,snktot,nspin), order='C')
-
-  for ispin in range(nspin):
-    for ik in range(snktot):
-      eig[:,ik,ispin] = np.linalg.eigvalsh(Hksp[:,:,ik,ispin])
-
-  if insulator:
-    Efr = np.amax(eig[(nelec-1 if dftSO else nelec//2-1)])
-    if parallel:
-      Efm = np.zeros((1), dtype=float) if rank==0 else None
-      comm.Reduce(Efr, Efm, op=MPI.MAX)
-      return comm.bcast(Efm[0] if rank==0 else None)
-    else:
-      return Efr
-
-  else:
-    Elw = 1.0e+8
-    Eup = -1.0e+8
-    eps = 1.0e-10
-    degauss = 0.01
-
-    for ispin in range(nspin):
-      for kp in range(snktot):
-        Elw = min(Elw,eig[0,kp,ispin])
-        Eup = max(Elw,eig[nbnd,kp,ispin])
-
-    Eup = Eup + 2 * degauss
-    Elw = Elw - 2 * degauss
-
-    # bisection method
-    fac = 1 if dftSO else 2
-    sumkup_aux = fac*np.sum(intmetpax(eig[:nbnd,:,:],Eup,degauss))
-    sumklw_aux = fac*np.sum(intmetpax(eig[:nbnd,:,:],Elw,degauss))
 
+class Occupations:
+  '''
+  Number of electrons N(E) of a set of eigenvalues with Methfessel-Paxton
+  smearing, as a function of the Fermi energy E. The eigenvalues are sorted
+  once: the states below (above) the support of the smearing around E are
+  counted as filled (empty) by bisection, only those within it are evaluated.
+  In parallel the eigenvalues are those of every rank, each evaluation of N(E)
+  is a single Allreduce.
+  '''
+
+  def __init__ ( self, eig, nktot, fac, degauss=0.01, parallel=True ):
+    '''
+    Arguments:
+      eig (ndarray): Eigenvalues of this rank, any shape
+      nktot (int): Total number of k-points
+      fac (int): Occupation of each state (2 without spin-orbit)
+      degauss (float): Width of the smearing
+      parallel (bool): If True the eigenvalues are distributed across the ranks
+
+    Returns:
+      None
+    '''
+    from .broadening import support
+
+    self.eig = np.sort(np.ravel(eig))
+    self.scale = float(fac)/nktot
+    self.degauss = degauss
+    self.window = support*degauss
+    self.parallel = parallel
+
+    # Range of the eigenvalues of every rank
+    bounds = np.array(([-self.eig[0],self.eig[-1]] if self.eig.size > 0 else [-np.inf,-np.inf]), dtype=float)
     if parallel:
-      sumkup = np.zeros((1), dtype=float) if rank==0 else None
-      sumklw = np.zeros((1), dtype=float) if rank==0 else None
-      comm.Reduce(sumkup_aux, sumkup, op=MPI.SUM)
-      comm.Reduce(sumklw_aux, sumklw, op=MPI.SUM)
-      sumkup = comm.bcast(sumkup[0]/nktot if rank==0 else None)
-      sumklw = comm.bcast(sumklw[0]/nktot if rank==0 else None)
-    else:
-      sumkup = sumkup_aux/nktot
-      sumklw = sumklw_aux/nktot
-
-    if (sumkup - nelec) < -eps or (sumklw - nelec) > eps:
+      comm.Allreduce(MPI.IN_PLACE, bounds, op=MPI.MAX)
+    self.emin,self.emax = -bounds[0],bounds[1]
+    self.nstates = self.scale*(comm.allreduce(self.eig.size) if parallel else self.eig.size)
+
+
+  def count ( self, E ):
+    '''
+    Number of electrons N(E) and its derivative (the density of states) at Fermi energy E
+    '''
+    lo,hi = np.searchsorted(self.eig, [E-self.window,E+self.window])
+    window = self.eig[lo:hi]
+    local = np.array([lo+np.sum(intmetpax(window,E,self.degauss)), np.sum(metpax(window,E,self.degauss))])
+    if self.parallel:
+      comm.Allreduce(MPI.IN_PLACE, local, op=MPI.SUM)
+    return self.scale*local[0],self.scale*local[1]
+
+
+  def fermi_energy ( self, nelec, eps=1.e-10, maxiter=100 ):
+    '''
+    Fermi energy of nelec electrons, by Newton steps on N(E) safeguarded by bisection
+
+    Arguments:
+      nelec (float): Number of electrons
+      eps (float): Tolerance on the number of electrons
+      maxiter (int): Maximum number of evaluations of N(E)
+
+    Returns:
+      Ef (float): Fermi energy
+    '''
+    Elw = self.emin - self.window
+    Eup = self.emax + self.window
+
+    if nelec > self.nstates+eps:
       if rank == 0:
         print('Error: cannot bracket Ef')
 
-    maxiter = 100
+    Ef = (Eup+Elw)/2
+    dE = dEold = Eup-Elw
     for i in range(maxiter):
-
-      Ef = (Eup + Elw)/2
-      sumkmid_aux = fac*np.sum(intmetpax(eig[:,:,:],Ef,degauss))
-      if parallel:
-        sumkmid = np.zeros((1,), dtype=float) if rank==0 else None
-        comm.Reduce(sumkmid_aux, sumkmid, op=MPI.SUM)
-        sumkmid = comm.bcast(sumkmid[0]/nktot if rank==0 else None)
-      else:
-        sumkmid = sumkmid_aux/nktot
-
-      if np.abs( sumkmid-nelec ) < eps:
+      N,dos = self.count(Ef)
+      f = N-nelec
+      if np.abs(f) < eps:
         break
-      elif sumkmid-nelec < -eps:
+      if f < 0.:
         Elw = Ef
       else:
         Eup = Ef
 
+      # Newton steps which stay in the bracket and shrink fast enough, else bisection
+      if dos > 0. and Elw < Ef-f/dos < Eup and np.abs(2.*f) < np.abs(dEold*dos):
+        dEold,dE = dE,f/dos
+        Ef -= dE
+      else:
+        dEold = dE
+        dE = (Eup-Elw)/2
+        Ef = Elw+dE
+      if Eup-Elw < 4.*np.finfo(float).eps*max(1.,np.abs(Ef)):
+        break
+
     return Ef
+
+
+def fermi_level ( data_controller, eig=None, nelec=None, parallel=True, degauss=0.01 ):
+  '''
+  Fermi energy of the eigenvalues of the k-points of this rank (of every rank in parallel)
+
+  Arguments:
+    data_controller (DataController): The DataController
+    eig (ndarray): Eigenvalues (snktot,nbnd,nspin), default E_k
+    nelec (float): Number of electrons, default that of the DFT calculation (e.g. to dope)
+    parallel (bool): If True the k-points are distributed across the ranks
+    degauss (float): Width of the Methfessel-Paxton smearing of metals
+
+  Returns:
+    Ef (float): Fermi energy
+  '''
+  arry,attr = data_controller.data_dicts()
+
+  eig = arry['E_k'] if eig is None else eig
+  nelec = attr['nelec'] if nelec is None else nelec
+  dftSO = attr['dftSO']
+
+  if attr['insulator']:
+    vb = eig[:,int(round(nelec))-1 if dftSO else int(round(nelec))//2-1]
+    Efr = np.amax(vb) if vb.size > 0 else -np.inf
+    return comm.allreduce(Efr, op=MPI.MAX) if parallel else Efr
+
+  occupations = Occupations(eig, attr['nkpnts'], (1 if dftSO else 2), degauss, parallel)
+  return occupations.fermi_energy(nelec)
+
+
+def E_Fermi ( Hksp, data_controller, parallel=False ):
+  '''
+  Fermi energy of the Hamiltonians Hksp (nawf,nawf,snktot,nspin), diagonalized by blocks of k-points
+
+  Arguments:
+    Hksp (ndarray): Hamiltonians of the k-points of this rank (of every rank in parallel)
+    data_controller (DataController): The DataController
+    parallel (bool): If True the k-points are distributed across the ranks
+
+  Returns:
+    Ef (float): Fermi energy
+  '''
+  nawf,_,snktot,nspin = Hksp.shape
+  Hksp = Hksp.reshape((nawf,nawf,snktot,nspin), order='C')
+
+  eig = np.empty((snktot,nawf,nspin), dtype=float)
+  for ks,ke in data_controller.k_chunks(snktot, nawf**2*nspin*Hksp.itemsize):
+    eig[ks:ke] = np.swapaxes(np.linalg.eigvalsh(np.moveaxis(Hksp[:,:,ks:ke],(0,1),(2,3))), 1, 2)
+
+  return fermi_level(data_controller, eig, parallel=parallel)
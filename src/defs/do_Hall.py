@@ -18,13 +18,72 @@
 
 
 import numpy as np
-from mpi4py import MPI
+from .mpi import MPI
+from .profiler import region
 
-comm = MPI.COMM_WORLD
+from .communication import comm
 rank = comm.Get_rank()
 
+def perturb_split_block ( op1, op2, v_k, degen ):
+  '''
+  perturb_split of a block of k-points, for operators and eigenvectors
+  of shape (nk,nawf,nawf,nspin) and the degeneracies degen[ispin][ik]
+  '''
+  from .perturb_split import perturb_split_batch
+
+  op1_k = np.empty(op1.shape, dtype=complex)
+  op2_k = np.empty(op2.shape, dtype=complex)
+  for ispin in range(op1.shape[3]):
+    op1_k[...,ispin],op2_k[...,ispin],_ = perturb_split_batch(op1[...,ispin], op2[...,ispin], v_k[...,ispin], degen[ispin])
+  return op1_k,op2_k
+
+
+def do_perturb_split ( data_controller, op1, op2, op1_k, op2_k ):
+  '''
+  Write to op1_k and op2_k the operators op1 and op2 (nk,nawf,nawf,nspin) in
+  the basis of eigenvectors diagonalizing op1 in the degenerate subspaces.
+  Blocks of k-points run on the workers of the backend, the arrays may be out-of-core.
+  '''
+  arry,attr = data_controller.data_dicts()
+  backend = data_controller.backend
+
+  with region('perturb_split'):
+    for ks,ke in data_controller.k_chunks(op1.shape[0], 4*op1[:1].nbytes):
+      blocks = [(ks+bs,ks+be) for bs,be in backend.blocks(ke-ks)]
+      split = backend.map(perturb_split_block, [op1[bs:be] for bs,be in blocks],
+                                               [op2[bs:be] for bs,be in blocks],
+                                               [arry['v_k'][bs:be] for bs,be in blocks],
+                                               [[d[bs:be] for d in arry['degen']] for bs,be in blocks])
+      for (bs,be),(o1,o2) in zip(blocks, split):
+        op1_k[bs:be],op2_k[bs:be] = o1,o2
+
+
+def do_momentum_split ( data_controller, ipol, jpol, pksp_i, pksp_j ):
+  '''
+  Write to pksp_i and pksp_j the gradients of H along ipol and jpol in the basis
+  diagonalizing the first in the degenerate subspaces, from the momenta pksp and
+  the rotations of their subspaces cached by do_momentum. Only the k-points with
+  degeneracies are rotated, from the basis of jpol to that of ipol.
+  '''
+  from .perturb_split import rotate_subspaces
+
+  arry,attr = data_controller.data_dicts()
+
+  with region('perturb_split'):
+    for ks,ke in data_controller.k_chunks(pksp_i.shape[0], 2*pksp_i[:1].nbytes):
+      pksp_i[ks:ke] = arry['pksp'][ks:ke,ipol]
+      pj = np.array(arry['pksp'][ks:ke,jpol])
+      for ispin,rotations in enumerate(arry['degen_rot']):
+        for ik in range(ks, ke):
+          if ik in rotations:
+            degen = arry['degen'][ispin][ik]
+            rotate_subspaces(pj[ik-ks,:,:,ispin], degen, [np.conj(w.T) for w in rotations[ik][jpol]])
+            rotate_subspaces(pj[ik-ks,:,:,ispin], degen, rotations[ik][ipol])
+      pksp_j[ks:ke] = pj
+    pj = None
+
+
 def do_spin_Hall ( data_controller, twoD, do_ac ):
-  from .perturb_split import perturb_split
   from .constants import ELECTRONVOLT_SI,ANGSTROM_AU,H_OVER_TPI,LL
 
   arry,attr = data_controller.data_dicts()
@@ -52,12 +111,10 @@ def do_spin_Hall ( data_controller, twoD, do_ac ):
     #----------------------------------------------
     jdHksp = do_spin_current(data_controller, spol, ipol)
 
-    jksp_is = np.empty_like(jdHksp)
-    pksp_j = np.empty_like(jdHksp)
+    jksp_is = data_controller.ooc_array('jksp', jdHksp.shape)
+    pksp_j = data_controller.ooc_array('pksp_j', jdHksp.shape)
 
-    for ik in range(jdHksp.shape[0]):
-      for ispin in range(jdHksp.shape[3]):
-        jksp_is[ik,:,:,ispin],pksp_j[ik,:,:,ispin] = perturb_split(jdHksp[ik,:,:,ispin], arry['dHksp'][ik,jpol,:,:,ispin], arry['v_k'][ik,:,:,ispin], arry['degen'][ispin][ik])
+    do_perturb_split(data_controller, jdHksp, arry['dHksp'][:,jpol], jksp_is, pksp_j)
     jdHksp = None
 
     #---------------------------------
@@ -93,12 +150,10 @@ def do_spin_Hall ( data_controller, twoD, do_ac ):
 
       jdHksp = do_spin_current(data_controller, spol, ipol)
 
-      jksp_js = np.empty_like(jdHksp)
-      pksp_i = np.empty_like(jdHksp)
+      jksp_js = data_controller.ooc_array('jksp', jdHksp.shape)
+      pksp_i = data_controller.ooc_array('pksp_i', jdHksp.shape)
 
-      for ik in range(jdHksp.shape[0]):
-        for ispin in range(jdHksp.shape[3]):
-          jksp_js[ik,:,:,ispin],pksp_i[ik,:,:,ispin] = perturb_split(jdHksp[ik,:,:,ispin], arry['dHksp'][ik,jpol,:,:,ispin], arry['v_k'][ik,:,:,ispin], arry['degen'][ispin][ik])
+      do_perturb_split(data_controller, jdHksp, arry['dHksp'][:,jpol], jksp_js, pksp_i)
       jdHksp = None
 
       ene,sigxy = do_ac_conductivity(data_controller, jksp_js, pksp_i, ipol, jpol)
@@ -117,7 +172,6 @@ def do_spin_Hall ( data_controller, twoD, do_ac ):
 
 
 def do_anomalous_Hall ( data_controller, do_ac ):
-  from .perturb_split import perturb_split
   from .constants import ELECTRONVOLT_SI,ANGSTROM_AU,H_OVER_TPI,LL
 
   arry,attr = data_controller.data_dicts()
@@ -142,12 +196,14 @@ def do_anomalous_Hall ( data_controller, do_ac ):
 
     dks = arry['dHksp'].shape
 
-    pksp_i = np.zeros((dks[0],dks[2],dks[3],dks[4]),order="C",dtype=complex)
-    pksp_j = np.zeros_like(pksp_i)
+    pksp_i = data_controller.ooc_array('pksp_i', (dks[0],dks[2],dks[3],dks[4]))
+    pksp_j = data_controller.ooc_array('pksp_j', (dks[0],dks[2],dks[3],dks[4]))
 
-    for ik in range(dks[0]):
-      for ispin in range(dks[4]):
-        pksp_i[ik,:,:,ispin],pksp_j[ik,:,:,ispin] = perturb_split(arry['dHksp'][ik,ipol,:,:,ispin], arry['dHksp'][ik,jpol,:,:,ispin], arry['v_k'][ik,:,:,ispin], arry['degen'][ispin][ik])
+    # The momenta of do_momentum hold the operators of both directions, unless they were trimmed to the projectable bands
+    if 'degen_rot' in arry and arry['pksp'].shape[2:4] == dks[2:4]:
+      do_momentum_split(data_controller, ipol, jpol, pksp_i, pksp_j)
+    else:
+      do_perturb_split(data_controller, arry['dHksp'][:,ipol], arry['dHksp'][:,jpol], pksp_i, pksp_j)
 
     ene,ahc,Om_k = do_Berry_curvature(data_controller, pksp_i, pksp_j)
 
@@ -187,12 +243,28 @@ def do_anomalous_Hall ( data_controller, do_ac ):
       fsigR = 'MCDr_%s%s.dat'%cart_indices
       data_controller.write_file_row_col(fsigR, ene, sigxyr)
 
+def Berry_occupation_block ( Om_znk, E_k, deltakp, ene, smearing ):
+  '''
+  Berry curvature of a block of k-points summed over the bands occupied at each energy of ene
+  '''
+  from .smearing import intgaussian, intmetpax
+
+  Om_zk = np.zeros((Om_znk.shape[0],ene.size), dtype=float)
+  for i in range(ene.size):
+    if smearing == 'gauss':
+      Om_zk[:,i] = np.sum((Om_znk[:,:]*intgaussian(E_k,ene[i],deltakp)), axis=1)
+    elif smearing == 'm-p':
+      Om_zk[:,i] = np.sum(Om_znk[:,:]*intmetpax(E_k,ene[i],deltakp), axis=1)
+    else:
+      Om_zk[:,i] = np.sum(Om_znk[:,:]*(0.5 * (-np.sign(E_k-ene[i]) + 1)), axis=1)
+  return Om_zk
+
+
 def do_Berry_curvature ( data_controller, jksp, pksp ):
   #----------------------
   # Compute spin Berry curvature
   #----------------------
   from .communication import gather_full
-  from .smearing import intgaussian, intmetpax
 
   arrays,attributes = data_controller.data_dicts()
 
@@ -204,11 +276,13 @@ def do_Berry_curvature ( data_controller, jksp, pksp ):
   Om_znkaux = np.zeros((snktot,nawf), dtype=float)
 
   deltap = 0.05
-  for ik in range(snktot):
-    E_nm = (arrays['E_k'][ik,:,0] - arrays['E_k'][ik,:,0][:,None])**2 + deltap**2
+  # jksp and pksp are read in blocks of k-points, they may be out-of-core
+  for ks,ke in data_controller.k_chunks(snktot, 2*pksp[:1].nbytes):
+    E_k = arrays['E_k'][ks:ke,:nawf,0]
+    E_nm = (E_k[:,None,:] - E_k[:,:,None])**2 + deltap**2
     E_nm[np.where(E_nm<1.e-4)] = np.inf
-    Om_znkaux[ik] = -2.0*np.sum(np.imag(jksp[ik,:,:,0]*pksp[ik,:,:,0].T)/E_nm, axis=1)
-  E_nm = None
+    Om_znkaux[ks:ke] = -2.0*np.sum(np.imag(jksp[ks:ke,:,:,0]*np.swapaxes(pksp[ks:ke,:,:,0],1,2))/E_nm, axis=2)
+  E_k = E_nm = None
 
   attributes['emaxH'] = np.amin(np.array([attributes['shift'],attributes['emaxH']]))
   ### Hardcoded 'de'
@@ -217,13 +291,17 @@ def do_Berry_curvature ( data_controller, jksp, pksp ):
 
   Om_zkaux = np.zeros((snktot,esize), dtype=float)
 
-  for i in range(esize):
-    if attributes['smearing'] == 'gauss':
-      Om_zkaux[:,i] = np.sum((Om_znkaux[:,:]*intgaussian(arrays['E_k'][:,:,0],ene[i],arrays['deltakp'][:,:,0])), axis=1)
-    elif attributes['smearing'] == 'm-p':
-      Om_zkaux[:,i] = np.sum(Om_znkaux[:,:]*intmetpax(arrays['E_k'][:,:,0],ene[i],arrays['deltakp'][:,:,0]), axis=1)
-    else:
-      Om_zkaux[:,i] = np.sum(Om_znkaux[:,:]*(0.5 * (-np.sign(arrays['E_k'][:,:,0]-ene[i]) + 1)), axis=1)
+  # Blocks of k-points run on the workers of the backend
+  backend = data_controller.backend
+  blocks = backend.blocks(snktot)
+  smearing = attributes['smearing']
+  deltakp = [(arrays['deltakp'][ks:ke,:,0] if smearing in ['gauss','m-p'] else None) for ks,ke in blocks]
+  Om_blocks = backend.map(Berry_occupation_block, [Om_znkaux[ks:ke] for ks,ke in blocks],
+                                                  [arrays['E_k'][ks:ke,:,0] for ks,ke in blocks],
+                                                  deltakp, [ene]*len(blocks), [smearing]*len(blocks))
+  for (ks,ke),Om in zip(blocks, Om_blocks):
+    Om_zkaux[ks:ke] = Om
+  Om_blocks = None
 
   Om_zk = gather_full(Om_zkaux, attributes['npool'])
   Om_zkaux = None
@@ -270,8 +348,10 @@ def do_ac_conductivity ( data_controller, jksp, pksp, ipol, jpol ):
   sigxy_auxR = np.ascontiguousarray(np.real(sigxy_aux))
   sigxy_auxI = np.ascontiguousarray(np.imag(sigxy_aux))
   
-  comm.Reduce(sigxy_auxR, sigxyR, op=MPI.SUM)
-  comm.Reduce(sigxy_auxI, sigxyI, op=MPI.SUM)
+  with region('reduction'):
+    comm.Reduce(sigxy_auxR, sigxyR, op=MPI.SUM)
+  with region('reduction'):
+    comm.Reduce(sigxy_auxI, sigxyI, op=MPI.SUM)
 
   sigxy_aux = sigxy_auxR = sigxy_auxI = None
 
@@ -283,6 +363,7 @@ def do_ac_conductivity ( data_controller, jksp, pksp, ipol, jpol ):
 
 def smear_sigma_loop ( data_controller, ene, pksp_i, pksp_j, ispin, ipol, jpol ):
   from .smearing import intgaussian,intmetpax
+  from .do_adaptive_smearing import pair_widths
 
   arry,attr = data_controller.data_dicts()
 
@@ -290,8 +371,6 @@ def smear_sigma_loop ( data_controller, ene, pksp_i, pksp_j, ispin, ipol, jpol )
   sigxy = np.zeros((esize), dtype=complex)
 
   snktot,nawf,_,nspin = pksp_j.shape
-  f_nm = np.zeros((snktot,nawf,nawf), dtype=float)
-  E_diff_nm = np.zeros((snktot,nawf,nawf), dtype=float)
 
   Ef = 0.0
   eps = 1.0e-16
@@ -301,26 +380,30 @@ def smear_sigma_loop ( data_controller, ene, pksp_i, pksp_j, ispin, ipol, jpol )
     fn = 1.0/(np.exp(arry['E_k'][:,:,ispin]/attr['temp'])+1)
   elif attr['smearing'] == 'gauss':
     fn = intgaussian(arry['E_k'][:,:,ispin], Ef, arry['deltakp'][:,:,ispin])
-  elif smearing == 'm-p':
+  elif attr['smearing'] == 'm-p':
     fn = intmetpax(arry['E_k'][:,:,ispin], Ef, arry['deltakp'][:,:,ispin]) 
 
-  # Collapsing the sum over k points
-  for n in range(nawf):
-    for m in range(nawf):
-      if m != n:
-        E_diff_nm[:,n,m] = (arry['E_k'][:,n,ispin]-arry['E_k'][:,m,ispin])**2
-        f_nm[:,n,m] = (fn[:,n] - fn[:,m])*np.imag(pksp_j[:,n,m,ispin]*pksp_i[:,m,n,ispin])
+  # Collapsing the sum over k points, in blocks of k-points as pksp may be out-of-core
+  offd = ~np.eye(nawf, dtype=bool)
+  for ks,ke in data_controller.k_chunks(snktot, 3*pksp_j[:1].nbytes):
+    E_k = arry['E_k'][ks:ke,:nawf,ispin]
+    E_diff_nm = (E_k[:,:,None]-E_k[:,None,:])**2
+    f_nm = (fn[ks:ke,:nawf,None]-fn[ks:ke,None,:nawf])*np.imag(pksp_j[ks:ke,:,:,ispin]*np.swapaxes(pksp_i[ks:ke,:,:,ispin],1,2))
+    f_nm *= offd
 
-  fn = None
+    # Pairs of bands with equal occupations, both filled or both empty, do not contribute
+    pairs = np.nonzero(f_nm)
+    f_nm,E_diff_nm = f_nm[pairs],E_diff_nm[pairs]
 
-  for e in range(esize):
     if attr['smearing'] != None:
-      sigxy[e] = np.sum(f_nm[:,:,:]/(E_diff_nm[:,:,:]-(ene[e]+1.j*arry['deltakp2'][:,:nawf,:nawf,ispin])**2+eps))
+      dkp2 = pair_widths(data_controller, ks, ke, ispin, nawf)[pairs]
     else:
-      sigxy[e] = np.sum(f_nm[:,:,:]/(E_diff_nm[:,:,:]-(ene[e]+1.j*arry['delta'])**2+eps))
+      dkp2 = attr['delta']
+
+    for e in range(esize):
+      sigxy[e] += np.sum(f_nm/(E_diff_nm-(ene[e]+1.j*dkp2)**2+eps))
 
-  F_nm = None
-  E_diff_nm = None
+  fn = f_nm = E_diff_nm = dkp2 = None
 
   return np.nan_to_num(sigxy)
 
@@ -332,7 +415,7 @@ def do_spin_current ( data_controller, spol, ipol ):
   bnd = attr['bnd']
   snktot,_,nawf,nawf,nspin = arry['dHksp'].shape
 
-  jdHksp = np.empty((snktot,nawf,nawf,nspin), dtype=complex)
+  jdHksp = data_controller.ooc_array('jdHksp', (snktot,nawf,nawf,nspin))
 
   for ispin in range(nspin):
     for ik in range(snktot):
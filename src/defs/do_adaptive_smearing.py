@@ -26,32 +26,63 @@ def do_adaptive_smearing ( data_controller, smearing ):
   # adaptive smearing as in Yates et al. Phys. Rev. B 75, 195121 (2007).
   #----------------------
 
+  from .do_momentum import momentum_diagonal,momenta_bands
+
   a_vectors = arrays['a_vectors']
 
-  nawf = attributes['nawf']
+  # Widths are computed for the bands of the momenta (see gradient_and_momenta)
+  nawf = momenta_bands(arrays)
   nspin = attributes['nspin']
   nkpnts = attributes['nkpnts']
-  npks = arrays['pksp'].shape[0]
-
-  diag = np.diag_indices(nawf)
+  npks = arrays['E_k'].shape[0]
 
   dk = (8.*np.pi**3/attributes['omega']/(nkpnts))**(1./3.)
 
   afac = (1. if smearing=='m-p' else .7)
 
-## DEV: Try to make contiguinuity conditional. Requires benchmark testing
-  pksaux = np.ascontiguousarray(arrays['pksp'][:,:,diag[0],diag[1]])
+  # Widths of the bands, from the diagonal of the momenta read in blocks of k-points
+  deltakp = np.empty((npks,nawf,nspin), dtype=float)
+  for ks,ke in data_controller.k_chunks(npks, 3*nawf**2*nspin*16):
+    deltakp[ks:ke] = afac*dk*norm(momentum_diagonal(arrays, ks, ke), axis=1)
 
-  deltakp = np.zeros((npks,nawf,nspin), dtype=float)
-  deltakp2 = np.zeros((npks,nawf,nawf,nspin), dtype=float)
-  for n in range(nawf):
-    deltakp[:,n] = norm(np.real(pksaux[:,:,n]), axis=1)
-    for m in range(nawf):
-      deltakp2[:,n,m,:] = norm(pksaux[:,:,n,:]-pksaux[:,:,m,:], axis=1)
-
-  pksaux = None
-  deltakp *= afac*dk
-  deltakp2 *= afac*dk
+  # The widths of the pairs of bands (nk,nawf,nawf,nspin) are not stored,
+  # pair_widths computes them from the momenta for the blocks of its callers,
+  # which must be those the widths were computed from
+  arrays.pop('deltakp2', None)
+  attributes['deltakp_scale'] = (afac*dk, attributes.get('momenta_generation', 0))
 
   arrays['deltakp'] = deltakp
-  arrays['deltakp2'] = deltakp2
+
+
+def pair_widths ( data_controller, ks, ke, ispin, nb ):
+  '''
+  Adaptive smearing widths of the pairs of bands, a*dk*|v_n-v_m|, for the
+  k-points ks to ke of spin ispin and the lowest nb bands, from the diagonal of
+  the momenta. Requires do_adaptive_smearing, after the last computation of the momenta.
+
+  Arguments:
+    data_controller (DataController): The DataController
+    ks, ke (int): First and last (excluded) k-points of the block
+    ispin (int): Spin index
+    nb (int): Number of bands
+
+  Returns:
+    deltakp2 (ndarray): Widths (ke-ks,nb,nb)
+  '''
+  import numpy as np
+  from .do_momentum import momentum_diagonal
+
+  arrays,attributes = data_controller.data_dicts()
+
+  scale,generation = attributes['deltakp_scale']
+  if generation != attributes.get('momenta_generation', 0):
+    raise ValueError('The momenta were computed again after the adaptive smearing, call adaptive_smearing again')
+
+  v = momentum_diagonal(arrays, ks, ke)[:,:,:nb,ispin]
+
+  # Squared differences accumulated one direction at a time
+  deltakp2 = np.zeros((ke-ks,nb,nb), dtype=float)
+  for i in range(3):
+    deltakp2 += (v[:,i,:,None]-v[:,i,None,:])**2
+
+  return scale*np.sqrt(deltakp2)
@@ -18,15 +18,11 @@
 
 import os, sys, glob
 import numpy as np
-import matplotlib.pyplot as plt
-import scipy.integrate
-import scipy.special
-import scipy.interpolate
-from scipy.io import FortranFile
+import scipy.linalg
 import scipy.fft as FFT
 
-from mpi4py import MPI
-comm = MPI.COMM_WORLD
+from .mpi import MPI
+from .communication import comm
 rank = comm.Get_rank()
 
 from .read_upf import UPF
@@ -46,6 +42,9 @@ def read_pswfc_from_upf(data_controller, atom):
   raise RuntimeError('atom not found')
   
 def radialfft_simpson(r, f, l, qmesh, volume):
+  import scipy.special
+  import scipy.integrate
+
   fq = np.zeros_like(qmesh)
   fact = 4.0*np.pi / np.sqrt(volume)
   
@@ -233,14 +232,18 @@ def build_aewfc_basis(data_controller):
 
 
 
+def scatter_G2box(wfc, igwx, gamma_only, mill, nr1, nr2, nr3):
+  # place the plane wave coefficients (last axis) on the FFT box with a single fancy-index assignment
+  wfc = np.asarray(wfc)
+  wfcg = np.zeros(wfc.shape[:-1]+(nr1,nr2,nr3), dtype=complex)
+  m0,m1,m2 = mill[0,:igwx],mill[1,:igwx],mill[2,:igwx]
+  wfcg[...,m0,m1,m2] = wfc[...,:igwx]
+  if gamma_only:
+    wfcg[...,-m0,-m1,-m2] = np.conj(wfc[...,:igwx])
+  return wfcg
+
 def fft_wfc_G2R_old(wfc, igwx, gamma_only, mill, nr1, nr2, nr3, omega):
-  wfcg = np.zeros((nr1,nr2,nr3), dtype=complex)
-  
-  for ig in range(igwx):
-    wfcg[mill[0,ig],mill[1,ig],mill[2,ig]] = wfc[ig]
-    if gamma_only:
-      wfcg[-mill[0,ig],-mill[1,ig],-mill[2,ig]] = np.conj(wfc[ig])
-      
+  wfcg = scatter_G2box(wfc, igwx, gamma_only, mill, nr1, nr2, nr3)
   wfcr = FFT.ifftn(wfcg) * nr1 * nr2 * nr3 / np.sqrt(omega)
   return wfcr
 
@@ -248,52 +251,39 @@ def fft_wfc_G2R(wfc, gkspace, nr1, nr2, nr3, omega):
   igwx = gkspace['igwx']
   gamma_only = gkspace['gamma_only']
   mill = gkspace['mill']
-  wfcg = np.zeros((nr1,nr2,nr3), dtype=complex)
-  
-  for ig in range(igwx):
-    wfcg[mill[0,ig],mill[1,ig],mill[2,ig]] = wfc[ig]
-    if gamma_only:
-      wfcg[-mill[0,ig],-mill[1,ig],-mill[2,ig]] = np.conj(wfc[ig])
-      
+  wfcg = scatter_G2box(wfc, igwx, gamma_only, mill, nr1, nr2, nr3)
   wfcr = FFT.ifftn(wfcg) * nr1 * nr2 * nr3 / np.sqrt(omega)
   return wfcr
 
 def fft_allwfc_G2R(wfc, gkspace, nr1, nr2, nr3, omega):
+  # wfc is either a single wavefunction (igwx) or a set of them (nwfc,igwx)
   igwx = gkspace['igwx']
   gamma_only = gkspace['gamma_only']
   mill = gkspace['mill']
-  try: 
-    nox = wfc.shape[0]
-    nwx = wfc.shape[1]
-    wfcg = np.zeros((nwx,nr1,nr2,nr3), dtype=complex)
-  except:
-    nox = 0
-    wfcg = np.zeros((nr1,nr2,nr3), dtype=complex)
-  if nox == 0:
-    for ig in range(igwx):
-      wfcg[:,mill[0,ig],mill[1,ig],mill[2,ig]] = wfc[:,ig]
-      if gamma_only:
-        wfcg[:,-mill[0,ig],-mill[1,ig],-mill[2,ig]] = np.conj(wfc[:,ig])
-    wfcr = FFT.ifftn(wfcg) * nr1 * nr2 * nr3 / np.sqrt(omega)
-  else:
-    wfcr = np.zeros((nox,nr1,nr2,nr3), dtype=complex)
-    for no in range(nox):
-      for ig in range(igwx):
-        wfcg[no,mill[0,ig],mill[1,ig],mill[2,ig]] = wfc[no,ig]
-        if gamma_only:
-          wfcg[no,-mill[0,ig],-mill[1,ig],-mill[2,ig]] = np.conj(wfc[no,ig])
-      wfcr[no] = FFT.ifftn(wfcg[no]) * nr1 * nr2 * nr3 / np.sqrt(omega)
+  wfcg = scatter_G2box(wfc, igwx, gamma_only, mill, nr1, nr2, nr3)
+  wfcr = FFT.ifftn(wfcg, axes=(-3,-2,-1)) * nr1 * nr2 * nr3 / np.sqrt(omega)
   return wfcr
   
 def fft_wfc_R2G(wfc, igwx, mill, omega):
   tmp = FFT.fftn(wfc) / np.sqrt(omega)
-  
-  wfcg = np.zeros((igwx,), dtype=complex)
-  for ig in range(igwx):
-    wfgc[tmp] = tmp[mill[0,ig],mill[1,ig],mill[2,ig]]
-    
+  wfcg = tmp[mill[0,:igwx],mill[1,:igwx],mill[2,:igwx]]
   return wfcg
 
+def read_fortran_records(fname):
+  # memory map a Fortran sequential unformatted file and return the
+  # (offset, length) in bytes of the payload of each record
+  mm = np.memmap(fname, dtype=np.uint8, mode='r')
+  records = []
+  pos = 0
+  while pos < mm.size:
+    nbytes = int(mm[pos:pos+4].view(np.int32)[0])
+    end = pos + 4 + nbytes
+    if int(mm[end:end+4].view(np.int32)[0]) != nbytes:
+      raise IOError('Corrupted record in fortran binary file: %s'%fname)
+    records.append((pos+4,nbytes))
+    pos = end + 4
+  return mm,records
+
 def read_QE_wfc(data_controller, ik, ispin):
   arry, attr = data_controller.data_dicts()
   
@@ -306,36 +296,34 @@ def read_QE_wfc(data_controller, ik, ispin):
   else:
     print('no wfc file found')
     
-  with FortranFile(os.path.join(attr['fpath'], wfcfile), 'r') as f:
-    record = f.read_ints(np.int32)
-    assert len(record) == 11, 'something wrong reading fortran binary file'
-    
-    ik_ = record[0]
-    assert ik+1 == ik_, 'wrong k-point in wfc file???'
-    
-    xk = np.frombuffer(record[1:7], np.float64)
-    ispin = record[7]
-    gamma_only = (record[8] != 0)
-    scalef = np.frombuffer(record[9:], np.float64)[0]
-    #print('ik =', ik, '  ispin =', ispin, '  gamma_only =', gamma_only, '  scalef =', scalef)
-    #print('xk =', xk)
-    
-    ngw, igwx, npol, nbnd = f.read_ints(np.int32)
-    #print('ngw =', ngw, '  igwx = ', igwx, '  npol = ', npol, '  nbnd = ', nbnd)
-    bg = f.read_reals(np.float64).reshape(3,3,order='F')
-    #print('bg = ', bg)
-    mill = f.read_ints(np.int32).reshape(3,igwx,order='F')
-    #print('mill.shape = ', mill.shape)
-    
-    wfc = []
-    for i in range(nbnd):
-      wfc.append(f.read_reals(np.complex128))
-  
+  mm,records = read_fortran_records(os.path.join(attr['fpath'], wfcfile))
+  record = lambda i,dtype : np.frombuffer(mm, dtype=dtype, count=records[i][1]//np.dtype(dtype).itemsize, offset=records[i][0])
+
+  header = record(0, np.int32)
+  assert len(header) == 11, 'something wrong reading fortran binary file'
+
+  ik_ = header[0]
+  assert ik+1 == ik_, 'wrong k-point in wfc file???'
+
+  xk = np.frombuffer(header[1:7], np.float64)
+  ispin = header[7]
+  gamma_only = (header[8] != 0)
+  scalef = np.frombuffer(header[9:], np.float64)[0]
+
+  ngw, igwx, npol, nbnd = record(1, np.int32)
+  bg = record(2, np.float64).reshape(3,3,order='F')
+  mill = record(3, np.int32).reshape(3,igwx,order='F')
+
+  # the band records all have the same length, so they are viewed
+  # as a single (nbnd,npw) array directly on the memory map
+  offset,nbytes = records[4]
+  assert len(records) == 4+nbnd and all(r[1] == nbytes for r in records[4:]), 'something wrong reading fortran binary file'
+  stride = records[5][0]-offset if nbnd > 1 else nbytes
+  wfc = np.array(np.ndarray((nbnd,nbytes//16), dtype=np.complex128, buffer=mm, offset=offset, strides=(stride,16)))
+  mm = None
+
   # compute overlap
-  ovp = np.zeros((nbnd,nbnd),dtype=complex)
-  for n in range(nbnd):
-    for m in range(nbnd):
-      ovp[n,m] = np.sum(np.conj(wfc[n]).dot(wfc[m]))
+  ovp = np.conj(wfc) @ wfc.T
   eigs, eigv = np.linalg.eigh(ovp)
   assert (np.all(eigs>=0))
 
@@ -349,14 +337,10 @@ def read_QE_wfc(data_controller, ik, ispin):
 
 def calc_ylmg(k_plus_G, q):
     # cubic harmonics: build the angular part, no spin orbit
-    kGx = np.zeros_like(q)
-    kGy = np.zeros_like(q)
-    kGz = np.zeros_like(q)
-    for ig in range(len(q)):
-      if abs(q[ig]) > 1e-6:
-        kGx[ig] = k_plus_G[ig,0] / q[ig]
-        kGy[ig] = k_plus_G[ig,1] / q[ig]
-        kGz[ig] = k_plus_G[ig,2] / q[ig]
+    kG = np.zeros_like(k_plus_G)
+    nz = np.abs(q) > 1e-6
+    kG[nz] = k_plus_G[nz] / q[nz,None]
+    kGx,kGy,kGz = kG[:,0],kG[:,1],kG[:,2]
     
     lmax = 3
     ylmg = np.zeros((len(q), (lmax+1)*(lmax+1)))
@@ -396,7 +380,7 @@ def calc_ylmg(k_plus_G, q):
 
 def calc_ylmg_complex_0(ylmg):
     # complex spherical harmonics
-    ylmgc = np.zeros_like(ylmg, np.complex)
+    ylmgc = np.zeros_like(ylmg, complex)
 
     sqrt2 = np.sqrt(2.0)
 
@@ -439,7 +423,7 @@ def calc_ylmg_so(ylmgc):
     # spinor spherical harmonics
     npw = ylmgc.shape[0]
     nylm = ylmgc.shape[1]
-    ylmgso = np.zeros((2*npw,2*nylm), np.complex)
+    ylmgso = np.zeros((2*npw,2*nylm), complex)
     sqrt = np.sqrt
 
     # generated automatically by cb.py
@@ -543,19 +527,44 @@ def calc_ylmg_so(ylmgc):
 
 
 
-def calc_atwfc_k(basis, gkspace, dftSO=False):
+def build_radial_table(basis):
+  # collect the distinct radial form factors of the basis (shared by the m components
+  # of a shell) in a single table, so that they are interpolated together at each k
+  qmesh = basis[0]['qmesh']
+  table,irad,seen = [],[],{}
+  for b in basis:
+    if b['qmesh'] is not qmesh and not np.array_equal(b['qmesh'], qmesh):
+      raise ValueError('All basis functions must share the same q mesh')
+    key = id(b['wfc_g'])
+    if key not in seen:
+      seen[key] = len(table)
+      table.append(b['wfc_g'])
+    irad.append(seen[key])
+  return {'qmesh':qmesh, 'table':np.array(table), 'irad':np.array(irad)}
+
+
+def interp_radial_table(rtable, q):
+  # linear interpolation of every radial form factor on the |k+G| values
+  qmesh,table = rtable['qmesh'],rtable['table']
+  if np.any(q < qmesh[0]) or np.any(q > qmesh[-1]):
+    raise ValueError('|k+G| outside of the radial q mesh')
+  i0 = np.clip(np.searchsorted(qmesh, q, side='right')-1, 0, len(qmesh)-2)
+  w = (q - qmesh[i0]) / (qmesh[i0+1] - qmesh[i0])
+  return table[:,i0]*(1.-w) + table[:,i0+1]*w
+
+
+def calc_atwfc_k(basis, gkspace, dftSO=False, rtable=None):
   # construct atomic wfc at k
-  atwfc_k = []
+  # rtable (from build_radial_table) can be computed once and reused for every k
   natwfc = len(basis)
+  if rtable is None:
+    rtable = build_radial_table(basis)
   
   xk, igwx, mill, bg, gamma_only = [gkspace[s] for s in ('xk', 'igwx', 'mill', 'bg', 'gamma_only')]
-  #print('xk=', xk)
   
   # build k+G vectors
   hkl = mill.T
-  k_plus_G = np.dot(hkl, bg.T)
-  for ig in range(igwx):
-      k_plus_G[ig,:] += xk
+  k_plus_G = np.dot(hkl, bg.T) + xk
 
   # pre-calculate spherical harmonics
   q = np.linalg.norm(k_plus_G, axis=1)
@@ -563,49 +572,35 @@ def calc_atwfc_k(basis, gkspace, dftSO=False):
   if dftSO:
       ylmgc = calc_ylmg_complex_0(ylmg)
       ylmgso = calc_ylmg_so(ylmgc)
- 
-  # loop over atoms 
-  for i in range(natwfc):
-    # 1. build the structure factor
-    strf = np.zeros((igwx,), dtype=complex)
-    tau = basis[i]['tau']
-    k_plus_G_dot_tau = np.dot(k_plus_G, tau)
-    strf = np.exp(-1j*k_plus_G_dot_tau)
-    
-    # 2. build the form factor
-    qmesh, wfc_g = basis[i]['qmesh'], basis[i]['wfc_g']
-    #fact = InterpolatedUnivariateSpline(qmesh, wfc_g)(q)
-    fact = scipy.interpolate.interp1d(qmesh, wfc_g, kind='linear')(q)
-    
-    # 3. build the angular part
-    l, m = basis[i]['l'], basis[i]['m']
-    if l > 3: raise NotImplementedError('l>3 not implemented yet')
-    lm = l*l + (m-1)
-    if dftSO:
-        jm = basis[i]['jm']
-
-    # 4. final
-    if not dftSO:
-        atwfc = strf * fact * ylmg[:,lm] * (1.0j)**l
-    else:
-        atwfc = np.hstack((strf,strf)) * np.hstack((fact,fact)) * ylmgso[:,jm] * (1.0j)**l
- 
-    atwfc_k.append(atwfc)
-    
-  return np.array(atwfc_k)
+
+  l = np.array([b['l'] for b in basis])
+  if np.any(l > 3): raise NotImplementedError('l>3 not implemented yet')
+
+  # 1. structure factors for all the orbitals
+  tau = np.array([b['tau'] for b in basis])
+  strf = np.exp(-1j*np.dot(k_plus_G, tau.T))
+
+  # 2. form factors, interpolated once for each distinct radial function
+  fact = interp_radial_table(rtable, q)[rtable['irad']].T
+
+  # 3. angular part and final assembly, (natwfc, npw)
+  if not dftSO:
+    lm = np.array([b['l']*b['l'] + (b['m']-1) for b in basis])
+    atwfc_k = strf * fact * ylmg[:,lm] * (1.0j)**l
+  else:
+    jm = np.array([b['jm'] for b in basis])
+    atwfc_k = np.vstack((strf,strf)) * np.vstack((fact,fact)) * ylmgso[:,jm] * (1.0j)**l
+
+  return np.ascontiguousarray(atwfc_k.T)
 
 
 
 def ortho_atwfc_k(atwfc_k):
   # orthonormalize atwfcs
   natwfc = atwfc_k.shape[0]
-  ovp = np.zeros((natwfc, natwfc), dtype=np.complex)
-  
-  for i in range(natwfc):
-    for j in range(natwfc):
-      ovp[i,j] = np.dot(np.conj(atwfc_k[i]), atwfc_k[j])
-      
-      # check that eigenvalues are positive
+  ovp = np.conj(atwfc_k) @ atwfc_k.T
+
+  # check that eigenvalues are positive
   eigs, eigv = np.linalg.eigh(ovp)
   assert (np.all(eigs>=0))
   
@@ -618,12 +613,8 @@ def ortho_atwfc_k(atwfc_k):
     X = np.dot(np.conj(eigv), np.dot(np.diag(eigs), eigv.T))
     oatwfc_k = np.dot(X, atwfc_k)
     
-    # check ortonormalization
-  oovp = np.zeros((natwfc, natwfc), dtype=np.complex)
-  for i in range(natwfc):
-    for j in range(natwfc):
-      oovp[i,j] = np.dot(np.conj(oatwfc_k[i]), oatwfc_k[j])
-      
+  # check ortonormalization
+  oovp = np.conj(oatwfc_k) @ oatwfc_k.T
   diff = np.linalg.norm(oovp - np.eye(natwfc))
   if np.abs(diff) > 1e-4:
     raise RuntimeError('ortogonalization failed')
@@ -631,43 +622,53 @@ def ortho_atwfc_k(atwfc_k):
   return oatwfc_k
 
 
-def calc_proj_k(data_controller, basis, ik, ispin):
+def calc_proj_k(data_controller, basis, ik, ispin, rtable=None):
   arry, attr = data_controller.data_dicts()
   gkspace, wfc = read_QE_wfc(data_controller, ik, ispin)
-  atwfc_k = calc_atwfc_k(basis, gkspace, attr['dftSO'])
+  atwfc_k = calc_atwfc_k(basis, gkspace, attr['dftSO'], rtable)
   oatwfc_k = ortho_atwfc_k(atwfc_k)
   proj_k = np.dot(np.conj(oatwfc_k), wfc['wfc'].T)
   return (proj_k.T)
 
 
-def calc_gkspace(data_controller,ik,gamma_only=False):
+def calc_gsphere(data_controller):
+  # sphere of Miller indices |G|^2 <= ecutrho, built once per cell and cutoff
+  # and stored in the data controller ('gsphere') to be reused for every k
   arry, attr = data_controller.data_dicts()
-  # calculate sphere of Miller indeces for k + G
   gcutm = attr['ecutrho'] / (2*np.pi/attr['alat'])**2
   at = arry['a_vectors']
+  bv = arry['b_vectors']
+
+  key = (gcutm, at.tobytes(), bv.tobytes())
+  if 'gsphere' in arry and arry['gsphere']['key'] == key:
+    return arry['gsphere']
+
   nx = 2*int(np.sqrt(gcutm)*np.sqrt(at[0,0]**2 + at[1,0]**2 + at[2,0]**2)) + 1
   ny = 2*int(np.sqrt(gcutm)*np.sqrt(at[0,1]**2 + at[1,1]**2 + at[2,1]**2)) + 1
   nz = 2*int(np.sqrt(gcutm)*np.sqrt(at[0,2]**2 + at[1,2]**2 + at[2,2]**2)) + 1
   nx = int((nx+1)/2)
   ny = int((ny+1)/2)
   nz = int((nz+1)/2)
-  # sphere of Miller indeces 
-  mill_g = []
-  for i in range(-nx, nx+1):
-    for j in range(-ny, ny+1):
-      for k in range(-nz, nz+1):
-        k_plus_G = np.array([i,j,k]) @ arry['b_vectors']
-        if np.linalg.norm(k_plus_G)**2 <= attr['ecutrho']/(2*np.pi/attr['alat'])**2:
-          mill_g.append(np.array([i,j,k]))
-  mill_g = np.swapaxes(np.array(mill_g),1,0)
-  igwx_g = mill_g.shape[1]
-  
-  mill = []
-  for ig in range(igwx_g):
-    k_plus_G = mill_g[:,ig]@arry['b_vectors'] + arry['kgrid'][:,ik]
-    if np.linalg.norm(k_plus_G)**2 <= attr['ecutwfc']/(2*np.pi/attr['alat'])**2:
-      mill.append(mill_g[:,ig])
-  mill = np.swapaxes(np.array(mill),1,0)
+
+  # all the Miller indices of the box, in the same order as nested loops over i,j,k
+  ijk = np.meshgrid(np.arange(-nx,nx+1), np.arange(-ny,ny+1), np.arange(-nz,nz+1), indexing='ij')
+  mill_box = np.stack([m.ravel() for m in ijk], axis=1)
+  G = mill_box @ bv
+  inside = np.linalg.norm(G, axis=1)**2 <= gcutm
+
+  arry['gsphere'] = {'key':key, 'mill':np.ascontiguousarray(mill_box[inside].T), 'G':G[inside]}
+  return arry['gsphere']
+
+
+def calc_gkspace(data_controller,ik,gamma_only=False):
+  arry, attr = data_controller.data_dicts()
+  # calculate sphere of Miller indeces for k + G
+  gsphere = calc_gsphere(data_controller)
+
+  # keep the G vectors with |k+G|^2 <= ecutwfc
+  k_plus_G = gsphere['G'] + arry['kgrid'][:,ik]
+  inside = np.linalg.norm(k_plus_G, axis=1)**2 <= attr['ecutwfc']/(2*np.pi/attr['alat'])**2
+  mill = gsphere['mill'][:,inside]
   igwx = mill.shape[1]
   
   xk = arry['kgrid'][:,ik] * 2*np.pi/attr['alat']
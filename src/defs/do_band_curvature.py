@@ -46,7 +46,7 @@ def do_band_curvature ( data_controller ):
 
     from .do_d2Hd2k import do_d2Hd2k_ij
     import numpy as np
-    from .perturb_split import perturb_split
+    from .perturb_split import rotate_subspaces
 
     ary,attr = data_controller.data_dicts()
     bnd = attr['bnd']    
@@ -55,7 +55,7 @@ def do_band_curvature ( data_controller ):
 
     # not really the inverse mass tensor..it's actually tksp
     # but we are calling it d2Ed2k for now to save memory.
-    d2Ed2k,dvec_list = do_d2Hd2k_ij(ary['Hksp'],ary['Rfft'],attr['alat'],
+    d2Ed2k,rot_list = do_d2Hd2k_ij(ary['Hksp'],ary['Rfft'],attr['alat'],
                                     attr['npool'],ary['v_k'],
                                     bnd,ary['degen'])
 
@@ -78,18 +78,22 @@ def do_band_curvature ( data_controller ):
         E_temp = ((E_k[ik,:,ispin]-E_k[ik,:,ispin][:,None])[:,:]).T
         E_temp[np.where(np.abs(E_temp)<1.e-5)]=np.inf
 
+        # gradient of H in the basis of the eigenvectors, for the three directions at once
+        v_k=ary['v_k'][ik,:,:,ispin]
+        pksp=np.matmul(np.matmul(np.conj(v_k.T),ary['dHksp'][ik,:,:,:,ispin]),v_k)
+
         for ij in range(ij_ind.shape[0]):
             ipol = ij_ind[ij,0]
             jpol = ij_ind[ij,1]
 
-            # to avoid a zero in the denominator when E_i=E_j
-            if dvec_list[ij][ispin][ik].size:
-                v_k=dvec_list[ij][ispin][ik]
-            else:
-                v_k=ary['v_k'][ik,:,:,ispin]
-            
-            pksp_i=np.conj(v_k.T).dot(ary['dHksp'][ik,ipol,:,:,ispin]).dot(v_k)
-            pksp_j=np.conj(v_k.T).dot(ary['dHksp'][ik,jpol,:,:,ispin]).dot(v_k)
+            pksp_i=pksp[ipol]
+            pksp_j=pksp[jpol]
+
+            # rotated to the basis of d2H/d2k_ij where it has degenerate subspaces
+            if ik in rot_list[ij][ispin]:
+                weights=rot_list[ij][ispin][ik]
+                pksp_i=rotate_subspaces(np.copy(pksp_i),ary['degen'][ispin][ik],weights)
+                pksp_j=rotate_subspaces(np.copy(pksp_j),ary['degen'][ispin][ik],weights)
 
             # this is where d2Ed2k becomes the actual curvature tensor
             d2Ed2k[ij,ik,:,ispin] += np.sum((((pksp_i*pksp_j.T +\
@@ -63,7 +63,7 @@ def band_loop_H ( data_controller, kq_aux ):
 
 
 def do_bands ( data_controller ):
-  from mpi4py import MPI
+  from .mpi import MPI
   from .constants import ANGSTROM_AU
   from .communication import gather_full
   from .get_R_grid_fft import get_R_grid_fft
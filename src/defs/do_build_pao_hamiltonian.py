@@ -18,13 +18,13 @@
 
 import numpy as np
 
-from mpi4py import MPI
-comm = MPI.COMM_WORLD
+from .mpi import MPI
+from .communication import comm
 rank = comm.Get_rank()
 
 ### Reformat
 def build_Hks ( data_controller ):
-  from scipy import linalg as spl
+  from .communication import load_balancing
 
   minimal = False
 
@@ -37,82 +37,92 @@ def build_Hks ( data_controller ):
   nkpnts = attributes['nkpnts']
   shift_type = attributes['shift_type']
 
+  if shift_type not in (0,1,2):
+    if rank == 0:
+      print('\'shift_type\' Not Recognized')
+    comm.Abort()
+
+  # U is distributed over k-points, each rank holds the slice [ini_ik,end_ik)
   U = arrays['U'] 
   my_eigsmat = arrays['my_eigsmat']
 
-  Hksaux = np.zeros((nawf,nawf,nkpnts,nspin), dtype=complex)
-  if minimal:
-    Hks = np.zeros((bnd,bnd,nkpnts,nspin), dtype=complex)
-  else:
-    Hks = np.zeros((nawf,nawf,nkpnts,nspin), dtype=complex)
+  ini_ik,end_ik = load_balancing(comm.Get_size(), rank, nkpnts)
+  snk = end_ik - ini_ik
+
+  dinds = np.diag_indices(nawf)
+  Hksaux = np.empty((snk,nawf,nawf,nspin), dtype=complex)
+
+  # All the local k-points are treated at once with stacked matrix products
+  for ispin in range(nspin):
+    my_eigs = my_eigsmat[:bnd,ini_ik:end_ik,ispin].T
+
+    # Choose only the eigenvalues that are below the energy shift
+    # Bands above bnd_ik are masked out, so each k keeps its own number of bands
+    bnd_ik = np.sum(my_eigs <= eta, axis=1)
+    if np.any(bnd_ik == 0):
+      print('No Eigenvalues in the selected energy range')
+      comm.Abort()
+    mask = np.arange(bnd)[None,:] < bnd_ik[:,None]
+
+    # Columns of UU are the eigenvectors of length nawf, normalized for the first nawf bands
+    UU = np.transpose(U[:,:,:,ispin], (2,1,0))
+    norms = 1./np.sqrt(np.real(np.sum(np.conj(UU)*UU,axis=1)))
+    norms[:,nawf:] = 1.
+    ac = UU[:,:,:bnd] * (norms[:,:bnd]*mask)[:,None,:]  # filtering: bnd is defined by the projectabilities
+    acH = np.conj(np.transpose(ac, (0,2,1)))
+
+    if shift_type == 0:
+      #option 1 (PRB 2013)
+      Hk = (ac*(my_eigs-eta)[:,None,:]) @ acH
+      Hk[:,dinds[0],dinds[1]] += eta
+
+    elif shift_type == 1:
+      #option 2 (PRB 2016)
+      # Masked bands get a unit diagonal in the overlap, so they do not contribute
+      ovp = acH @ ac
+      ovp[:,np.arange(bnd),np.arange(bnd)] += ~mask
+      Hk = (ac*my_eigs[:,None,:]) @ acH - eta*(ac @ np.linalg.solve(ovp, acH))
+      Hk[:,dinds[0],dinds[1]] += eta
+
+    else:
+      # no shift
+      Hk = (ac*my_eigs[:,None,:]) @ acH
+
+    # Enforce Hermiticity (just in case...)
+    Hksaux[...,ispin] = 0.5*(Hk + np.conj(np.transpose(Hk, (0,2,1))))
+    Hk = ac = acH = UU = None
+
+  Hksaux = np.ascontiguousarray(np.transpose(Hksaux, (1,2,0,3)))
+
+  if not minimal:
+    return Hksaux
 
-  for ik in range(nkpnts):
+  from scipy import linalg as spl
+  import numpy.random as rd
+  from numpy import linalg as npl
+  Hks = np.zeros((bnd,bnd,snk,nspin), dtype=complex)
+  for ik in range(snk):
     for ispin in range(nspin):
-      my_eigs = my_eigsmat[:,ik,ispin]
-
-      #Building the Hamiltonian matrix
-      E = np.diag(my_eigs)
-      UU = np.transpose(U[:,:,ik,ispin]) #transpose of U. Now the columns of UU are the eigenvector of length nawf
-      norms = 1./np.sqrt(np.real(np.sum(np.conj(UU)*UU,axis=0)))
-      UU[:,:nawf] = UU[:,:nawf]*norms[:nawf]
-
-      # Choose only the eigenvalues that are below the energy shift
-      bnd_ik = 0
-      for n in range(bnd):
-        if my_eigs[n] <= eta:
-          bnd_ik += 1
-      if bnd_ik == 0:
-        if rank == 0:
-          print('No Eigenvalues in the selected energy range')
-        comm.Abort()
-      ac = UU[:,:bnd_ik]  # filtering: bnd is defined by the projectabilities
-      ee1 = E[:bnd_ik,:bnd_ik]
-      if shift_type == 0:
-        #option 1 (PRB 2013)
-        Hksaux[:,:,ik,ispin] = ac.dot(ee1).dot(np.conj(ac).T) + eta*(np.identity(nawf)-ac.dot(np.conj(ac).T))
-
-      elif shift_type == 1:
-        #option 2 (PRB 2016)
-        aux_p=spl.inv(np.dot(np.conj(ac).T,ac))
-        Hksaux[:,:,ik,ispin] = ac.dot(ee1).dot(np.conj(ac).T) + eta*(np.identity(nawf)-ac.dot(aux_p).dot(np.conj(ac).T))
-
-      elif shift_type == 2:
-        # no shift
-        Hksaux[:,:,ik,ispin] = ac.dot(ee1).dot(np.conj(ac).T)
-
-      else:
-        if rank == 0:
-          print('\'shift_type\' Not Recognized')
-        comm.Abort()
-
-      # Enforce Hermiticity (just in case...)
-      Hksaux[:,:,ik,ispin] = 0.5*(Hksaux[:,:,ik,ispin] + np.conj(Hksaux[:,:,ik,ispin].T))
-
-      if minimal:
-        import numpy.random as rd
-        from numpy import linalg as npl
-        Sbd = np.zeros((nawf,nawf),dtype=complex)
-        Sbdi = np.zeros((nawf,nawf),dtype=complex)
-        S = sv = np.zeros((nawf,nawf),dtype=complex)
-        e = se = np.zeros(nawf,dtype=float)
-
-        e,S = npl.eigh(Hksaux[:,:,ik,ispin])
-        S11 = S[:bnd,:bnd] + 1.0*rd.random(bnd)/10000.
-        S21 = S[:bnd,bnd:] + 1.0*rd.random(nawf-bnd)/10000.
-        S12 = S21.T
-        S22 = S[bnd:,bnd:] + 1.0*rd.random(nawf-bnd)/10000.
-        S22 = S22 + S21.T.dot(np.dot(spl.inv(S11),S12.T))
-        Sbd[:bnd,:bnd] = 0.5*(S11+np.conj(S11.T))
-        Sbd[bnd:,bnd:] = 0.5*(S22+np.conj(S22.T))
-        Sbdi = spl.inv(np.dot(Sbd,np.conj(Sbd.T)))
-        se,sv = npl.eigh(Sbdi)
-        se = np.sqrt(se+0.0j)*np.identity(nawf,dtype=complex)
-        Sbdi = sv.dot(se).dot(np.conj(sv).T)
-        T = S.dot(np.conj(Sbd.T)).dot(Sbdi)
-        Hbd = np.conj(T.T).dot(np.dot(Hksaux[:,:,ik,ispin],T))
-        Hks[:,:,ik,ispin] = 0.5*(Hbd[:bnd,:bnd]+np.conj(Hbd[:bnd,:bnd].T))
-      else:
-        Hks = Hksaux
+      Sbd = np.zeros((nawf,nawf),dtype=complex)
+      Sbdi = np.zeros((nawf,nawf),dtype=complex)
+      S = sv = np.zeros((nawf,nawf),dtype=complex)
+      e = se = np.zeros(nawf,dtype=float)
+
+      e,S = npl.eigh(Hksaux[:,:,ik,ispin])
+      S11 = S[:bnd,:bnd] + 1.0*rd.random(bnd)/10000.
+      S21 = S[:bnd,bnd:] + 1.0*rd.random(nawf-bnd)/10000.
+      S12 = S21.T
+      S22 = S[bnd:,bnd:] + 1.0*rd.random(nawf-bnd)/10000.
+      S22 = S22 + S21.T.dot(np.dot(spl.inv(S11),S12.T))
+      Sbd[:bnd,:bnd] = 0.5*(S11+np.conj(S11.T))
+      Sbd[bnd:,bnd:] = 0.5*(S22+np.conj(S22.T))
+      Sbdi = spl.inv(np.dot(Sbd,np.conj(Sbd.T)))
+      se,sv = npl.eigh(Sbdi)
+      se = np.sqrt(se+0.0j)*np.identity(nawf,dtype=complex)
+      Sbdi = sv.dot(se).dot(np.conj(sv).T)
+      T = S.dot(np.conj(Sbd.T)).dot(Sbdi)
+      Hbd = np.conj(T.T).dot(np.dot(Hksaux[:,:,ik,ispin],T))
+      Hks[:,:,ik,ispin] = 0.5*(Hbd[:bnd,:bnd]+np.conj(Hbd[:bnd,:bnd].T))
   return Hks
 
 
@@ -124,7 +134,15 @@ def do_build_pao_hamiltonian ( data_controller ):
 
   ashape = (attr['nawf'],attr['nawf'],attr['nk1'],attr['nk2'],attr['nk3'],attr['nspin'])
   
-  arry['Hks'] = build_Hks(data_controller)
+  from .communication import allgather_array
+
+  # Hks is built on each rank's slice of k-points, then assembled on every rank
+  Hks = build_Hks(data_controller)
+  arry['Hks'] = np.moveaxis(allgather_array(np.moveaxis(Hks,2,0)), 0, 2)
+  Hks = None
+
+  if attr['acbn0']:
+    arry['Sks'] = np.moveaxis(allgather_array(np.moveaxis(arry['Sks'],2,0)), 0, 2)
 
   if attr['expand_wedge']:
     from .pao_sym import open_grid_wrapper
@@ -167,6 +185,7 @@ def do_build_pao_hamiltonian ( data_controller ):
 
 def do_Hks_to_HRs ( data_controller ):
   from scipy import fftpack as FFT
+  from .profiler import region
 
   arry,attr = data_controller.data_dicts()
 
@@ -177,4 +196,5 @@ def do_Hks_to_HRs ( data_controller ):
   if rank == 0:
     # Original k grid to R grid
     arry['HRs'] = np.zeros_like(arry['Hks'])
-    arry['HRs'] = FFT.ifftn(arry['Hks'], axes=[2,3,4])
+    with region('fft'):
+      arry['HRs'] = FFT.ifftn(arry['Hks'], axes=[2,3,4])
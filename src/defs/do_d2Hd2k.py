@@ -32,26 +32,13 @@
 # 
 
 import numpy as np
-import sys, time
-from numpy import linalg as LAN
-
-from mpi4py import MPI
-from mpi4py.MPI import ANY_SOURCE
-#from .load_balancing import *
-from .get_R_grid_fft import *
-from .communication import *
-from .constants import *
-from .perturb_split import *
-# initialize parallel execution
-comm=MPI.COMM_WORLD
+from scipy import fftpack as FFT
+from .perturb_split import perturb_split_batch
+from .communication import comm,gather_scatter
+
 rank = comm.Get_rank()
 size = comm.Get_size()
 
-try:
-    from cuda_fft import *
-except: pass
-from scipy import fftpack as FFT
-
 
 def do_d2Hd2k_ij(Hksp,Rfft,alat,npool,v_kp,bnd,degen):
     #----------------------
@@ -88,7 +75,7 @@ def do_d2Hd2k_ij(Hksp,Rfft,alat,npool,v_kp,bnd,degen):
     #############################################################################################
     num_n = Hksp.shape[0]
 
-    dvec_list=[]
+    rot_list=[]
 
     for ij in range(M_ij.shape[0]):
         dir_tmp=[]
@@ -116,34 +103,25 @@ def do_d2Hd2k_ij(Hksp,Rfft,alat,npool,v_kp,bnd,degen):
 
         d2Hksp = np.reshape(d2Hksp,(nawf,nawf,d2Hksp.shape[1],nspin),order='C')
 
-        tksp = np.zeros_like(d2Hksp)
-
-        #find non-degenerate set of psi(k) for d2H/d2k_ij
+        # d2H/d2k_ij in the basis diagonalizing it in the degenerate subspaces, for every k-point at once.
+        # The rotations are saved so that the second term in d2E/d2k is computed in the same basis
+        d2Hksp = np.moveaxis(d2Hksp,2,0)
+        tksp = np.empty_like(d2Hksp)
         for ispin in range(tksp.shape[3]):
-            isp_tmp=[]
-            for ik in range(tksp.shape[2]):
+            tksp[...,ispin],_,rotations = perturb_split_batch(d2Hksp[...,ispin],None,v_kp[...,ispin],degen[ispin])
+            dir_tmp.append({ik:r[0] for ik,r in rotations.items()})
+        rot_list.append(dir_tmp)
 
-                # we save dvec so that it can be used when calculating the second term in d2E/d2k
-                tksp[:,:,ik,ispin],_,dvec = perturb_split(d2Hksp[:,:,ik,ispin],
-                                                          d2Hksp[:,:,ik,ispin],
-                                                          v_kp[ik,:,:,ispin],
-                                                          degen[ispin][ik],return_v_k=True)
-
-                isp_tmp.append(dvec)
-            dir_tmp.append(isp_tmp)
-        dvec_list.append(dir_tmp)
-
-        
         # get the value for d2H/d2k
-        for ispin in range(d2Hksp.shape[3]):
-            for n in range(bnd):                
-                M_ij[ij,:,n,ispin] = tksp[n,n,:,ispin].real
+        for ispin in range(tksp.shape[3]):
+            for n in range(bnd):
+                M_ij[ij,:,n,ispin] = tksp[:,n,n,ispin].real
 
         comm.Barrier()
 
     Hksp_aux= d2Hksp = None    
 
-    return M_ij,dvec_list
+    return M_ij,rot_list
 
 
 
@@ -17,146 +17,144 @@
 #
 
 import numpy as np
-from mpi4py import MPI
-import scipy.optimize 
-import scipy.integrate
+from .mpi import MPI
 
-comm = MPI.COMM_WORLD
+from .communication import comm
 rank = comm.Get_rank()
 
+# Boltzmann constant in eV/K
+K_B = 8.617332478e-5
 
-def _fd_criterion_gen(threshold):
+# Fermi-Dirac occupations below _FD_THRESHOLD are set to 0, and above 1-_FD_THRESHOLD to 1
+_FD_THRESHOLD = 1e-8
+_FD_XMAX = np.log(1./_FD_THRESHOLD-1.)
 
-    def _fd_criterion(x):
-        return 1. / (np.exp(x) + 1.) - threshold
+# Tolerance on the chemical potential (eV)
+mu_tolerance = 1e-9
 
-    return _fd_criterion
 
-def FD(ene,mu,temp):
-  
-  _FD_THRESHOLD = 1e-8
-  _FD_XMAX = scipy.optimize.newton(_fd_criterion_gen(_FD_THRESHOLD), 0.)
-
-  temp_ev = temp*8.617332478e-5
+def FD ( ene, mu, temp ):
+  '''
+  Fermi-Dirac occupations of the energies ene for the chemical potentials mu
+  (broadcast together) at the temperature temp (K)
+  '''
+  dela = np.subtract(ene, mu)
   if temp == 0.:
-    dela = ene-mu
     nruter = np.where(dela < 0., 1., 0.)
     nruter[np.isclose(dela, 0.)] = .5
-  else:
-    x = (ene-mu) / temp_ev
-    nruter = np.where(x < 0., 1., 0.)
-    indices = np.logical_and(x > -_FD_XMAX, x < _FD_XMAX)
-    nruter[indices] = 1. / (np.exp(x[indices]) + 1.)
-  return nruter
-
-def calc_N(data_controller,ene,dos, mu, temp, dosweight=2.):
-
-  arry,attr = data_controller.data_dicts()
-  core_electrons = attr['core_electrons']
-
-  if temp == 0.: 
-    occ = np.where(ene < mu, 1., 0.)
-    occ[ene==mu] = .5
-  else:
-    occ = FD(ene, mu, temp)
-  dos_occ = dos*occ
-  return -dosweight * scipy.integrate.simps(dos_occ,ene)-core_electrons
-  
-def solve_for_mu(data_controller,ene,dos,N0,temp,refine=False,try_center=False,dosweight=2.):
-
-  _FD_THRESHOLD_GAP = 1e-3
-  _FD_XMAX_GAP = scipy.optimize.newton(_fd_criterion_gen(_FD_THRESHOLD_GAP), 0.)
-
-  dela = np.empty_like(ene)
-
-  if rank ==0:
-    for i,e in enumerate(ene):
-      dela[i] = (calc_N(data_controller,ene, dos, e, temp, dosweight)) + N0
-  
-    dela = np.abs(dela)
-    pos = dela.argmin()
-    mu = ene[pos]
-    center = False
-########################################
-#checking if dos is zero takes care not to include band gaps in the integral calculation
-#######################################
-
-    if dos[pos] == 0.:
-      lpos = -1
-      hpos = -1
-      for i in range(pos, -1, -1):
-        if dos[i] != 0.:
-          lpos = i
-          break
-      for i in range(pos, dos.size):
-        if dos[i] != 0.:
-           hpos = i
-           break
-      if -1 in (lpos, hpos):
-        raise ValueError("mu0 lies outside the range of band energies")
-      hene = ene[hpos]
-      lene = ene[lpos]
-      if (try_center and min(hene - mu, mu - lene) >= _FD_XMAX_GAP * temp / 2.):
-          pos = int(round(.5 * (lpos + hpos)))
-          mu = ene[pos]
-          center = True
-    if refine:
-      if center:
-        mu = .5 * (lene + hene)
-      else:
-        residual = calc_N(data_controller,ene, dos, mu, temp, dosweight) + N0
-        if np.isclose(residual, 0):
-           lpos = pos
-           hpos = pos
-        elif residual > 0:
-           lpos = pos
-           hpos = min(pos + 1, ene.size - 1)
-        else:
-           lpos = max(0, pos - 1)
-           hpos = pos
-        if hpos != lpos:
-           lmu = ene[lpos]
-           hmu = ene[hpos]
-
-           def calc_abs_residual(muarg):
-              return abs(calc_N(data_controller,ene, dos, muarg, temp, dosweight) + N0)
-           result = scipy.optimize.minimize_scalar(calc_abs_residual,bounds=(lmu, hmu),method="bounded")
-           mu = result.x
-    return mu
-
-def do_doping( data_controller, temps, ene, fname ):
+    return nruter
+  x = dela/(K_B*temp)
+  nruter = 1./(np.exp(np.clip(x, -_FD_XMAX, _FD_XMAX))+1.)
+  return np.where(x <= -_FD_XMAX, 1., np.where(x >= _FD_XMAX, 0., nruter))
+
+
+def trapezoid_weights ( ene ):
+  '''
+  Weights (ne,) of the trapezoidal rule on the ascending grid ene
+  '''
+  de = np.diff(ene)
+  w = np.zeros(ene.size, dtype=float)
+  w[:-1] += de/2.
+  w[1:] += de/2.
+  return w
+
+
+def solve_for_mu ( ene, dos, N0, temps, core_electrons=0., dosweight=2. ):
+  '''
+  Chemical potentials mu(T,N0) of every temperature and number of electrons, roots
+  of the number of electrons dosweight*int(dos*FD(mu,T)) + core_electrons, which
+  increases monotonically with mu. At T=0 it is the cumulative integral of the
+  DoS, inverted by interpolation. At T>0 the roots of all (T,N0) are bracketed
+  together by bisection, each step costing one vectorized Fermi-Dirac table
+  (pairs,ne). Where the number of electrons is flat around the target (mu in a
+  gap) the center of the plateau is taken.
+
+  Arguments:
+    ene (ndarray): Ascending energies (ne,)
+    dos (ndarray): Density of states (ne,)
+    N0 (ndarray): Numbers of electrons (nd,)
+    temps (ndarray): Temperatures in K (nT,)
+    core_electrons (float): Electrons below the energy window
+    dosweight (float): Occupation of each state
+
+  Returns:
+    mu (ndarray): Chemical potentials (nd,nT)
+  '''
+  N0 = np.atleast_1d(np.asarray(N0, dtype=float))
+  temps = np.atleast_1d(np.asarray(temps, dtype=float))
+  target = N0 - core_electrons
+
+  # Cumulative number of electrons at the energies of the grid
+  cumulative = np.concatenate(([0.], np.cumsum(dosweight*(dos[1:]+dos[:-1])*np.diff(ene)/2.)))
+  if np.any(target < 0.) or np.any(target > cumulative[-1]):
+    raise ValueError("mu0 lies outside the range of band energies")
+
+  mu = np.empty((N0.size,temps.size), dtype=float)
+
+  # Numbers of electrons within tol of each target are a plateau (a gap), whose center is taken
+  tol = 1e-10*max(cumulative[-1],1.)
+
+  # T=0: the grid points within the plateau of each target, or the interval crossing it
+  zero = (temps == 0.)
+  if np.any(zero):
+    lo = np.searchsorted(cumulative, target-tol, side='left')
+    hi = np.searchsorted(cumulative, target+tol, side='right')-1
+    gap = hi > lo
+    i = np.clip(lo, 1, ene.size-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      t = np.clip((target-cumulative[i-1])/(cumulative[i]-cumulative[i-1]), 0., 1.)
+    mu0 = np.where(gap, .5*(ene[lo]+ene[np.maximum(hi,lo)]), ene[i-1]+np.nan_to_num(t)*(ene[i]-ene[i-1]))
+    mu[:,zero] = mu0[:,None]
+
+  # T>0: bisection of the lower and upper ends of the plateau of every N0 at once. The
+  # occupations are 1 (0) below (above) _FD_XMAX*kT around mu, the electrons there are
+  # read from the cumulative sum of the weighted DoS: only a window of the grid is evaluated
+  wdos = dosweight*trapezoid_weights(ene)*dos
+  prefix = np.concatenate(([0.], np.cumsum(wdos)))
+  t = np.concatenate((target-tol, target+tol))
+  upper = np.arange(t.size) >= N0.size
+  de = (ene[-1]-ene[0])/max(ene.size-1,1)
+  niter = int(np.ceil(np.log2(max(ene[-1]-ene[0],mu_tolerance)/mu_tolerance)))
+
+  for iT in np.flatnonzero(~zero):
+    kT = K_B*temps[iT]
+    window = np.arange(int(np.ceil(2.*_FD_XMAX*kT/de))+3)
+    mlo = np.full(t.size, ene[0])
+    mhi = np.full(t.size, ene[-1])
+    for _ in range(niter):
+      mid = .5*(mlo+mhi)
+      lo = np.maximum(np.searchsorted(ene, mid-_FD_XMAX*kT, side='right')-1, 0)
+      idx = lo[:,None] + window
+      valid = idx < ene.size
+      idx = np.minimum(idx, ene.size-1)
+      N = prefix[lo] + np.sum(np.where(valid, wdos[idx]*FD(ene[idx], mid[:,None], temps[iT]), 0.), axis=1)
+      below = np.where(upper, N <= t, N < t)
+      mlo = np.where(below, mid, mlo)
+      mhi = np.where(below, mhi, mid)
+    mu[:,iT] = .25*(mlo+mhi).reshape(2,N0.size).sum(axis=0)
+
+  return mu
+
+
+def do_doping ( data_controller, temps, ene, fname ):
 
   arry,attr = data_controller.data_dicts()
-  temp_conv,omega_conv = 11604.52500617,1.481847093e-25
+  omega_conv = 1.481847093e-25
 
   if attr['smearing'] is None:
     dos = arry['dos']
   else:
     dos = arry['dosdk']
 
-  doping = attr['doping_conc']
+  doping = np.atleast_1d(attr['doping_conc'])
   nelec,omega = attr['nelec'],attr['omega']*omega_conv
 
-  margin = 9. * temps.max()
-  mumin = ene.min() + margin
-  mumax = ene.max() - margin
-  nT = len(temps)
-  mu = np.empty(nT)
-  dos_int = np.empty(nT)
-  msize = mu.size
-  Nc = np.empty(nT)
-  N = nelec - doping * omega
-
-  for iT,temp in enumerate(temps):
-
-    itemp = temp/temp_conv
-
-    if rank == 0:
-      mu[iT] = solve_for_mu(data_controller,ene,dos,N,temp,refine=True,try_center=True)
-
-    mu[iT] = comm.bcast(mu[iT], root=0)
-
-  fdope = '%s%s%s.dat'%(fname, 'n' if doping<0 else 'p', np.abs(doping))
-  data_controller.write_file_row_col(fdope, temps, mu)
+  # Numbers of electrons of every doping level, solved for every temperature at once
+  N = nelec - doping*omega
+  mu = solve_for_mu(ene, dos, N, temps, attr['core_electrons']) if rank==0 else None
+  mu = comm.bcast(mu, root=0)
+  arry['doping_mu'] = mu
 
-    
+  for idop,dop in enumerate(doping):
+    fdope = '%s%s%s.dat'%(fname, 'n' if dop<0 else 'p', np.abs(dop))
+    data_controller.write_file_row_col(fdope, temps, mu[idop])
@@ -17,19 +17,23 @@
 #
 
 import numpy as np
-from mpi4py import MPI
+from .mpi import MPI
+from .profiler import region
 
-comm = MPI.COMM_WORLD
+from .communication import comm
 rank = comm.Get_rank()
 
 def do_dos ( data_controller, emin, emax, ne, delta ):
+  from .broadening import broadened_sum
 
   arry,attr = data_controller.data_dicts()
+  backend = data_controller.backend
   bnd = attr['bnd']
   netot = attr['nkpnts']*bnd
   emax = np.amin(np.array([attr['shift'], emax]))
   arry['dos'] = np.empty((ne,), dtype=float)
-  # DOS calculation with gaussian smearing
+  # DOS calculation with gaussian smearing, eigenvalues binned on a histogram
+  # convolved with the gaussian (see broadening.py)
   ene = np.linspace(emin, emax, ne)
 
   if rank == 0 and attr['verbose']:
@@ -37,20 +41,19 @@ def do_dos ( data_controller, emin, emax, ne, delta ):
 
   for ispin in range(attr['nspin']):
 
-    dosaux = np.zeros((ne), order="C")
-
-    E_k = arry['E_k'][:,:bnd,ispin]
-
-    for n in range(ne):
-      dosaux[n] = np.sum(np.exp(-((ene[n]-E_k)/delta)**2))
+    # Blocks of k-points run on the workers of the backend
+    blocks = backend.blocks(arry['E_k'].shape[0])
+    E_k = [arry['E_k'][ks:ke,:bnd,ispin] for ks,ke in blocks]
+    dosaux = np.sum(backend.map(broadened_sum, E_k, [ene]*len(blocks), [delta]*len(blocks)), axis=0)
 
     dos = np.zeros((ne), dtype=float) if rank == 0 else None
 
-    comm.Reduce(dosaux,dos,op=MPI.SUM)
+    with region('reduction'):
+      comm.Reduce(dosaux,dos,op=MPI.SUM)
     dosaux = None
 
     if rank == 0:
-      dos *= float(bnd)/(float(netot)*np.sqrt(np.pi)*delta)
+      dos *= float(bnd)/float(netot)
       arry['dos'] = dos
     fdos = 'dos_%s.dat'%str(ispin)
     data_controller.write_file_row_col(fdos, ene, dos)
@@ -58,12 +61,10 @@ def do_dos ( data_controller, emin, emax, ne, delta ):
     #return dos if rank==0 else None
 
 def do_dos_adaptive ( data_controller, emin, emax, ne ):
-  from .smearing import gaussian, metpax
-
-  comm = MPI.COMM_WORLD
-  rank = comm.Get_rank()
+  from .broadening import broadened_sum,adaptive_classes
 
   arry,attr = data_controller.data_dicts()
+  backend = data_controller.backend
 
   # DOS calculation with adaptive smearing
   ene = np.linspace(emin, emax, ne)
@@ -80,19 +81,18 @@ def do_dos_adaptive ( data_controller, emin, emax, ne ):
     E_k = arry['E_k'][:,:bnd,ispin].reshape(arry['E_k'].shape[0]*bnd)
     delta = np.ravel(arry['deltakp'][:,:bnd,ispin], order='C')
 
-    dosaux = np.zeros((ne), dtype=float)
-
-    for n in range(ne):
-      if attr['smearing'] == 'gauss':
-        # adaptive Gaussian smearing
-        dosaux[n] = np.sum(gaussian(ene[n],E_k,delta))
+    # Widths binned in classes common to every rank
+    classes = adaptive_classes(comm, delta, ene)
 
-      elif attr['smearing'] == 'm-p':
-        # adaptive Methfessel and Paxton smearing
-        dosaux[n] = np.sum(metpax(ene[n],E_k,delta))
+    # Blocks of k-points run on the workers of the backend
+    blocks = [(ks*bnd,ke*bnd) for ks,ke in backend.blocks(arry['E_k'].shape[0])]
+    nb = len(blocks)
+    dosaux = np.sum(backend.map(broadened_sum, [E_k[s:e] for s,e in blocks], [ene]*nb, [delta[s:e] for s,e in blocks],
+                                [None]*nb, [attr['smearing']]*nb, [classes]*nb), axis=0)
 
     dos = np.zeros((ne), dtype=float) if rank==0 else None
-    comm.Reduce(dosaux, dos, op=MPI.SUM)
+    with region('reduction'):
+      comm.Reduce(dosaux, dos, op=MPI.SUM)
     dosaux = None
 
     if rank == 0:
@@ -102,3 +102,47 @@ def do_dos_adaptive ( data_controller, emin, emax, ne ):
     data_controller.write_file_row_col(fdosdk, ene,dos)
     data_controller.broadcast_single_array('dosdk', dtype=float)
 
+
+def do_dos_tetrahedra ( data_controller, emin, emax, ne ):
+  from .tetrahedra import tetrahedra_corners,tetrahedra_batch,dos_tetrahedra_block
+
+  arry,attr = data_controller.data_dicts()
+  backend = data_controller.backend
+
+  # DOS calculation with the linear tetrahedron method
+  emax = np.amin(np.array([attr['shift'], emax]))
+  ene = np.linspace(emin, emax, ne)
+  arry['dostetra'] = np.empty((ne,), dtype=float)
+
+  bnd = attr['bnd']
+
+  if rank == 0 and attr['verbose']:
+    print('Writing Tetrahedron DoS Files')
+
+  # Corners of the tetrahedra of the cells of this rank, the energies of those
+  # held by other ranks (across the boundaries of its slab) are exchanged
+  corners,halo = tetrahedra_corners(data_controller)
+  ncells = corners.shape[0]//6
+
+  for ispin in range(attr['nspin']):
+
+    E_k = np.ascontiguousarray(arry['E_k'][:,:bnd,ispin])
+    with region('halo'):
+      E = np.concatenate((E_k,halo.exchange(E_k)))
+
+    # Blocks of cells run on the workers of the backend
+    blocks = backend.blocks(ncells, tetrahedra_batch(bnd))
+    dosaux = np.sum(backend.map(dos_tetrahedra_block, [E[corners[6*cs:6*ce]] for cs,ce in blocks],
+                                [ene]*len(blocks)), axis=0)
+
+    dos = np.zeros((ne), dtype=float) if rank==0 else None
+    with region('reduction'):
+      comm.Reduce(dosaux, dos, op=MPI.SUM)
+    dosaux = None
+
+    if rank == 0:
+      dos /= 6.*attr['nkpnts']
+      arry['dostetra'] = dos
+    fdos = 'dostetra_%s.dat'%str(ispin)
+    data_controller.write_file_row_col(fdos, ene, dos)
+    data_controller.broadcast_single_array('dostetra', dtype=float)
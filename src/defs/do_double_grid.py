@@ -16,12 +16,22 @@
 # or http://www.gnu.org/copyleft/gpl.txt .
 #
 
+def zero_pad_fft ( HRs, nk, nfft ):
+  '''
+  Fourier transform of a batch of orbital pairs of H(R), zero padded from the nk to the nk+nfft grid
+  '''
+  from .zero_pad import zero_pad
+  from scipy import fftpack as FFT
+
+  return FFT.fftn(zero_pad(HRs,*nk,*nfft), axes=[1,2,3])
+
+
 # Fourier interpolation on extended grid (zero padding)
 def do_double_grid ( data_controller ):
   import numpy as np
-  from mpi4py import MPI
-  from .zero_pad import zero_pad
-  from scipy import fftpack as FFT
+  from .mpi import MPI
+  from functools import partial
+  from .profiler import region
   from .communication import scatter_full
 
   rank = MPI.COMM_WORLD.Get_rank()
@@ -45,9 +55,15 @@ def do_double_grid ( data_controller ):
   # Extended R to k (with zero padding)
   arrays['Hksp']  = np.empty((HRs.shape[0],nk1p,nk2p,nk3p,nspin), dtype=complex)
 
-  for ispin in range(nspin):
-    for n in range(HRs.shape[0]):
-      arrays['Hksp'][n,:,:,:,ispin] = FFT.fftn(zero_pad(HRs[n,:,:,:,ispin],nk1,nk2,nk3,nfft1,nfft2,nfft3))
+  # Orbital pairs are padded and transformed in batches (see memory_model.py), one batch per worker of the backend
+  nb = attr.get('fft_batch', 1)
+  fft = partial(zero_pad_fft, nk=(nk1,nk2,nk3), nfft=(nfft1,nfft2,nfft3))
+  with region('fft'):
+    for ispin in range(nspin):
+      for batches in data_controller.backend.rounds(snawf, nb):
+        Hks = data_controller.backend.map(fft, [HRs[s:e,:,:,:,ispin] for s,e in batches])
+        for (s,e),H in zip(batches, Hks):
+          arrays['Hksp'][s:e,:,:,:,ispin] = H
 
   attr['nk1'] = nk1p
   attr['nk2'] = nk2p
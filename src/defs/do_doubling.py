@@ -15,7 +15,7 @@ import scipy.linalg as la
 
 def doubling_HRs ( data_controller ):
     from scipy.fftpack import fftshift
-    from mpi4py import MPI
+    from .mpi import MPI
 
     if MPI.COMM_WORLD.Get_rank() != 0:
        return
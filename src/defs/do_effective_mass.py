@@ -19,7 +19,7 @@
 
 def do_effective_mass( data_controller,ene ):
 
-  from mpi4py import MPI
+  from .mpi import MPI
   import numpy as np
   from os.path import join
   from numpy import linalg as npl
@@ -27,7 +27,7 @@ def do_effective_mass( data_controller,ene ):
   from .get_K_grid_fft import get_K_grid_fft_crystal
   from os.path import join
 
-  comm = MPI.COMM_WORLD
+  from .communication import comm
   rank = comm.Get_rank()
 
   ary,attr = data_controller.data_dicts()
@@ -49,23 +49,38 @@ def get_degeneracies ( E_k, bnd ):
   return all_degen
 
 
-def do_pao_eigh ( data_controller ):
-  from .communication import gather_scatter
+def eigh_block ( Hks, nb ):
+  '''
+  Eigenvalues and eigenvectors of the Hamiltonians Hks (nk,nawf,nawf), diagonalized in batches of nb k-points
+  '''
   from numpy.linalg import eigh
-  from mpi4py import MPI
 
-  rank = MPI.COMM_WORLD.Get_rank()
+  E_k = np.empty(Hks.shape[:2], dtype=float)
+  v_k = np.empty(Hks.shape, dtype=complex)
+  for n in range(0, Hks.shape[0], nb):
+    E_k[n:n+nb],v_k[n:n+nb] = eigh(Hks[n:n+nb], UPLO='U')
+  return E_k,v_k
+
+
+def do_pao_eigh ( data_controller ):
+  from .profiler import region
 
   arrays,attributes = data_controller.data_dicts()
+  backend = data_controller.backend
 
   snktot,nawf,_,nspin = arrays['Hksp'].shape
 
   arrays['E_k'] = np.zeros((snktot,nawf,nspin), dtype=float)
   arrays['v_k'] = np.zeros((snktot,nawf,nawf,nspin), dtype=complex)
 
-  for ispin in range(nspin):
-    for n in range(snktot):
-      arrays['E_k'][n,:,ispin],arrays['v_k'][n,:,:,ispin] = eigh(arrays['Hksp'][n,:,:,ispin], UPLO='U')
+  # k-points are diagonalized in batches (see memory_model.py), blocks of k-points run on the workers of the backend
+  nb = attributes.get('eigh_batch', 1)
+  blocks = backend.blocks(snktot, nb)
+  with region('eigh'):
+    for ispin in range(nspin):
+      Hks = [arrays['Hksp'][ks:ke,:,:,ispin] for ks,ke in blocks]
+      for (ks,ke),(E_k,v_k) in zip(blocks, backend.map(eigh_block, Hks, [nb]*len(blocks))):
+        arrays['E_k'][ks:ke,:,ispin],arrays['v_k'][ks:ke,:,:,ispin] = E_k,v_k
 
   arrays['degen'] = get_degeneracies(arrays['E_k'], attributes['bnd'])
 
@@ -17,9 +17,10 @@
 #
 
 import numpy as np
-from mpi4py import MPI
+from .mpi import MPI
+from .profiler import region
 
-comm = MPI.COMM_WORLD
+from .communication import comm
 rank = comm.Get_rank()
 
 def do_dielectric_tensor ( data_controller, ene ):
@@ -73,24 +74,29 @@ def do_epsilon ( data_controller, ene, ispin, ipol, jpol ):
   ### TNeeds revision. Each processor is allocating zeros here, when only rank 0 needs it. 
   ### Can be condensed
   epsi = np.zeros(esize, dtype=float)
-  comm.Allreduce(epsi_aux, epsi, op=MPI.SUM)
+  with region('reduction'):
+    comm.Allreduce(epsi_aux, epsi, op=MPI.SUM)
   epsi_aux = None
 
   epsr = np.zeros(esize, dtype=float)
-  comm.Allreduce(epsr_aux, epsr, op=MPI.SUM)
+  with region('reduction'):
+    comm.Allreduce(epsr_aux, epsr, op=MPI.SUM)
   epsr_aux = None
 
   epsr_aux = epsr_kramerskronig(data_controller, ene, epsi)
   epsr0 = np.zeros(esize, dtype=float)
-  comm.Allreduce(epsr_aux, epsr0, op=MPI.SUM)
+  with region('reduction'):
+    comm.Allreduce(epsr_aux, epsr0, op=MPI.SUM)
   epsr_aux = None
 
   jdos = np.zeros(esize, dtype=float)
-  comm.Allreduce(jdos_aux, jdos, op=MPI.SUM)
+  with region('reduction'):
+    comm.Allreduce(jdos_aux, jdos, op=MPI.SUM)
   jods_aux = None
 
   count = np.zeros(1,dtype=float)
-  comm.Allreduce(count_aux, count, op=MPI.SUM)
+  with region('reduction'):
+    comm.Allreduce(count_aux, count, op=MPI.SUM)
   count_aux = None
 
   ieps = np.zeros(esize, dtype=float)
@@ -152,19 +158,24 @@ def eps_loop ( data_controller, ene, ispin, ipol, jpol):
 
   bndmax = bnd
 
-  for ik in range(fn.shape[0]):
-    for iband2 in range(bndmax):
-       for iband1 in range(bndmax):
+  # The momenta are read in blocks of k-points, pksp may be out-of-core
+  kchunks = data_controller.k_chunks(snktot, 2*bnd**2*arrays['pksp'].itemsize)
+
+  for ks,ke in kchunks:
+    pksp = arrays['pksp'][ks:ke,:,:bnd,:bnd,ispin][:,[ipol,jpol]]
+    for ik in range(ks,ke):
+      for iband2 in range(bndmax):
+        for iband1 in range(bndmax):
           if iband1 != iband2:
-             E_diff_nm = arrays['E_k'][ik,iband2,ispin] - arrays['E_k'][ik,iband1,ispin]
-             f_nm =  fn[ik,iband2]-fn[ik,iband1]
-             if np.abs(f_nm) > 2.e-3 and fn[ik,iband1] > 1.e-4 and fn[ik,iband2] < 2.0:
-                pksp2 = np.real(arrays['pksp'][ik,ipol,iband1,iband2,ispin]*arrays['pksp'][ik,jpol,iband2,iband1,ispin])
-                pksp2 *= attributes['alat']*BOHR_RADIUS_ANGS/(EPS0*RYTOEV)
-                epsi[:] +=  pksp2*delta*ene[:]*fn[ik,iband1]/(((E_diff_nm**2-ene[:]**2)**2+delta**2*ene[:]**2)*(E_diff_nm))
-                epsr[:] +=  pksp2*(E_diff_nm**2-ene[:]**2)*fn[ik,iband1]/(((E_diff_nm**2-ene[:]**2)**2+delta**2*ene[:]**2)*(E_diff_nm))
-                jdos[:] +=  delta*(fn[ik,iband1]-fn[ik,iband2])/(np.pi*((E_diff_nm-ene[:])**2+delta**2))
-                count[0] += (fn[ik,iband1]-fn[ik,iband2])
+            E_diff_nm = arrays['E_k'][ik,iband2,ispin] - arrays['E_k'][ik,iband1,ispin]
+            f_nm =  fn[ik,iband2]-fn[ik,iband1]
+            if np.abs(f_nm) > 2.e-3 and fn[ik,iband1] > 1.e-4 and fn[ik,iband2] < 2.0:
+              pksp2 = np.real(pksp[ik-ks,0,iband1,iband2]*pksp[ik-ks,1,iband2,iband1])
+              pksp2 *= attributes['alat']*BOHR_RADIUS_ANGS/(EPS0*RYTOEV)
+              epsi[:] +=  pksp2*delta*ene[:]*fn[ik,iband1]/(((E_diff_nm**2-ene[:]**2)**2+delta**2*ene[:]**2)*(E_diff_nm))
+              epsr[:] +=  pksp2*(E_diff_nm**2-ene[:]**2)*fn[ik,iband1]/(((E_diff_nm**2-ene[:]**2)**2+delta**2*ene[:]**2)*(E_diff_nm))
+              jdos[:] +=  delta*(fn[ik,iband1]-fn[ik,iband2])/(np.pi*((E_diff_nm-ene[:])**2+delta**2))
+              count[0] += (fn[ik,iband1]-fn[ik,iband2])
 
   if attributes['metal']:
     if rank == 0: print('NOT TESTED - needs different delta for intraband transitions and degauss from QE + check on units!!!')
@@ -185,12 +196,16 @@ def eps_loop ( data_controller, ene, ispin, ipol, jpol):
     elif smearing == 'm-p':
       fnF = metpax(arrays['E_k'][:,:bnd,ispin], Ef, arrays['deltakp'][:,:bnd,ispin])
 
-    for ik in range(fn.shape[0]):
-      for iband1 in range(bndmax):
-        pksp2 = np.real(arrays['pksp'][ik,ipol,iband1,iband1,ispin]*arrays['pksp'][ik,jpol,iband1,iband1,ispin])
-        pksp2 *= attributes['alat']*BOHR_RADIUS_ANGS/(EPS0*RYTOEV**3)
-        epsi[:] +=  pksp2*delta*ene[:]*fnF[ik,iband1]/((ene[:]**4+delta**2*ene[:]**2)*degauss)
-        epsr[:] -=  pksp2*fnF[ik,iband1]*ene[:]**2/((ene[:]**4+delta**2*ene[:]**2)*degauss)
+    for ks,ke in kchunks:
+      pksp = arrays['pksp'][ks:ke,:,:bnd,:bnd,ispin][:,[ipol,jpol]]
+      for ik in range(ks,ke):
+        for iband1 in range(bndmax):
+          pksp2 = np.real(pksp[ik-ks,0,iband1,iband1]*pksp[ik-ks,1,iband1,iband1])
+          pksp2 *= attributes['alat']*BOHR_RADIUS_ANGS/(EPS0*RYTOEV**3)
+          epsi[:] +=  pksp2*delta*ene[:]*fnF[ik,iband1]/((ene[:]**4+delta**2*ene[:]**2)*degauss)
+          epsr[:] -=  pksp2*fnF[ik,iband1]*ene[:]**2/((ene[:]**4+delta**2*ene[:]**2)*degauss)
+
+  pksp = None
 
   np.seterr(over=orig_over_err)
   return(epsi, epsr, jdos, count)
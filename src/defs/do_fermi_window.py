@@ -0,0 +1,121 @@
+#
+# PAOFLOW
+#
+# Utility to construct and operate on Hamiltonians from the Projections of DFT wfc on Atomic Orbital bases (PAO)
+#
+# Copyright (C) 2016-2018 ERMES group (http://ermes.unt.edu, mbn@unt.edu)
+#
+# Reference:
+# M. Buongiorno Nardelli, F. T. Cerasoli, M. Costa, S Curtarolo,R. De Gennaro, M. Fornari, L. Liyanage, A. Supka and H. Wang,
+# PAOFLOW: A utility to construct and operate on ab initio Hamiltonians from the Projections of electronic wavefunctions on
+# Atomic Orbital bases, including characterization of topological materials, Comp. Mat. Sci. vol. 143, 462 (2018).
+#
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `License'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#
+
+def window_bands ( E_k, emin, emax ):
+  '''
+  First and last (excluded) bands of each k-point with an energy in [emin,emax],
+  over every spin, from the eigenvalues E_k (nk,nb,nspin) ascending along the bands.
+  A k-point without such a band has first >= last.
+  '''
+  import numpy as np
+
+  first = np.amin(np.sum(E_k < emin, axis=1), axis=1)
+  last = np.amax(np.sum(E_k <= emax, axis=1), axis=1)
+  return first,last
+
+
+def window_index ( E_k, emin, emax ):
+  '''
+  Local k-points (nwk,) with a band in [emin,emax] and their first and last (excluded) such bands (nwk,2)
+  '''
+  import numpy as np
+
+  first,last = window_bands(E_k, emin, emax)
+  kpts = np.flatnonzero(last > first)
+  return kpts,np.stack((first[kpts],last[kpts]), axis=1)
+
+
+def do_fermi_window ( data_controller, emin, emax ):
+  '''
+  Build the compact index of the (k, band) pairs with an energy within [emin,emax]. The
+  bands of a k-point in the window are contiguous, so the index holds the local k-points
+  with at least one such band, 'window_k' (nwk,), and their first and last (excluded)
+  bands, 'window_bands' (nwk,2).
+
+  Arguments:
+    data_controller (DataController): The DataController
+    emin (float): The minimum energy of the window
+    emax (float): The maximum energy of the window
+
+  Returns:
+    None
+  '''
+  import numpy as np
+
+  arry,attr = data_controller.data_dicts()
+
+  arry['window_k'],arry['window_bands'] = window_index(arry['E_k'], emin, emax)
+  attr['fermi_window'] = (emin, emax)
+
+  npairs = data_controller.comm.allreduce(int(np.sum(np.diff(arry['window_bands'], axis=1))))
+  nkw = data_controller.comm.allreduce(arry['window_k'].size)
+  if data_controller.rank == 0 and attr['verbose']:
+    nb = arry['E_k'].shape[1]
+    print('Fermi window [%.3f,%.3f] eV: %d of %d k-points, %d of %d (k, band) pairs'%(emin,emax,nkw,attr['nkpnts'],npairs,attr['nkpnts']*nb))
+
+
+def window_kpoints ( arry, n ):
+  '''
+  Local k-points at which the band n lies in the Fermi window (see do_fermi_window),
+  or every k-point when no window was built
+  '''
+  if 'window_k' not in arry:
+    return slice(None)
+  bands = arry['window_bands']
+  return arry['window_k'][(bands[:,0] <= n) & (n < bands[:,1])]
+
+
+def transport_margin ( data_controller, emin, emax, tmax, smearing ):
+  '''
+  Distances (eV) below emin and above emax within which states contribute to the Boltzmann
+  kernels on the transport energies [emin,emax] at temperatures up to tmax (K): the thermal
+  window of the Fermi-Dirac occupations of do_doping and, with adaptive smearing, the support
+  of the broadening of the widest state between each edge of the Fermi window and the transport
+  energies. These states stand for those just beyond the window, whose widths are not computed.
+  The Fermi window must extend this far beyond the transport energies. Must be called by every rank.
+
+  Arguments:
+    data_controller (DataController): The DataController
+    emin, emax (float): Range of the transport energies
+    tmax (float): Highest temperature
+    smearing (str): Smearing of the transport, None for none
+
+  Returns:
+    lower, upper (float): Margins below emin and above emax
+  '''
+  import numpy as np
+  from .mpi import MPI
+  from .broadening import support
+  from .do_doping import K_B,_FD_XMAX
+
+  arry,attr = data_controller.data_dicts()
+
+  thermal = _FD_XMAX*K_B*tmax
+  if smearing is None:
+    return thermal,thermal
+
+  wmin,wmax = attr['fermi_window']
+  E = arry['E_k'][:,:attr['bnd']]
+  deltakp = arry['deltakp'][:,:attr['bnd']]
+
+  margins = []
+  for lo,hi in [(wmin,emin), (emax,wmax)]:
+    states = (E >= lo) & (E <= hi)
+    wlocal = (np.amax(deltakp[states]) if np.any(states) else 0.)
+    margins.append(max(thermal, support*data_controller.comm.allreduce(wlocal, op=MPI.MAX)))
+  return tuple(margins)
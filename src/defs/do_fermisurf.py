@@ -19,11 +19,11 @@
 
 def do_fermisurf ( data_controller ):
   import numpy as np
-  from mpi4py import MPI
+  from .mpi import MPI
   from os.path import join
   from .communication import gather_full
 
-  comm = MPI.COMM_WORLD
+  from .communication import comm
   rank = comm.Get_rank()
 
   arry,attr = data_controller.data_dicts()
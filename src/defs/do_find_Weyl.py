@@ -26,24 +26,13 @@
 # 
 
 
-import scipy.optimize as so
-#import matplotlib.pyplot as plt
-from scipy import fftpack as FFT
-import numpy as np
-import cmath
-import sys
-import scipy
-from scipy import fftpack as FFT
-from mpi4py import MPI
-from mpi4py.MPI import ANY_SOURCE
 import os
-import scipy.optimize as OP
+import numpy as np
 from numpy import linalg as LAN
 from .communication import gather_full, scatter_full
-from numpy import linalg as LAN
 
 # initialize parallel execution
-comm=MPI.COMM_WORLD
+from .communication import comm
 rank = comm.Get_rank()
 size = comm.Get_size()
 
@@ -202,6 +191,7 @@ def find_weyl ( data_controller, test_rad, search_grid ):
       ofo.write(wcs)
 
 def find_min ( HRs, nelec, R, a_vectors, symf, verbose, search_grid=[8,8,8] ):
+  import scipy.optimize as OP
 
   snk = tuple(search_grid[i] for i in range(3))
   #snk2 = search_grid[1]
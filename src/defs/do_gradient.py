@@ -31,9 +31,32 @@
 # optical spectroscopy from first principles, Phys. Rev. B 94 165166 (2016).
 # 
 
-def do_gradient ( data_controller ):
+def gradient_fft ( Hks, Rfft, alat ):
+  '''
+  H(R) and the Fourier transforms of R*H(R) of a batch of orbital pairs
+
+  Arguments:
+    Hks (ndarray): H(k) of the batch, (nb,nk1,nk2,nk3)
+    Rfft (ndarray): R vectors of the FFT grid, (nk1,nk2,nk3,3)
+    alat (float): Lattice parameter
+
+  Returns:
+    HRs (ndarray): i*alat*H(R), (nb,nk1,nk2,nk3)
+    dHks (ndarray): Gradient of H(k), (nb,nk1,nk2,nk3,3)
+  '''
   import numpy as np
   from scipy import fftpack as FFT
+
+  HRs = FFT.ifftn(Hks, axes=[1,2,3])*1.0j*alat
+  dHks = np.empty(Hks.shape+(3,), dtype=complex)
+  for l in range(3):
+    dHks[...,l] = FFT.fftn(Rfft[:,:,:,l]*HRs, axes=[1,2,3])
+  return HRs,dHks
+
+
+def do_gradient ( data_controller ):
+  import numpy as np
+  from .profiler import region
   from .get_R_grid_fft import get_R_grid_fft
 
   arry,attr = data_controller.data_dicts()
@@ -49,17 +72,25 @@ def do_gradient ( data_controller ):
   get_R_grid_fft(data_controller, nk1, nk2, nk3)
 
   arry['dHksp'] = np.empty((snawf,nk1,nk2,nk3,3,nspin), dtype=complex, order='C')
-  for ispin in range(nspin):
-    for n in range(snawf):
-      ########################################
-      ### real space grid replaces k space ###
-      ########################################
+  # Orbital pairs are transformed in batches (see memory_model.py), one batch per worker of the backend.
+  # The real space grid replaces the k space one in Hksp
+  nb = attr.get('fft_batch', 1)
+  backend = data_controller.backend
+  with region('fft'):
+    for ispin in range(nspin):
       if attr['use_cuda']:
-        arry['Hksp'][n,:,:,:,ispin] = cuda_ifftn(arry['Hksp'][n,:,:,:,ispin])*1.0j*attr['alat']
-      else:
-        arry['Hksp'][n,:,:,:,ispin] = FFT.ifftn(arry['Hksp'][n,:,:,:,ispin])*1.0j*attr['alat']
-
-      # Compute R*H(R)
-      for l in range(3):
-        arry['dHksp'][n,:,:,:,l,ispin] = FFT.fftn(arry['Rfft'][:,:,:,l]*arry['Hksp'][n,:,:,:,ispin])
+        from scipy import fftpack as FFT
+        from .cuda_fft import cuda_ifftn
+        # cuda_ifftn transforms the leading axes of its input, the orbital pairs are transformed one at a time
+        for n in range(snawf):
+          arry['Hksp'][n,:,:,:,ispin] = cuda_ifftn(arry['Hksp'][n,:,:,:,ispin])*1.0j*attr['alat']
+          for l in range(3):
+            arry['dHksp'][n,:,:,:,l,ispin] = FFT.fftn(arry['Rfft'][:,:,:,l]*arry['Hksp'][n,:,:,:,ispin])
+        continue
 
+      for batches in backend.rounds(snawf, nb):
+        grads = backend.map(gradient_fft, [arry['Hksp'][s:e,:,:,:,ispin] for s,e in batches],
+                                          [arry['Rfft']]*len(batches), [attr['alat']]*len(batches))
+        for (s,e),(HRs,dHks) in zip(batches, grads):
+          arry['Hksp'][s:e,:,:,:,ispin] = HRs
+          arry['dHksp'][s:e,:,:,:,:,ispin] = dHks
@@ -16,20 +16,148 @@
 # or http://www.gnu.org/copyleft/gpl.txt .
 #
 
-def do_momentum ( data_controller ):
+def momentum_block ( dHksp, v_k, degen, bands=None ):
+  '''
+  Momentum matrices of a block of k-points, from its dHksp (nk,3,nawf,nawf,nspin),
+  eigenvectors v_k (nk,nawf,nawf,nspin) and degeneracies degen[ispin][ik], for
+  the lowest 'bands' bands (None for all). The three directions are split at once,
+  each in the basis diagonalizing its own degenerate subspaces. Also returns, for
+  each spin, the rotations of these subspaces (see perturb_split_batch) indexed by
+  k-point in the block.
+  '''
   import numpy as np
-  from .perturb_split import perturb_split
+  from .perturb_split import perturb_split_batch
+
+  nb = dHksp.shape[2] if bands is None else bands
+  pksp = np.empty(dHksp.shape[:2]+(nb,nb,dHksp.shape[4]), dtype=complex)
+  rotations = []
+  for ispin in range(dHksp.shape[4]):
+    pksp[...,ispin],_,rot = perturb_split_batch(dHksp[...,ispin], None, v_k[...,ispin], degen[ispin], bands)
+    rotations.append(rot)
+  return pksp,rotations
+
+
+def velocity_block ( dHksp, v_k, degen, bands=None ):
+  '''
+  Diagonal of the momentum matrices of momentum_block (nk,3,bands,nspin), real, at
+  the cost of a single product of dHksp with the eigenvectors of the bands
+  '''
+  import numpy as np
+  from .perturb_split import perturb_split_diagonal
+
+  nb = dHksp.shape[2] if bands is None else bands
+  velkp = np.empty(dHksp.shape[:2]+(nb,dHksp.shape[4]), dtype=float)
+  for ispin in range(dHksp.shape[4]):
+    velkp[...,ispin] = perturb_split_diagonal(dHksp[...,ispin], v_k[...,ispin], degen[ispin], bands)
+  return velkp
+
+
+def momentum_diagonal ( arry, ks, ke ):
+  '''
+  Real diagonal of the momenta (the band velocities) of the k-points ks to ke, (nk,3,nb,nspin),
+  read from pksp or, when gradient_and_momenta stored only the diagonal, from velkp
+  '''
+  import numpy as np
+
+  if 'pksp' not in arry:
+    return np.array(arry['velkp'][ks:ke])
+  nb = arry['pksp'].shape[2]
+  return np.real(arry['pksp'][ks:ke][:,:,range(nb),range(nb)])
+
+
+def momenta_bands ( arry ):
+  '''
+  Number of bands of the stored momenta
+  '''
+  return (arry['pksp'] if 'pksp' in arry else arry['velkp']).shape[2]
+
+
+def do_momentum ( data_controller, bands=None, diagonal_only=False ):
+  '''
+  Compute the momenta from dHksp, the eigenvectors and their degeneracies. When a
+  Fermi window was built (see do_fermi_window) only its k-points are computed
+
+  Arguments:
+    data_controller (DataController): The DataController
+    bands (int): Number of lowest bands whose momenta are stored, None for all
+    diagonal_only (bool): If True only the diagonal of the momenta is computed, and stored in 'velkp' (nk,3,bands,nspin) rather than 'pksp' (nk,3,bands,bands,nspin)
+
+  Returns:
+    None
+  '''
+  import numpy as np
+  from .profiler import region
 
   arry,attr = data_controller.data_dicts()
+  backend = data_controller.backend
 
   nktot,_,nawf,nawf,nspin = arry['dHksp'].shape
+  nb = nawf if bands is None else min(bands, nawf)
+  bands = None if nb == nawf else nb
+
+  for k in ['pksp', 'velkp', 'degen_rot']:
+    arry.pop(k, None)
+
+  if diagonal_only:
+    kernel = velocity_block
+    arry['velkp'] = data_controller.ooc_array('velkp', (nktot,3,nb,nspin), float)
+  else:
+    kernel = momentum_block
+    arry['pksp'] = data_controller.ooc_array('pksp', (nktot,3,nb,nb,nspin), arry['dHksp'].dtype)
+
+  # Rotations of the degenerate subspaces of each direction, [ispin]{ik:[[rotation per subspace] per direction]},
+  # reused by the anomalous Hall conductivity to build its operators from pksp when it holds every band
+  if kernel is momentum_block and bands is None:
+    arry['degen_rot'] = [{} for _ in range(nspin)]
 
-  arry['pksp'] = np.zeros_like(arry['dHksp'])
+  # Only the k-points of the Fermi window (see do_fermi_window) are computed, the momenta of the others remain zero
+  kpts = arry['window_k'] if 'window_k' in arry else np.arange(nktot)
+  attr['momenta_window'] = attr['fermi_window'] if 'window_k' in arry else None
+  # Counts the computations of the momenta, the widths derived from them record it (see pair_widths)
+  attr['momenta_generation'] = attr.get('momenta_generation', 0) + 1
+
+  # Blocks of k-points are read and written at once, dHksp and pksp may be out-of-core
+  for ks,ke in data_controller.k_chunks(kpts.size, 2*arry['dHksp'][:1].nbytes+arry['v_k'][:1].nbytes):
+    kc = kpts[ks:ke]
+    dHksp = np.array(arry['dHksp'][kc])
+    v_k = np.array(arry['v_k'][kc])
+    blocks = backend.blocks(ke-ks)
+    with region('perturb_split'):
+      pksp = backend.map(kernel, [dHksp[bs:be] for bs,be in blocks],
+                                 [v_k[bs:be] for bs,be in blocks],
+                                 [[[d[ik] for ik in kc[bs:be]] for d in arry['degen']] for bs,be in blocks],
+                                 [bands]*len(blocks))
+    for (bs,be),p in zip(blocks, pksp):
+      if diagonal_only:
+        arry['velkp'][kc[bs:be]] = p
+        continue
+      arry['pksp'][kc[bs:be]] = p[0]
+      if 'degen_rot' in arry:
+        for ispin,rot in enumerate(p[1]):
+          arry['degen_rot'][ispin].update({int(kc[bs+ik]):r for ik,r in rot.items()})
+  dHksp = v_k = pksp = None
+
+
+def require_momenta ( data_controller, stage, matrices=False, all_bands=False, all_kpoints=False ):
+  '''
+  Raise a ValueError if the momenta stored by gradient_and_momenta, or the adaptive
+  smearing widths derived from them, do not cover what 'stage' reads
+
+  Arguments:
+    data_controller (DataController): The DataController
+    stage (str): Name of the stage, for the message
+    matrices (bool): The stage reads the momentum matrices, not only their diagonal
+    all_bands (bool): The stage reads the adaptive smearing widths of every band and k-point, not only of the 'bnd' projectable bands or of the Fermi window
+    all_kpoints (bool): The stage reads the momenta, or the widths, of every k-point, not only of the Fermi window (see do_fermi_window)
+
+  Returns:
+    None
+  '''
+  arry,attr = data_controller.data_dicts()
 
-  for ispin in range(nspin):
-    for ik in range(nktot):
-      for l in range(3):
-         arry['pksp'][ik,l,:,:,ispin],_ = perturb_split(arry['dHksp'][ik,l,:,:,ispin], 
-                                                        arry['dHksp'][ik,l,:,:,ispin], 
-                                                        arry['v_k'][ik,:,:,ispin],
-                                                        arry['degen'][ispin][ik])
+  if matrices and 'pksp' not in arry:
+    raise ValueError('%s requires the momentum matrices, call gradient_and_momenta without diagonal_only'%stage)
+  if all_bands and 'deltakp' in arry and arry['deltakp'].shape[1] < attr['nawf']:
+    raise ValueError('%s requires the adaptive smearing widths of all %d bands, call gradient_and_momenta without bands'%(stage,attr['nawf']))
+  if (all_bands or all_kpoints) and attr.get('momenta_window') is not None:
+    raise ValueError('%s requires the momenta of every k-point, call gradient_and_momenta before fermi_window'%stage)
@@ -17,63 +17,99 @@
 #
 
 import numpy as np
-from mpi4py import MPI
+from .mpi import MPI
+from .profiler import region
 
-comm = MPI.COMM_WORLD
+from .communication import comm
 rank = comm.Get_rank()
 
-def do_pdos ( data_controller, emin, emax, ne, delta ):
+def pdos_weights ( v_k, ks, ke, ispin ):
+  '''
+  Projections |v_k|**2 of the states of the k-points ks to ke on the orbitals (nk*nbnd,nawf)
+  '''
+  v = v_k[ks:ke,:,:,ispin]
+  return np.ascontiguousarray(np.transpose(np.real(v*np.conj(v)), (0,2,1))).reshape(-1,v.shape[1])
+
+
+def write_pdos ( data_controller, label, ene, pdos, ispin, columns ):
+  '''
+  Write the PDoS of the orbitals and their sum, either one file per orbital
+  ('m_label_ispin.dat' and 'label_sum_ispin.dat') or a single file ('label_ispin.dat')
+  whose columns are the energies, the PDoS of every orbital and their sum
+
+  Arguments:
+    data_controller (DataController): The DataController
+    label (str): Label of the files (e.g. 'pdos', 'pdosdk')
+    ene (ndarray): Energies (ne,)
+    pdos (ndarray): PDoS of the orbitals on rank 0 (nawf,ne), None on the other ranks
+    ispin (int): Spin index
+    columns (bool): If True write the single file
+
+  Returns:
+    None
+  '''
+  nawf = data_controller.data_attributes['nawf']
+  pdos_sum = np.sum(pdos, axis=0) if rank==0 else None
+
+  if columns:
+    fpdos = '%s_%d.dat'%(label,ispin)
+    data_controller.write_file_columns(fpdos, ene, (np.vstack((pdos,pdos_sum)) if rank==0 else None))
+    return
+
+  # Rank 0 writes every file before the ranks synchronize
+  for m in range(nawf):
+    fpdos = '%d_%s_%d.dat'%(m,label,ispin)
+    data_controller.write_file_row_col(fpdos, ene, (pdos[m] if rank==0 else None), barrier=False)
+
+  fpdos = '%s_sum_%d.dat'%(label,ispin)
+  data_controller.write_file_row_col(fpdos, ene, pdos_sum)
+
+
+def do_pdos ( data_controller, emin, emax, ne, delta, columns=False ):
+  from .broadening import broadened_sum
 
   arrays,attributes = data_controller.data_dicts()
+  backend = data_controller.backend
 
   nawf = attributes['nawf']
   nspin = attributes['nspin']
   nktot = attributes['nkpnts']
 
-  # PDOS calculation with gaussian smearing
+  # PDOS calculation with gaussian smearing, eigenvalues binned on a histogram
+  # weighted by the projections, convolved with the gaussian (see broadening.py)
 
   emax = np.amin(np.array([attributes['shift'], emax]))
   ene = np.linspace(emin, emax, ne)
 
   for ispin in range(nspin):
 
-    pdosaux = np.zeros((nawf,ne), dtype=float)
-    v_kaux = np.real(np.abs(arrays['v_k'][:,:,:,ispin])**2)
-
-    E_k = arrays['E_k'][:,:,ispin]
-
-    for n in range(ne):
-      taux = np.exp(-((ene[n]-E_k)/delta)**2)/np.sqrt(np.pi)
-      for m in range(nawf):
-        pdosaux[m,n] += np.sum(taux*v_kaux[:,m,:])
+    # Blocks of k-points run on the workers of the backend
+    blocks = backend.blocks(arrays['E_k'].shape[0])
+    nb = len(blocks)
+    pdosaux = np.sum(backend.map(broadened_sum, [arrays['E_k'][ks:ke,:,ispin] for ks,ke in blocks], [ene]*nb, [delta]*nb,
+                                 [pdos_weights(arrays['v_k'],ks,ke,ispin) for ks,ke in blocks]), axis=0)
+    pdosaux = np.ascontiguousarray(pdosaux.T)
 
     pdos = (np.zeros((nawf,ne),dtype=float) if rank==0 else None)
 
-    comm.Reduce(pdosaux, pdos, op=MPI.SUM)
+    with region('reduction'):
+      comm.Reduce(pdosaux, pdos, op=MPI.SUM)
     pdosaux = None
 
     if rank == 0:
-      pdos /= (float(nktot)*np.sqrt(np.pi)*delta)
-
-    pdos_sum = (np.zeros(ne, dtype=float) if rank==0 else None)
+      pdos /= float(nktot)*np.sqrt(np.pi)
 
-    for m in range(nawf):
-      if rank == 0:
-        pdos_sum += pdos[m]
-      fpdos = '%d_pdos_%d.dat'%(m,ispin)
-      data_controller.write_file_row_col(fpdos, ene, (pdos[m] if rank==0 else None))
+    write_pdos(data_controller, 'pdos', ene, pdos, ispin, columns)
 
-    fpdos = 'pdos_sum_%d.dat'%ispin
-    data_controller.write_file_row_col(fpdos, ene, pdos_sum)
 
-
-def do_pdos_adaptive ( data_controller, emin, emax, ne ):
-  from .smearing import metpax, gaussian
+def do_pdos_adaptive ( data_controller, emin, emax, ne, columns=False ):
+  from .broadening import broadened_sum,adaptive_classes
 
   arrays = data_controller.data_arrays
   attributes = data_controller.data_attributes
+  backend = data_controller.backend
 
-  # PDoS Calculation with Gaussian Smearing
+  # PDoS Calculation with adaptive smearing, binned in classes of widths (see broadening.py)
   emax = np.amin(np.array([attributes['shift'], emax]))
   ene = np.linspace(emin, emax, ne)
 
@@ -81,38 +117,66 @@ def do_pdos_adaptive ( data_controller, emin, emax, ne ):
 
   for ispin in range(attributes['nspin']):
 
-    E_k = np.real(arrays['E_k'][:,:,ispin])
+    delta = arrays['deltakp'][:,:,ispin]
+    classes = adaptive_classes(comm, delta, ene)
 
-    pdosaux = np.zeros((nawf,ne), dtype=float)
+    # Blocks of k-points run on the workers of the backend
+    blocks = backend.blocks(arrays['E_k'].shape[0])
+    nb = len(blocks)
+    pdosaux = np.sum(backend.map(broadened_sum, [np.real(arrays['E_k'][ks:ke,:,ispin]) for ks,ke in blocks], [ene]*nb,
+                                 [delta[ks:ke] for ks,ke in blocks], [pdos_weights(arrays['v_k'],ks,ke,ispin) for ks,ke in blocks],
+                                 [attributes['smearing']]*nb, [classes]*nb), axis=0)
+    pdosaux = np.ascontiguousarray(pdosaux.T)
 
+    pdos = (np.zeros((nawf,ne), dtype=float) if rank==0 else None)
+
+    with region('reduction'):
+      comm.Reduce(pdosaux, pdos, op=MPI.SUM)
+    pdosaux = None
+
+    if rank == 0:
+      pdos /= float(attributes['nkpnts'])
+
+    write_pdos(data_controller, 'pdosdk', ene, pdos, ispin, columns)
+
+
+def do_pdos_tetrahedra ( data_controller, emin, emax, ne, columns=False ):
+  from .tetrahedra import tetrahedra_corners,tetrahedra_batch,pdos_tetrahedra_block
+
+  arrays,attributes = data_controller.data_dicts()
+  backend = data_controller.backend
+
+  # PDoS calculation with the linear tetrahedron method
+  emax = np.amin(np.array([attributes['shift'], emax]))
+  ene = np.linspace(emin, emax, ne)
+
+  nawf = attributes['nawf']
+
+  corners,halo = tetrahedra_corners(data_controller)
+  ncells = corners.shape[0]//6
+
+  for ispin in range(attributes['nspin']):
+
+    E_k = np.ascontiguousarray(arrays['E_k'][:,:,ispin])
     v_kaux = np.real(np.abs(arrays['v_k'][:,:,:,ispin])**2)
 
-    taux = np.zeros((arrays['deltakp'].shape[0],nawf), dtype=float)
+    # Energies and projections of the corners held by other ranks
+    with region('halo'):
+      E = np.concatenate((E_k,halo.exchange(E_k)))
+      v_kaux = np.concatenate((v_kaux,halo.exchange(v_kaux)))
 
-    for n in range (ne):
-      if attributes['smearing'] == 'gauss':
-        taux = gaussian(ene[n], E_k, arrays['deltakp'][:,:,ispin]) 
-      elif attributes['smearing'] == 'm-p':
-        taux = metpax(ene[n], E_k, arrays['deltakp'][:,:,ispin])
-      for i in range(nawf):
-          # Adaptive Gaussian Smearing
-          pdosaux[i,n] += np.sum(taux*v_kaux[:,i,:])
+    blocks = backend.blocks(ncells, tetrahedra_batch(nawf*(nawf+1)))
+    pdosaux = np.sum(backend.map(pdos_tetrahedra_block, [E[corners[6*cs:6*ce]] for cs,ce in blocks],
+                                 [v_kaux[corners[6*cs:6*ce]] for cs,ce in blocks], [ene]*len(blocks)), axis=0)
+    v_kaux = None
 
     pdos = (np.zeros((nawf,ne), dtype=float) if rank==0 else None)
 
-    comm.Reduce(pdosaux, pdos, op=MPI.SUM)
+    with region('reduction'):
+      comm.Reduce(np.ascontiguousarray(pdosaux), pdos, op=MPI.SUM)
     pdosaux = None
 
     if rank == 0:
-      pdos /= float(attributes['nkpnts'])
-
-    pdos_sum = (np.zeros(ne, dtype=float) if rank==0 else None)
-
-    for m in range(nawf):
-      if rank == 0:
-        pdos_sum += pdos[m]
-      fpdos = '%d_pdosdk_%d.dat'%(m,ispin)
-      data_controller.write_file_row_col(fpdos, ene, (pdos[m] if rank==0 else None))
+      pdos /= 6.*attributes['nkpnts']
 
-    fpdos = 'pdosdk_sum_%d.dat'%ispin
-    data_controller.write_file_row_col(fpdos, ene, pdos_sum)
+    write_pdos(data_controller, 'pdostetra', ene, pdos, ispin, columns)
@@ -16,15 +16,17 @@
 # or http://www.gnu.org/copyleft/gpl.txt .
 
 import numpy as np
-from mpi4py import MPI
+from .mpi import MPI
 
 def build_Pn ( nawf, nbnds, nkpnts, nspin, U ):
-  Pn = 0.
+  # U holds this rank's slice of k-points; the partial sums are reduced over all ranks
+  Pn = np.zeros(nbnds, dtype=float)
   for ispin in range(nspin):
-    for ik in range(nkpnts):
+    for ik in range(U.shape[2]):
       UU = np.transpose(U[:,:,ik,ispin]) #transpose of U. Now the columns of UU are the eigenvector of length nawf
       Pn += np.real(np.sum(np.conj(UU)*UU,axis=0))/nkpnts/nspin
-  return Pn
+  from .communication import comm
+  return comm.allreduce(Pn, op=MPI.SUM)
 
 
 def do_projectability ( data_controller ):
@@ -38,10 +40,11 @@ def do_projectability ( data_controller ):
 
   pthr,shift = attr['pthr'],attr['shift']
 
+  Pn = build_Pn(attr['nawf'], attr['nbnds'], attr['nkpnts'], attr['nspin'], arry['U'])
+
   if rank != 0:
     attr['shift'] = None
   else:
-    Pn = build_Pn(attr['nawf'], attr['nbnds'], attr['nkpnts'], attr['nspin'], arry['U'])
 
     if attr['verbose']:
       print('Projectability vector ', Pn)
@@ -17,13 +17,13 @@
 #
 
 import numpy as np
-from mpi4py import MPI
+from .mpi import MPI
 
 from .do_atwfc_proj import *
 from .write2xsf import write2xsf
 from .communication import load_balancing
 
-comm = MPI.COMM_WORLD
+from .communication import comm
 rank = comm.Get_rank()
 
 def do_density ( data_controller, nr1, nr2, nr3 ):
@@ -40,11 +40,12 @@ def do_density ( data_controller, nr1, nr2, nr3 ):
   ini_ik,end_ik = load_balancing(comm.Get_size(), rank, attr['nkpnts'])
   
   basis = arry['basis']
+  rtable = build_radial_table(basis)
   eps = 1.e-5
   for ispin in range(attr['nspin']):
     for ik in range(ini_ik,end_ik):
       gkspace = calc_gkspace(data_controller,ik,gamma_only=False)
-      atwfcgk = calc_atwfc_k(basis,gkspace)
+      atwfcgk = calc_atwfc_k(basis,gkspace,rtable=rtable)
       oatwfcgk = ortho_atwfc_k(atwfcgk)
       atwfcr = fft_allwfc_G2R(oatwfcgk,gkspace, nr1, nr2, nr3, attr['omega'])
       for nb in range(attr['bnd']):
@@ -21,10 +21,10 @@
 def do_spin_texture ( data_controller ):
   import os
   import numpy as np
-  from mpi4py import MPI
+  from .mpi import MPI
   from .communication import gather_full
 
-  comm = MPI.COMM_WORLD
+  from .communication import comm
   rank = comm.Get_rank()
 
   arrays = data_controller.data_arrays
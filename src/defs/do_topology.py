@@ -22,14 +22,14 @@ from numpy import linalg as npl
 
 # Compute Z2 invariant and topological properties on a selected path in the BZ
 def do_topology ( data_controller ):
-  from mpi4py import MPI
+  from .mpi import MPI
   from scipy.fftpack import fftshift
   from .constants import LL, ANGSTROM_AU
   from .get_R_grid_fft import get_R_grid_fft
   from .communication import scatter_full,gather_full
   from .kpnts_interpolation_mesh import kpnts_interpolation_mesh
 
-  comm = MPI.COMM_WORLD
+  from .communication import comm
   rank = comm.Get_rank()
 
   arrays,attributes = data_controller.data_dicts()
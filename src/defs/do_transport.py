@@ -17,7 +17,38 @@
 #
 
 
-def do_transport ( data_controller, temps, ene, velkp, channels, weights, do_hall, write_to_file, save_tensors ):
+def hall_trace ( L0, L0_hall ):
+  '''
+  Trace of the Hall tensor (SI units) at each energy, from the conductivity L0 (3,3,ne)
+  and the Hall conductivity L0_hall (3,3,3,ne), both divided by the cell volume
+  '''
+  import numpy as np
+  from numpy import linalg as npl
+
+  hall_SI = 9.248931724005307e-13
+
+  esize = L0.shape[2]
+  R_hall = np.zeros((3,3,3,esize), dtype=float)
+  R_hall_trace = np.zeros((esize), dtype=float)
+  for n in range(esize):
+    try:
+      for r in range(3):
+        R_hall[:,:,r,n] = npl.inv(L0[:,:,n]) @ L0_hall[:,:,r,n] @ npl.inv(L0[:,:,n])
+        #----------------------   
+        # The equivalent to the trace of the Hall tensor is an average
+        # over the even permutations of [0, 1, 2].
+        #----------------------  
+      R_hall_trace[n] = (R_hall[0,1,2,n]+R_hall[2,0,1,n]+R_hall[1,2,0,n])*hall_SI/3
+
+    except:
+      from .report_exception import report_exception
+      print('check t_tensor components - matrix cannot be singular')
+      report_exception()
+      raise
+  return R_hall_trace
+
+
+def do_transport ( data_controller, temps, ene, velkp, channels, weights, do_hall, write_to_file, save_tensors, tetrahedra=False ):
   import numpy as np
   from os.path import join
   from numpy import linalg as npl
@@ -28,7 +59,7 @@ def do_transport ( data_controller, temps, ene, velkp, channels, weights, do_hal
 
   esize = ene.size
   snktot = arrays['E_k'].shape[0]
-  siemen_conv,temp_conv,hall_SI = 6.9884,11604.52500617,9.248931724005307e-13
+  siemen_conv,temp_conv = 6.9884,11604.52500617
   nspin,t_tensor = attr['nspin'],arrays['t_tensor']
   spin_mult = 1. if nspin==2 or attr['dftSO'] else 2.
 
@@ -42,8 +73,10 @@ def do_transport ( data_controller, temps, ene, velkp, channels, weights, do_hal
       fkappa = ojf('kappa', ispin)
       fSeebeck = ojf('Seebeck', ispin)
       fsigmadk = ojf('sigmadk', ispin) if attr['smearing']!=None else None
+      fsigmatetra = ojf('sigmatetra', ispin) if tetrahedra else None
       if do_hall:
         fhall = ojf('hall_trace', ispin)
+        fhalltetra = ojf('hall_tracetetra', ispin) if tetrahedra else None
 
     for iT,temp in enumerate(temps):
 
@@ -77,6 +110,28 @@ def do_transport ( data_controller, temps, ene, velkp, channels, weights, do_hal
 
         comm.Barrier()
 
+      if tetrahedra:
+        # Conductivity (T=0 transport distribution) and Hall trace with the tetrahedron method, without smearing
+        L0,_,_ = do_Boltz_tensors(data_controller, 'tetrahedra', itemp, ene, velkp, ispin, channels, weights)
+        if do_hall:
+          L0_hall = do_Boltz_tensors_hall(data_controller, 'tetrahedra', itemp, ene, velkp, ispin, channels, weights)
+        if rank == 0:
+          L0 *= spin_mult/attr['omega']
+          if write_to_file:
+            sigma = L0*siemen_conv*1.e21
+            for i in range(esize):
+              wtup(fsigmatetra, gtup(sigma,i))
+            sigma = None
+          if do_hall:
+            L0_hall *= spin_mult/attr['omega']
+            R_hall_trace = hall_trace(L0, L0_hall)
+            if write_to_file:
+              for i in range(esize):
+                wtup_hall(fhalltetra, gtup_hall(R_hall_trace,i))
+          L0 = L0_hall = None
+
+        comm.Barrier()
+
       L0,L1,L2 = do_Boltz_tensors(data_controller, None, itemp, ene, velkp, ispin, channels, weights)
 
       if do_hall: 
@@ -99,23 +154,7 @@ def do_transport ( data_controller, temps, ene, velkp, channels, weights, do_hal
 
         if do_hall:
           L0_hall *= spin_mult/(attr['omega'])
-          R_hall = np.zeros((3,3,3,esize), dtype=float)
-          R_hall_trace = np.zeros((esize), dtype=float)
-          for n in range(esize):
-            try:
-              for r in range(3):
-                R_hall[:,:,r,n] = npl.inv(L0_unconverted[:,:,n]) @ L0_hall[:,:,r,n] @ npl.inv(L0_unconverted[:,:,n])
-                #----------------------   
-                # The equivalent to the trace of the Hall tensor is an average
-                # over the even permutations of [0, 1, 2].
-                #----------------------  
-              R_hall_trace[n] = (R_hall[0,1,2,n]+R_hall[2,0,1,n]+R_hall[1,2,0,n])*hall_SI/3
-
-            except:
-              from .report_exception import report_exception
-              print('check t_tensor components - matrix cannot be singular')
-              report_exception()
-              raise e
+          R_hall_trace = hall_trace(L0_unconverted, L0_hall)
           if write_to_file:
             for i in range(esize):
               wtup_hall(fhall, gtup_hall(R_hall_trace,i))
@@ -178,8 +217,12 @@ def do_transport ( data_controller, temps, ene, velkp, channels, weights, do_hal
       fSeebeck.close()
       if attr['smearing'] is not None:
         fsigmadk.close()
+      if tetrahedra:
+        fsigmatetra.close()
       if do_hall:
         fhall.close()
+        if tetrahedra:
+          fhalltetra.close()
 
     if save_tensors:
       data_controller.broadcast_single_array('sigma', dtype=float)
@@ -14,7 +14,7 @@
 def wave_function_site_projection(data_controller):
     import cmath
     import numpy as np
-    from mpi4py import MPI
+    from .mpi import MPI
     from os.path import join
     from scipy import fftpack as FFT
     from .constants import ANGSTROM_AU
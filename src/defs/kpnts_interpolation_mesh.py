@@ -28,11 +28,10 @@ import sys,os
 import copy
 
 
-from mpi4py import MPI
-from mpi4py.MPI import ANY_SOURCE
+from .mpi import MPI
 
 # initialize parallel execution
-comm=MPI.COMM_WORLD
+from .communication import comm
 rank = comm.Get_rank()
 
 
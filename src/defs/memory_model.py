@@ -0,0 +1,243 @@
+#
+# PAOFLOW
+#
+# Utility to construct and operate on Hamiltonians from the Projections of DFT wfc on Atomic Orbital bases (PAO)
+#
+# Copyright (C) 2016-2018 ERMES group (http://ermes.unt.edu, mbn@unt.edu)
+#
+# Reference:
+# M. Buongiorno Nardelli, F. T. Cerasoli, M. Costa, S Curtarolo,R. De Gennaro, M. Fornari, L. Liyanage, A. Supka and H. Wang,
+# PAOFLOW: A utility to construct and operate on ab initio Hamiltonians from the Projections of electronic wavefunctions on
+# Atomic Orbital bases, including characterization of topological materials, Comp. Mat. Sci. vol. 143, 462 (2018).
+#
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `License'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#
+
+# Largest element count of a single MPI message
+int_max = 2147483647
+
+bytes_complex = 16
+bytes_float = 8
+
+
+def local_count ( n, size ):
+  '''
+  Largest number of items held by one rank when 'n' items are distributed over 'size' ranks
+  '''
+  return -(-n//size)
+
+
+def grid_sizes ( attr ):
+  '''
+  Number of k-points of the original grid and of the interpolated grid (nfft, if set)
+  '''
+  nk1,nk2,nk3 = attr['nk1'],attr['nk2'],attr['nk3']
+  nfft = [attr.get('nfft%d'%i,0) or n for i,n in zip((1,2,3),(nk1,nk2,nk3))]
+  return (nk1,nk2,nk3),tuple(nfft)
+
+
+def min_npool ( attr ):
+  '''
+  Smallest number of pools which keeps every scatter and gather message below the MPI element limit
+  '''
+  import numpy as np
+
+  _,(nf1,nf2,nf3) = grid_sizes(attr)
+  return max(1, int(np.ceil(float(attr['nawf']**2*nf1*nf2*nf3*3*attr['nspin'])/int_max)))
+
+
+def batch_bytes ( attr ):
+  '''
+  Temporary memory used per item of a batch by the interpolation FFT, the gradient FFT and the eigensolver
+  '''
+  (nk1,nk2,nk3),(nf1,nf2,nf3) = grid_sizes(attr)
+  nk = nf1*nf2*nf3
+  # zero_pad builds three intermediate grids before the transform
+  zpad = nk1*nk2*nf3 + nk1*nf2*nf3 + 2*nk
+  # The gradient holds H(R), the three components of dH(k) and the product R*H(R) with its transform
+  grad = 6*nk
+  return zpad*bytes_complex,grad*bytes_complex,3*attr['nawf']**2*bytes_complex
+
+
+def stage_requirements ( attr, size, fft_batch=1, eigh_batch=1, workers=1 ):
+  '''
+  Per-rank memory model of the k-space stages. Each stage is described by the arrays alive
+  at each of its phases (e.g. before and after a transposition), on the rank holding the most data.
+  Arrays above the out-of-core threshold (see DataController.ooc_array) are replaced by the
+  buffers of the blocks of k-points read at once.
+
+  Arguments:
+    attr (dict): Data attributes (nawf, nspin, nk1-3 and, if set, nfft1-3, ooc_threshold, ooc_chunk)
+    size (int): Number of MPI ranks
+    fft_batch (int): Number of orbital pairs transformed at once by the FFT stages
+    eigh_batch (int): Number of k-points diagonalized at once
+    workers (int): Number of workers of the ExecutionBackend, each holding the temporaries of a batch
+
+  Returns:
+    stages (list): List of (stage, phases) tuples, where phases is a list of (phase, {array:bytes}) tuples
+  '''
+  C,F = bytes_complex,bytes_float
+  nawf,nspin = attr['nawf'],attr['nspin']
+  (nk1,nk2,nk3),(nf1,nf2,nf3) = grid_sizes(attr)
+  nk0,nk = nk1*nk2*nk3,nf1*nf2*nf3
+
+  norb = nawf**2
+  nkl,nol = local_count(nk,size),local_count(norb,size)
+
+  threshold = attr.get('ooc_threshold', None)
+  chunk = attr.get('ooc_chunk', .25)*1.e9
+
+  def ooc ( nbytes ):
+    return 0 if threshold is not None and nbytes >= threshold*1.e9 else nbytes
+
+  Hk = nkl*norb*nspin*C
+  eigen = {'E_k':nkl*nawf*nspin*F, 'v_k':Hk}
+  dHk = 3*Hk
+
+  fft_interp,fft_grad,eigh_work = batch_bytes(attr)
+
+  stages = []
+
+  rank0 = {'Hks, HRs (rank 0)':2*norb*nk0*nspin*C}
+  stages.append(('interpolated_hamiltonian',
+                 [('zero padding FFT', dict(rank0, **{'HRs (scattered)':nol*nk0*nspin*C, 'Hksp (orbitals)':nol*nk*nspin*C,
+                                                       'FFT temporaries':workers*fft_batch*fft_interp})),
+                  ('transposition', dict(rank0, **{'Hksp (orbitals)':nol*nk*nspin*C, 'Hksp':Hk,
+                                                    'transposition buffer':nol*nkl*nspin*C})),
+                  ('reordering', dict(rank0, **{'Hksp':2*Hk}))]))
+
+  stages.append(('pao_eigh',
+                 [('diagonalization', dict(eigen, **{'Hksp':Hk, 'eigensolver workspace':workers*eigh_batch*eigh_work}))]))
+
+  ooc_dHk,ooc_pk = ooc(dHk),ooc(dHk)
+  stages.append(('gradient_and_momenta',
+                 [('transposition', dict(eigen, **{'Hksp':Hk, 'Hksp (orbitals)':nol*nk*nspin*C,
+                                                   'transposition buffer':nol*nkl*nspin*C})),
+                  ('gradient FFT', dict(eigen, **{'Hksp (orbitals)':nol*nk*nspin*C, 'dHksp (orbitals)':3*nol*nk*nspin*C,
+                                                  'Rfft':3*nk*F, 'FFT temporaries':workers*fft_batch*fft_grad})),
+                  ('transposition', dict(eigen, **{'dHksp (orbitals)':3*nol*nk*nspin*C, 'dHksp':dHk,
+                                                   'transposition buffer':3*nol*nkl*nspin*C})),
+                  ('reordering', dict(eigen, **{'dHksp':2*dHk})),
+                  ('momenta', dict(eigen, **{'dHksp':ooc_dHk, 'pksp':ooc_pk, 'momenta blocks':min(2*dHk,chunk)}))]))
+
+  # The widths of the pairs of bands are computed by their consumers (see pair_widths)
+  buffers = {'out-of-core buffers':chunk} if ooc_dHk == 0 or ooc_pk == 0 else {}
+  stages.append(('adaptive_smearing',
+                 [('smearing', dict(eigen, **dict(buffers, **{'dHksp':ooc_dHk, 'pksp':ooc_pk,
+                                                              'deltakp':nkl*nawf*nspin*F,
+                                                              'momenta diagonal':3*nkl*nawf*nspin*F})))]))
+
+  return stages
+
+
+def stage_peaks ( stages ):
+  '''
+  Peak phase of each stage
+
+  Arguments:
+    stages (list): Output of stage_requirements
+
+  Returns:
+    peaks (list): List of (stage, phase, bytes, {array:bytes}) tuples
+  '''
+  peaks = []
+  for stage,phases in stages:
+    phase,arrays = max(phases, key=lambda p : sum(p[1].values()))
+    peaks.append((stage,phase,sum(arrays.values()),arrays))
+  return peaks
+
+
+def memory_report ( peaks, budget=None ):
+  '''
+  Human readable report of the peak memory of each stage
+
+  Arguments:
+    peaks (list): Output of stage_peaks
+    budget (float): (optional) Memory budget per rank in GBytes, stages above it are marked
+
+  Returns:
+    report (str): The report
+  '''
+  B_to_GB = 1.E-9
+  lines = ['Estimated peak memory per rank:']
+  for stage,phase,nbytes,arrays in peaks:
+    over = budget is not None and nbytes*B_to_GB > budget
+    lines.append('  %-26s %8.3f GBytes (%s)%s'%(stage,nbytes*B_to_GB,phase,('  exceeds budget' if over else '')))
+    for k,v in sorted(arrays.items(), key=lambda a : -a[1]):
+      if v > 0:
+        lines.append('    %-30s %8.3f GBytes'%(k,v*B_to_GB))
+  if budget is not None:
+    lines.append('  Budget: %.3f GBytes per rank'%budget)
+  return '\n'.join(lines)
+
+
+def plan_memory ( attr, size, budget, max_buffer=None, workers=1 ):
+  '''
+  Choose the FFT and eigensolver batch sizes for a memory budget per rank.
+  The pools split the messages of the scatters and gathers, not the arrays they fill, so npool does
+  not change the memory per rank: it is the smallest value not lower than attr['npool'] keeping MPI
+  messages below the element limit, whatever the budget. Only more ranks or out-of-core storage
+  reduce the peaks, as suggested by the report when the run does not fit.
+  The batch sizes are the largest that keep every stage within the budget, with their temporaries
+  bounded by 'max_buffer'.
+
+  Arguments:
+    attr (dict): Data attributes (see stage_requirements)
+    size (int): Number of MPI ranks
+    budget (float): Memory available to each rank in GBytes
+    max_buffer (float): Largest size in GBytes of the batch temporaries of a worker, defaults to attr['ooc_chunk']
+    workers (int): Number of workers of the ExecutionBackend
+
+  Returns:
+    plan (dict): 'npool', 'fft_batch', 'eigh_batch' and the resulting 'peaks' (see stage_peaks)
+
+  Raises:
+    MemoryError: If a stage exceeds the budget with batches of a single item. The message holds the full report.
+  '''
+  B_to_GB = 1.E-9
+  nbudget = budget/B_to_GB
+  if max_buffer is None:
+    max_buffer = attr.get('ooc_chunk', .25)
+  nbuffer = max_buffer/B_to_GB
+
+  npool = max(attr['npool'], min_npool(attr))
+  nol = local_count(attr['nawf']**2, size)
+  _,(nf1,nf2,nf3) = grid_sizes(attr)
+  nkl = local_count(nf1*nf2*nf3, size)
+
+  def peak ( stage, fft_batch, eigh_batch ):
+    requirements = dict(stage_requirements(attr, size, fft_batch, eigh_batch, workers))
+    return max(sum(a.values()) for _,a in requirements[stage])
+
+  def largest_batch ( stage, nmax, item_bytes, batch_args ):
+    # Bisection on the batch size, the peak memory grows with it
+    lo,hi = 1,max(1, min(nmax, int(nbuffer//item_bytes)))
+    while lo < hi:
+      mid = (lo+hi+1)//2
+      if peak(stage, *batch_args(mid)) <= nbudget:
+        lo = mid
+      else:
+        hi = mid-1
+    return lo
+
+  fft_interp,fft_grad,eigh_work = batch_bytes(attr)
+  fft_batch = min(largest_batch('interpolated_hamiltonian', nol, fft_interp, lambda b : (b,1)),
+                  largest_batch('gradient_and_momenta', nol, fft_grad, lambda b : (b,1)))
+  eigh_batch = largest_batch('pao_eigh', nkl, eigh_work, lambda b : (1,b))
+
+  peaks = stage_peaks(stage_requirements(attr, size, fft_batch, eigh_batch, workers))
+  if any(p[2] > nbudget for p in peaks):
+    msg = memory_report(peaks, budget)
+    # Smallest number of ranks (at unit batches) which fits the budget
+    for nsize in [size*2**i for i in range(1,11)]:
+      if all(p[2] <= nbudget for p in stage_peaks(stage_requirements(attr, nsize, workers=workers))):
+        msg += '\n  The run fits the budget on %d ranks.'%nsize
+        break
+    if attr.get('ooc_threshold', None) is None:
+      msg += '\n  Storing the largest arrays out-of-core (ooc_threshold) reduces the momenta and smearing stages.'
+    raise MemoryError('The run does not fit the memory budget.\n' + msg)
+
+  return {'npool':npool, 'fft_batch':fft_batch, 'eigh_batch':eigh_batch, 'peaks':peaks}
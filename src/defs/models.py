@@ -13,8 +13,8 @@
 def Slater_Koster( data_controller, params ):
   # generalized Slater-Koster TB model in the two-center approximation (1st nearest neighbors only)
   from .constants import ANGSTROM_AU
-  from scipy.fftpack import fftshift
-  from mpi4py import MPI
+  from numpy.fft import fftshift
+  from .mpi import MPI
   import numpy as np
 
   arry,attr = data_controller.data_dicts()
@@ -168,8 +168,8 @@ def Slater_Koster( data_controller, params ):
 
 def graphene( data_controller, params ):
   from .constants import ANGSTROM_AU
-  from scipy.fftpack import fftshift
-  from mpi4py import MPI
+  from numpy.fft import fftshift
+  from .mpi import MPI
   import numpy as np
 
   arry,attr = data_controller.data_dicts()
@@ -225,8 +225,8 @@ def graphene( data_controller, params ):
 
 def graphene2( data_controller, params ):
   from .constants import ANGSTROM_AU
-  from scipy.fftpack import fftshift
-  from mpi4py import MPI
+  from numpy.fft import fftshift
+  from .mpi import MPI
   import numpy as np
 
   arry,attr = data_controller.data_dicts()
@@ -289,8 +289,8 @@ def graphene2( data_controller, params ):
 
 def cubium( data_controller, params ):
   from .constants import ANGSTROM_AU
-  from scipy.fftpack import fftshift
-  from mpi4py import MPI
+  from numpy.fft import fftshift
+  from .mpi import MPI
   import numpy as np
 
   arry,attr = data_controller.data_dicts()
@@ -353,8 +353,8 @@ def cubium( data_controller, params ):
   
 def cubium2( data_controller, params ):
   from .constants import ANGSTROM_AU
-  from scipy.fftpack import fftshift
-  from mpi4py import MPI
+  from numpy.fft import fftshift
+  from .mpi import MPI
   import numpy as np
 
   arry,attr = data_controller.data_dicts()
@@ -421,8 +421,8 @@ def cubium2( data_controller, params ):
 
 def Kane_Mele( data_controller, params ):
   from .constants import ANGSTROM_AU
-  from scipy.fftpack import fftshift
-  from mpi4py import MPI
+  from numpy.fft import fftshift
+  from .mpi import MPI
   import numpy as np
 
   arry,attr = data_controller.data_dicts()
@@ -536,6 +536,85 @@ def Kane_Mele( data_controller, params ):
   arry['species']=["KM","KM"]
 
 
+def tile_TB_model ( data_controller, supercell ):
+  '''
+  Replace the TB model held by the DataController with its supercell of m1 x m2 x m3 primitive cells.
+  The hoppings of the supercell must remain within the R grid of the model (e.g. first neighbours on a 3 point grid).
+
+  Arguments:
+    data_controller (DataController): DataController holding the model
+    supercell (list): Number of primitive cells (m1,m2,m3) along each lattice vector
+
+  Returns:
+    None
+  '''
+  import numpy as np
+
+  arry,attr = data_controller.data_dicts()
+
+  m = np.array(supercell, dtype=int)
+  HRs = arry['HRs']
+  nawf,_,nk1,nk2,nk3,nspin = HRs.shape
+  nks = np.array([nk1,nk2,nk3])
+
+  # Primitive cells of the supercell
+  cells = np.array([[i,j,k] for i in range(m[0]) for j in range(m[1]) for k in range(m[2])])
+  ncell = cells.shape[0]
+  index = {tuple(c):n for n,c in enumerate(cells)}
+
+  HRsc = np.zeros((ncell*nawf,ncell*nawf,nk1,nk2,nk3,nspin), dtype=complex)
+  for i in np.ndindex(nk1,nk2,nk3):
+    if not HRs[:,:,i[0],i[1],i[2]].any():
+      continue
+    # Lattice vector of the grid point (indices above nk/2 are negative)
+    R = np.where(np.array(i) > nks//2, np.array(i)-nks, np.array(i))
+    for a,ta in enumerate(cells):
+      d = ta + R
+      Rsc = d//m
+      if np.any(np.abs(Rsc) > nks//2):
+        raise ValueError('Supercell %s does not fit the R grid of the model.'%str(supercell))
+      b = index[tuple(d-Rsc*m)]
+      isc = tuple(Rsc%nks)
+      HRsc[a*nawf:(a+1)*nawf,b*nawf:(b+1)*nawf,isc[0],isc[1],isc[2]] += HRs[:,:,i[0],i[1],i[2]]
+  arry['HRs'] = HRsc
+
+  # Cell, atoms and orbitals of the supercell
+  arry['tau'] = np.concatenate([arry['tau']+np.dot(c,arry['a_vectors']) for c in cells])
+  arry['a_vectors'] = arry['a_vectors']*m[:,None]
+  arry['b_vectors'] = arry['b_vectors']/m[:,None]
+  for k in ['atoms', 'species', 'naw']:
+    if k in arry:
+      arry[k] = list(arry[k])*ncell
+  for k in ['nawf', 'natoms', 'bnd', 'nbnds', 'nelec']:
+    if k in attr:
+      attr[k] *= ncell
+  if 'omega' in attr:
+    attr['omega'] *= ncell
+
+
+def polarize_TB_model ( data_controller, zeeman=0. ):
+  '''
+  Make the TB model held by the DataController spin polarized (nspin=2), with on-site energies split by 'zeeman'
+
+  Arguments:
+    data_controller (DataController): DataController holding the model
+    zeeman (float): Energy difference between the spin down and spin up on-site energies
+
+  Returns:
+    None
+  '''
+  import numpy as np
+
+  arry,attr = data_controller.data_dicts()
+
+  HRs = arry['HRs'][...,:1]
+  diag = np.diag_indices(HRs.shape[0])
+  arry['HRs'] = np.concatenate((HRs,HRs), axis=5)
+  arry['HRs'][diag[0],diag[1],0,0,0,0] -= zeeman/2
+  arry['HRs'][diag[0],diag[1],0,0,0,1] += zeeman/2
+  attr['nspin'] = 2
+
+
 def build_TB_model ( data_controller, parameters ):
   if parameters['label'].upper() == 'GRAPHENE':
     graphene(data_controller, parameters)
@@ -552,3 +631,9 @@ def build_TB_model ( data_controller, parameters ):
   else:
     print('ERROR: Label "%s" not found in builtin models.'%label)
 
+  # Optional supercell and spin polarization of the model
+  if 'supercell' in parameters:
+    tile_TB_model(data_controller, parameters['supercell'])
+  if parameters.get('nspin', 1) == 2:
+    polarize_TB_model(data_controller, parameters.get('zeeman', 0.))
+
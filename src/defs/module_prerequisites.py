@@ -16,6 +16,7 @@ module_pre_reqs = { 'add_external_fields'      : ['projectability'],\
                     'dos'                      : ['pao_eigh'],\
                     'fermi_surface'            : ['pao_eigh'],\
                     'spin_texture'             : ['pao_eigh'],
+                    'fermi_window'             : ['pao_eigh'],\
                     'gradient_and_momenta'     : ['pao_eigh'],\
                     'ipr'                      : ['pao_eigh'],\
                     'berry_phase'              : ['pao_hamiltonian'],\
@@ -0,0 +1,34 @@
+#
+# PAOFLOW
+#
+# Utility to construct and operate on Hamiltonians from the Projections of DFT wfc on Atomic Orbital bases (PAO)
+#
+# Copyright (C) 2016-2018 ERMES group (http://ermes.unt.edu, mbn@unt.edu)
+#
+# Reference:
+# M. Buongiorno Nardelli, F. T. Cerasoli, M. Costa, S Curtarolo,R. De Gennaro, M. Fornari, L. Liyanage, A. Supka and H. Wang,
+# PAOFLOW: A utility to construct and operate on ab initio Hamiltonians from the Projections of electronic wavefunctions on
+# Atomic Orbital bases, including characterization of topological materials, Comp. Mat. Sci. vol. 143, 462 (2018).
+#
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `License'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#
+
+# PAOFLOW modules import MPI from here. Without mpi4py, or when the environment
+# variable PAOFLOW_MPI is 0 (skipping the initialization of MPI in short single
+# process jobs), PAOFLOW runs on a single process, parallel over the workers
+# of its ExecutionBackend (backend.py).
+from os import environ
+
+have_mpi = False
+if environ.get('PAOFLOW_MPI', '1') != '0':
+  try:
+    from mpi4py import MPI
+    have_mpi = True
+  except ImportError:
+    pass
+
+if not have_mpi:
+  from . import serial_mpi as MPI
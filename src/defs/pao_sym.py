@@ -24,11 +24,11 @@ from tempfile import NamedTemporaryFile
 import re
 from .communication import scatter_full, gather_full,gather_scatter
 from scipy.spatial.distance import cdist
-from mpi4py import MPI
+from .mpi import MPI
 from .zero_pad import zero_pad
 import time
 
-comm = MPI.COMM_WORLD
+from .communication import comm
 rank = comm.Get_rank()
 
 
@@ -50,3 +50,141 @@ def perturb_split(rot_op1,rot_op2,v_k,degen,return_v_k=False):
       return(op1, op2, v_k_temp)
     else:
       return(op1, op2)
+
+
+def degenerate_rotations(op,degen):
+    '''
+    Unitary rotations of the degenerate subspaces of one k-point diagonalizing
+    op (nawf,nawf), an operator in the basis of the eigenvectors of H
+
+    Returns the list of rotations, one (d,d) matrix per subspace of degen
+    '''
+    from scipy import linalg as LAN
+
+    return [LAN.eigh(op[d[0]:d[-1]+1,d[0]:d[-1]+1])[1] for d in degen]
+
+
+def rotate_subspaces(op,degen,weights):
+    '''
+    Rotate in place op (...,nawf,nawf) by W^H op W, where W is block diagonal
+    with the rotations 'weights' on the degenerate subspaces and 1 elsewhere.
+    Only the rows and columns of the subspaces are updated.
+    '''
+    import numpy as np
+
+    for d,w in zip(degen,weights):
+        ll = d[0]
+        ul = d[-1]+1
+        op[...,ll:ul,:] = np.matmul(np.conj(w.T),op[...,ll:ul,:])
+        op[...,:,ll:ul] = np.matmul(op[...,:,ll:ul],w)
+    return op
+
+
+def band_window(degen,bands):
+    '''
+    Smallest number of bands, not lower than 'bands', which does not cut
+    a degenerate subspace of any of the k-points of degen
+    '''
+    nb = bands
+    extended = True
+    while extended:
+        extended = False
+        for dk in degen:
+            for d in dk:
+                if d[0] < nb <= d[-1]:
+                    nb = d[-1]+1
+                    extended = True
+    return nb
+
+
+def perturb_split_batch(op1,op2,v_k,degen,bands=None):
+    '''
+    perturb_split over a block of k-points, with stacked matrix products
+
+    Arguments:
+        op1 (ndarray): Operators (nk,...,nawf,nawf) whose degenerate subspaces are diagonalized, e.g. (nk,3,nawf,nawf) for the three directions of dH/dk
+        op2 (ndarray): Operators of the shape of op1 rotated as op1, or None when op2 is op1
+        v_k (ndarray): Eigenvectors (nk,nawf,nawf)
+        degen (list): Degenerate subspaces of each k-point
+        bands (int): Number of lowest bands of the returned operators, None for all. The products are restricted to these bands, extended past the degenerate subspaces they would cut
+
+    Returns:
+        op1_k (ndarray): op1 in the rotated eigenvector basis, (nk,...,bands,bands)
+        op2_k (ndarray): op2 in the same basis, None if op2 is None
+        rotations (dict): For each k-point with degeneracies, the rotations of its subspaces within the bands (see degenerate_rotations) for each operator of op1, in the order of np.ndindex(op1.shape[1:-2])
+    '''
+    import numpy as np
+
+    nawf = v_k.shape[-1]
+    nb = nawf if bands is None else min(nawf,band_window(degen,bands))
+
+    # Contiguous operands take the BLAS path of matmul, whatever the layout of the caller's arrays
+    op1 = np.ascontiguousarray(op1)
+    op2 = None if op2 is None else np.ascontiguousarray(op2)
+
+    # Eigenvectors of the bands, broadcast over the operators of each k-point
+    v = np.ascontiguousarray(v_k[...,:nb]).reshape(v_k.shape[:1]+(1,)*(op1.ndim-3)+(nawf,nb))
+    vh = np.conj(np.swapaxes(v,-1,-2))
+
+    op1_k = np.matmul(vh,np.matmul(op1,v))
+    op2_k = None if op2 is None else np.matmul(vh,np.matmul(op2,v))
+
+    # Only k-points with degeneracies are rediagonalized
+    rotations = {}
+    for ik in range(op1.shape[0]):
+        degen_k = [d for d in degen[ik] if d[0] < nb]
+        if len(degen_k) == 0:
+            continue
+        rotations[ik] = []
+        for idx in np.ndindex(op1.shape[1:-2]):
+            weights = degenerate_rotations(op1_k[(ik,)+idx],degen_k)
+            rotate_subspaces(op1_k[(ik,)+idx],degen_k,weights)
+            if op2_k is not None:
+                rotate_subspaces(op2_k[(ik,)+idx],degen_k,weights)
+            rotations[ik].append(weights)
+
+    if bands is not None and nb > bands:
+        op1_k = np.ascontiguousarray(op1_k[...,:bands,:bands])
+        op2_k = None if op2_k is None else np.ascontiguousarray(op2_k[...,:bands,:bands])
+
+    return op1_k,op2_k,rotations
+
+
+def perturb_split_diagonal(op,v_k,degen,bands=None):
+    '''
+    Diagonal of the operators op1_k of perturb_split_batch(op,None,v_k,degen,bands),
+    without their off-diagonal elements: v_n^H op v_n for each band, replaced in the
+    degenerate subspaces by the eigenvalues of their block of op
+
+    Arguments:
+        op (ndarray): Hermitian operators (nk,...,nawf,nawf)
+        v_k (ndarray): Eigenvectors (nk,nawf,nawf)
+        degen (list): Degenerate subspaces of each k-point
+        bands (int): Number of lowest bands, None for all
+
+    Returns:
+        diag (ndarray): Real diagonal (nk,...,bands)
+    '''
+    import numpy as np
+    from scipy import linalg as LAN
+
+    nawf = v_k.shape[-1]
+    nb = nawf if bands is None else min(nawf,bands)
+
+    op = np.ascontiguousarray(op)
+    v = np.ascontiguousarray(v_k[...,:nb]).reshape(v_k.shape[:1]+(1,)*(op.ndim-3)+(nawf,nb))
+
+    diag = np.real(np.sum(np.conj(v)*np.matmul(op,v),axis=-2))
+
+    for ik in range(op.shape[0]):
+        for d in degen[ik]:
+            if d[0] >= nb:
+                continue
+            ll = d[0]
+            ul = min(d[-1]+1,nb)
+            vd = v_k[ik][:,ll:d[-1]+1]
+            for idx in np.ndindex(op.shape[1:-2]):
+                vals = LAN.eigvalsh(np.dot(np.conj(vd.T),np.dot(op[(ik,)+idx],vd)))
+                diag[(ik,)+idx+(slice(ll,ul),)] = vals[:ul-ll]
+
+    return diag
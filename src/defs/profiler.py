@@ -0,0 +1,227 @@
+#
+# PAOFLOW
+#
+# Utility to construct and operate on Hamiltonians from the Projections of DFT wfc on Atomic Orbital bases (PAO)
+#
+# Copyright (C) 2016-2018 ERMES group (http://ermes.unt.edu, mbn@unt.edu)
+#
+# Reference:
+# M. Buongiorno Nardelli, F. T. Cerasoli, M. Costa, S Curtarolo,R. De Gennaro, M. Fornari, L. Liyanage, A. Supka and H. Wang,
+# PAOFLOW: A utility to construct and operate on ab initio Hamiltonians from the Projections of electronic wavefunctions on
+# Atomic Orbital bases, including characterization of topological materials, Comp. Mat. Sci. vol. 143, 462 (2018).
+#
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `License'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#
+
+from time import perf_counter
+from contextlib import contextmanager
+
+# The Profiler of the current run, None when profiling is disabled
+active = None
+
+
+def max_rss ( ):
+  '''
+  High-water resident set size of this process, in bytes
+  '''
+  import resource
+  from sys import platform
+
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux reports kilobytes, macOS bytes
+  return rss if platform == 'darwin' else rss*1024
+
+
+@contextmanager
+def null_region ( ):
+  yield
+
+
+def region ( name ):
+  '''
+  Context manager timing a sub-kernel of the current stage. Does nothing when profiling is disabled.
+  The bytes communicated within the kernel are counted by the communicator of defs/communication.py.
+
+  Arguments:
+    name (str): Name of the kernel (e.g. 'fft', 'eigh', 'transpose', 'reduction')
+
+  Returns:
+    context manager
+  '''
+  if active is None:
+    return null_region()
+  return active.region(name)
+
+
+def kernel ( name ):
+  '''
+  Decorator timing every call of a function as the kernel 'name' (see region)
+  '''
+  from functools import wraps
+
+  def decorator ( func ):
+    @wraps(func)
+    def wrapper ( *args, **kwargs ):
+      if active is None:
+        return func(*args, **kwargs)
+      with active.region(name):
+        return func(*args, **kwargs)
+    return wrapper
+
+  return decorator
+
+
+def count_bytes ( nbytes ):
+  '''
+  Add 'nbytes' to the communication volume of the current stage and of the open kernels
+  '''
+  if active is not None:
+    active.count_bytes(nbytes)
+
+
+class Profiler:
+  '''
+  Records, on every rank, the wall time, communication volume and growth of the
+  memory high-water of each PAOFLOW stage (the interval between two calls to
+  report_module_time) and of the kernels timed with 'region'.
+  '''
+
+  def __init__ ( self, comm ):
+    self.comm = comm
+    self.rank = comm.Get_rank()
+
+    self.t0 = perf_counter()
+    self.stages = []
+    self.events = []
+    self.stack = []
+    self.new_stage(self.t0)
+
+
+  def new_stage ( self, t ):
+    self.stage_start = t
+    self.stage_rss = max_rss()
+    self.stage_bytes = 0
+    self.stage_kernels = {}
+    self.stage_mark = None
+
+
+  @contextmanager
+  def region ( self, name ):
+    frame = {'name':name, 'bytes':0, 'rss':max_rss(), 'start':perf_counter()}
+    self.stack.append(frame)
+    try:
+      yield
+    finally:
+      self.stack.pop()
+      t = perf_counter()
+      dur = t - frame['start']
+      self.events.append({'name':name, 'ts':frame['start']-self.t0, 'dur':dur, 'depth':len(self.stack),
+                          'bytes':frame['bytes'], 'rss_delta':max_rss()-frame['rss']})
+      # Nested kernels of the same name are only counted once
+      if all(f['name'] != name for f in self.stack):
+        k = self.stage_kernels.setdefault(name, {'time':0., 'calls':0, 'bytes':0})
+        k['time'] += dur
+        k['calls'] += 1
+        k['bytes'] += frame['bytes']
+
+
+  def count_bytes ( self, nbytes ):
+    self.stage_bytes += nbytes
+    for f in self.stack:
+      f['bytes'] += nbytes
+
+
+  def mark ( self ):
+    '''
+    End of the local work of the current stage, called before the synchronization of report_module_time
+    '''
+    self.stage_mark = perf_counter()
+
+
+  def stage ( self, name ):
+    '''
+    Close the current stage, called after the synchronization of report_module_time
+
+    Arguments:
+      name (str): Name of the stage
+    '''
+    t = perf_counter()
+    mark = t if self.stage_mark is None else self.stage_mark
+    self.stages.append({'name':name, 'start':self.stage_start-self.t0, 'time':t-self.stage_start,
+                        'busy':mark-self.stage_start, 'wait':t-mark, 'bytes':self.stage_bytes,
+                        'rss_delta':max_rss()-self.stage_rss, 'kernels':self.stage_kernels})
+    self.new_stage(t)
+
+
+  def write ( self, opath, prefix='paoflow_profile' ):
+    '''
+    Gather the records of every rank and write, from rank 0, a JSON summary
+    (prefix.json) and a Chrome trace (prefix_trace.json, for chrome://tracing or Perfetto).
+    Must be called by every rank.
+
+    Arguments:
+      opath (str): Output directory
+      prefix (str): Prefix of the file names
+
+    Returns:
+      None
+    '''
+    import json
+    import numpy as np
+    from os.path import join
+
+    stages = self.comm.gather(self.stages)
+    events = self.comm.gather(self.events)
+    peak = self.comm.gather(max_rss())
+
+    if self.rank != 0:
+      return
+
+    def stats ( values ):
+      values = np.array(values, dtype=float)
+      mean = values.mean()
+      return {'per_rank':values.tolist(), 'max':values.max(), 'mean':mean,
+              'imbalance':(values.max()/mean if mean > 0 else 1.)}
+
+    summary = {'nranks':len(stages), 'peak_rss':peak, 'stages':[]}
+    # Every rank closes the same sequence of stages
+    for i,s in enumerate(stages[0]):
+      rs = [r[i] for r in stages]
+      kernels = {}
+      for k in sorted(set().union(*[r['kernels'] for r in rs])):
+        kr = [r['kernels'].get(k, {'time':0.,'calls':0,'bytes':0}) for r in rs]
+        kernels[k] = {'time':stats([v['time'] for v in kr]),
+                      'calls':[v['calls'] for v in kr],
+                      'bytes':[v['bytes'] for v in kr]}
+      summary['stages'].append({'name':s['name'],
+                                'time':max(r['time'] for r in rs),
+                                'busy':stats([r['busy'] for r in rs]),
+                                'wait':stats([r['wait'] for r in rs]),
+                                'bytes':[r['bytes'] for r in rs],
+                                'rss_delta':[r['rss_delta'] for r in rs],
+                                'kernels':kernels})
+
+    with open(join(opath,prefix+'.json'), 'w') as f:
+      json.dump(summary, f, indent=1)
+
+    # Chrome trace, one process per rank. Times are in microseconds.
+    trace = []
+    for rank,(rs,re) in enumerate(zip(stages,events)):
+      trace.append({'name':'process_name', 'ph':'M', 'pid':rank, 'args':{'name':'rank %d'%rank}})
+      for s in rs:
+        trace.append({'name':s['name'], 'cat':'stage', 'ph':'X', 'pid':rank, 'tid':0,
+                      'ts':1.e6*s['start'], 'dur':1.e6*s['busy'],
+                      'args':{'bytes':s['bytes'], 'rss_delta':s['rss_delta'], 'wait':s['wait']}})
+        if s['wait'] > 0.:
+          trace.append({'name':'wait', 'cat':'sync', 'ph':'X', 'pid':rank, 'tid':0,
+                        'ts':1.e6*(s['start']+s['busy']), 'dur':1.e6*s['wait']})
+      for e in re:
+        trace.append({'name':e['name'], 'cat':'kernel', 'ph':'X', 'pid':rank, 'tid':1,
+                      'ts':1.e6*e['ts'], 'dur':1.e6*e['dur'],
+                      'args':{'bytes':e['bytes'], 'rss_delta':e['rss_delta']}})
+
+    with open(join(opath,prefix+'_trace.json'), 'w') as f:
+      json.dump({'traceEvents':trace, 'displayTimeUnit':'ms'}, f)
@@ -0,0 +1,212 @@
+#
+# PAOFLOW
+#
+# Utility to construct and operate on Hamiltonians from the Projections of DFT wfc on Atomic Orbital bases (PAO)
+#
+# Copyright (C) 2016-2018 ERMES group (http://ermes.unt.edu, mbn@unt.edu)
+#
+# Reference:
+# M. Buongiorno Nardelli, F. T. Cerasoli, M. Costa, S Curtarolo,R. De Gennaro, M. Fornari, L. Liyanage, A. Supka and H. Wang,
+# PAOFLOW: A utility to construct and operate on ab initio Hamiltonians from the Projections of electronic wavefunctions on
+# Atomic Orbital bases, including characterization of topological materials, Comp. Mat. Sci. vol. 143, 462 (2018).
+#
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `License'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#
+
+import numpy as np
+from os.path import basename,exists,join,splitext
+
+# Name of the cache directory, created inside the QE .save directory
+cache_dir = 'paoflow_cache'
+# Pickled file holding the signature of the parsed file and the non-array data
+meta_file = 'meta.pkl'
+
+
+def cache_path ( fpath, fname ):
+  '''
+  Directory housing the cache of the QE file 'fname', located in 'fpath'
+  '''
+  return join(fpath, cache_dir, splitext(basename(fname))[0])
+
+
+def file_signature ( fname, content=True, bsize=2**24 ):
+  '''
+  Signature used to validate a cache: file size, modification time and a hash of the content
+
+  Arguments:
+    fname (str): Path to the file
+    content (bool): If False the content hash is skipped (returned as None)
+    bsize (int): Size of the blocks read while hashing
+
+  Returns:
+    (size, mtime, hash) (tuple): The file signature
+  '''
+  from os import stat
+  from hashlib import sha1
+
+  st = stat(fname)
+  chash = None
+  if content:
+    h = sha1()
+    with open(fname, 'rb') as f:
+      for block in iter(lambda : f.read(bsize), b''):
+        h.update(block)
+    chash = h.hexdigest()
+  return (st.st_size, st.st_mtime_ns, chash)
+
+
+def cache_valid ( fpath, fname, keys=() ):
+  '''
+  Check whether a cache exists for 'fname' and matches the current file, by its size
+  and modification time. The content is only hashed when the size agrees but the
+  modification time does not (e.g. a copied or touched file).
+
+  Arguments:
+    fpath (str): Directory containing 'fname' (the QE .save directory)
+    fname (str): Name of the parsed QE file
+    keys (tuple): Keys of arrays which must be present in the cache
+
+  Returns:
+    valid (bool): True if the cache can be used in place of parsing 'fname'
+  '''
+  from pickle import load
+
+  mfile = join(cache_path(fpath,fname), meta_file)
+  if not exists(mfile):
+    return False
+
+  try:
+    with open(mfile, 'rb') as f:
+      signature,_,_,akeys = load(f)
+    if any(k not in akeys for k in keys):
+      return False
+    fsig = join(fpath, fname)
+    size,mtime,chash = signature
+    fsize,fmtime,_ = file_signature(fsig, content=False)
+    if size != fsize:
+      return False
+    if mtime == fmtime:
+      return True
+    return chash == file_signature(fsig)[2]
+  except Exception:
+    return False
+
+
+def read_cache ( fpath, fname, distributed=(), mmap=True ):
+  '''
+  Load the parsed data of 'fname' from its cache.
+  Arrays are memory mapped copy-on-write. Arrays listed in 'distributed' are stored globally and
+  each rank keeps a copy of its slice of k-points (axis 2, see load_balancing).
+
+  Arguments:
+    fpath (str): Directory containing 'fname' (the QE .save directory)
+    fname (str): Name of the parsed QE file
+    distributed (tuple): Keys of arrays distributed along the k-point axis
+    mmap (bool): If False the arrays are read into memory
+
+  Returns:
+    (attributes, arrays) (tuple): Dictionaries with the cached data
+  '''
+  from pickle import load
+
+  cpath = cache_path(fpath, fname)
+  with open(join(cpath,meta_file), 'rb') as f:
+    _,attrs,arrys,akeys = load(f)
+
+  for k in akeys:
+    arr = np.load(join(cpath,k+'.npy'), mmap_mode=('c' if mmap else None))
+    if k in distributed:
+      from .communication import load_balancing,comm
+      ini_ik,end_ik = load_balancing(comm.Get_size(), comm.Get_rank(), arr.shape[2])
+      arr = np.array(arr[:,:,ini_ik:end_ik])
+    arrys[k] = arr
+
+  return attrs,arrys
+
+
+def write_cache ( fpath, fname, attrs, arrys, distributed=() ):
+  '''
+  Write the parsed data of 'fname' to its cache, as .npy files plus a pickled
+  file with the signature, the attributes and the remaining (non-array) data.
+  Arrays listed in 'distributed' hold each rank's slice of k-points (axis 2) and
+  are written collectively into a single global array. In that case the call must
+  be made by every rank, otherwise only the calling rank writes. A failure to write
+  raises the same OSError on every rank.
+
+  Arguments:
+    fpath (str): Directory containing 'fname' (the QE .save directory)
+    fname (str): Name of the parsed QE file
+    attrs (dict): Attributes produced by the parser
+    arrys (dict): Arrays produced by the parser
+    distributed (tuple): Keys of arrays distributed along the k-point axis
+
+  Returns:
+    None
+  '''
+  from os import makedirs,remove
+  from pickle import dump,HIGHEST_PROTOCOL
+
+  rank,comm = 0,None
+  if len(distributed) > 0:
+    from .communication import comm
+    rank = comm.Get_rank()
+
+  def collective ( action, ranks=False ):
+    # Run action on rank 0 (on every rank if ranks), raising the same OSError on every rank if any failed,
+    # so that no rank is left waiting in a collective call
+    err = None
+    if ranks or rank == 0:
+      try:
+        action()
+      except OSError as e:
+        err = str(e)
+    if comm is not None:
+      err = next((e for e in comm.allgather(err) if e is not None), None)
+    if err is not None:
+      raise OSError(err)
+
+  cpath = cache_path(fpath, fname)
+  mfile = join(cpath, meta_file)
+
+  # Invalidate any previous cache before writing the new arrays
+  def invalidate ():
+    makedirs(cpath, exist_ok=True)
+    if exists(mfile):
+      remove(mfile)
+  collective(invalidate)
+
+  objs,akeys = {},[]
+  for k,v in arrys.items():
+    if isinstance(v, np.ndarray):
+      akeys.append(k)
+    else:
+      objs[k] = v
+  def save_arrays ():
+    for k in akeys:
+      if k not in distributed:
+        np.save(join(cpath,k+'.npy'), arrys[k])
+  collective(save_arrays)
+
+  for k in distributed:
+    from .communication import load_balancing
+
+    v = arrys[k]
+    nk = comm.allreduce(v.shape[2])
+    afile = join(cpath, k+'.npy')
+    collective(lambda : np.lib.format.open_memmap(afile, mode='w+', dtype=v.dtype, shape=v.shape[:2]+(nk,)+v.shape[3:]).flush())
+    ini_ik,end_ik = load_balancing(comm.Get_size(), rank, nk)
+    def write_slice ():
+      if end_ik > ini_ik:
+        arr = np.load(afile, mmap_mode='r+')
+        arr[:,:,ini_ik:end_ik] = v
+        arr.flush()
+    collective(write_slice, ranks=True)
+
+  # The meta file is written last, a partially written cache is never valid
+  def write_meta ():
+    with open(mfile, 'wb') as f:
+      dump([file_signature(join(fpath,fname)),attrs,objs,akeys], f, HIGHEST_PROTOCOL)
+  collective(write_meta)
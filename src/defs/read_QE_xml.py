@@ -1,5 +1,5 @@
 import xml.etree.cElementTree as ET
-from mpi4py import MPI
+from .mpi import MPI
 import numpy as np
 
 def parse_qe_data_file_schema ( data_controller, fname ):
@@ -14,7 +14,7 @@ def parse_qe_data_file_schema ( data_controller, fname ):
   import re
 
   arry,attr = data_controller.data_dicts()
-  comm = MPI.COMM_WORLD
+  from .communication import comm
   rank = comm.Get_rank()
 
   verbose = attr['verbose']
@@ -165,6 +165,8 @@ def parse_qe_data_file_schema ( data_controller, fname ):
   for s,v in arrys:
     arry[s] = v
 
+  return dict(attrs),dict(arrys)
+
 
 def parse_qe_data_file ( data_controller, fpath, fname ):
   '''
@@ -179,7 +181,7 @@ def parse_qe_data_file ( data_controller, fpath, fname ):
   from os.path import join
 
   arry,attr = data_controller.data_dicts()
-  comm = MPI.COMM_WORLD
+  from .communication import comm
   rank = comm.Get_rank()
 
   verbose = attr['verbose']
@@ -316,109 +318,126 @@ def parse_qe_data_file ( data_controller, fpath, fname ):
   for s,v in arrys:
     arry[s] = v
 
+  return dict(attrs),dict(arrys)
+
 
 def parse_qe_atomic_proj ( data_controller, fname ):
   '''
   Parse the atomic_proj.xml file produced by Quantum Espresso.
   Populated the DataController object with all necessay information.
+  The file is streamed and each rank only decodes the projections for its
+  own slice of k-points (see load_balancing), so 'U' and 'Sks' are stored
+  distributed along the k-point axis.
 
   Arugments:
     data_controller (DataController): Data controller to populate
     fname (str): Path and name of the xml file.
   '''
+  from .communication import load_balancing,comm
 
   arry,attr = data_controller.data_dicts()
-  comm = MPI.COMM_WORLD
   rank = comm.Get_rank()
+  size = comm.Get_size()
 
   verbose = attr['verbose']
   acbn0 = attr['acbn0']
 
-  tree = ET.parse(fname)
-  root = tree.getroot()
   qe_version = attr['qe_version']
 
-  Ry2eV = 13.60569193
-  Efermi = attr['Efermi']
-
-  elem = root.find('HEADER')
-  if qe_version > 6.5:
-    header = elem.attrib
-    nkpnts = int(header['NUMBER_OF_K-POINTS'])
-    nspin = int(header['NUMBER_OF_SPIN_COMPONENTS'])
-    nbnds = int(header['NUMBER_OF_BANDS'])
-    nawf = int(header['NUMBER_OF_ATOMIC_WFC'])
-  else:
-    nbnds = int(elem.find('NUMBER_OF_BANDS').text)
-    nkpnts = int(elem.find('NUMBER_OF_K-POINTS').text)
-    nspin = int(elem.find('NUMBER_OF_SPIN_COMPONENTS').text)
-    nawf = int(elem.find('NUMBER_OF_ATOMIC_WFC').text)
-
-  if nspin == 4:
-    nspin = 1
-
-  wavefunctions = np.empty((nbnds,nawf,nkpnts,nspin), dtype=complex)
-  overlaps = np.empty((nawf,nbnds,nkpnts), dtype=complex) if acbn0 else None
-
-  if qe_version > 6.5:
-
-    elem = root.find('EIGENSTATES')
-    ewfc = elem.findall('PROJS')
-    for ispin in range(nspin):
-      for i in range(nkpnts):
-        ik = ispin*nkpnts + i
-        for j,proj in enumerate(ewfc[ik].findall('ATOMIC_WFC')):
-          ind = int(proj.attrib['index'])-1
-          spin = int(proj.attrib['spin'])-1
-          text = [float(v) for v in proj.text.split()]
-          for k in range(len(text)//2):
-            k2 = 2*k
-            wavefunctions[k,ind,i,ispin] = complex(text[k2],text[k2+1])
-
-    if acbn0:
-      elem = root.find('OVERLAPS')
-      for i,ovp in enumerate(elem.findall('OVPS')):
-        dim = int(ovp.attrib['dim'])
-        ispin = int(ovp.attrib['spin'])-1
-        text = ovp.text.split()
-        for j in range(len(text)//2):
-          j2 = 2*j
-          i1 = j//dim
-          i2 = j%dim
-          v1,v2 = float(text[j2]),float(text[j2+1])
-          overlaps[i1,i2,i] = complex(v1,v2)
-
-  else:
-
-    def read_wf ( kpnt, i, ispin ):
-      for j,wf in enumerate(kpnt):
-        text = wf.text.replace(',', ' ').split()
-        wft = np.array(text, dtype=float).reshape((nbnds,2))
-        wavefunctions[:,j,i,ispin] = wft[:,0] + 1j*wft[:,1]
-
-    elem = root.find('PROJECTIONS')
-    for i,kpnt in enumerate(elem):
-      if nspin == 1:
-        read_wf(kpnt, i , 0)
-      else:
-        for ispin in range(nspin):
-          nele = kpnt.find('SPIN.%d'%(ispin+1))
-          read_wf(nele, i, ispin)
-
-    if acbn0:
-      elem = root.find('OVERLAPS')
-      for i,kpnt in enumerate(elem):
-        for j,ovp in enumerate(kpnt):
-          ispin = int(ovp.tag.split('.')[1]) - 1
-          text = ovp.text.replace(',', ' ').split()
-          for k in range(len(text)//2):
-            k0,k1 = k//nbnds,k%nbnds
-            k2 = 2*k
-            v1,v2 = float(text[k2]),float(text[k2+1])
-            overlaps[k0,k1,i] = complex(v1,v2)
+  # Header information, filled when the HEADER element is reached
+  dims = {}
+  wavefunctions = overlaps = None
+
+  read_complex = lambda text : np.array(text.replace(',', ' ').split(), dtype=float).view(complex)
+
+  def allocate ( nbnds, nkpnts, nspin, nawf ):
+    if nspin == 4:
+      nspin = 1
+    ini_ik,end_ik = load_balancing(size, rank, nkpnts)
+    dims.update({'nbnds':nbnds, 'nkpnts':nkpnts, 'nspin':nspin, 'nawf':nawf, 'ini_ik':ini_ik, 'end_ik':end_ik})
+    wfcs = np.empty((nbnds,nawf,end_ik-ini_ik,nspin), dtype=complex)
+    ovps = np.empty((nawf,nbnds,end_ik-ini_ik), dtype=complex) if acbn0 else None
+    return wfcs,ovps
+
+  def local_k ( ik ):
+    return ik-dims['ini_ik'] if dims['ini_ik'] <= ik < dims['end_ik'] else None
+
+  def read_wf ( kpnt, i, ispin ):
+    for j,wf in enumerate(kpnt):
+      wavefunctions[:,j,i,ispin] = read_complex(wf.text)
+
+  tags = []
+  nprojs = novps = 0
+  for event,elem in ET.iterparse(fname, events=('start','end')):
+
+    if event == 'start':
+      tags.append(elem.tag)
+      if qe_version > 6.5 and elem.tag == 'HEADER':
+        header = elem.attrib
+        wavefunctions,overlaps = allocate(int(header['NUMBER_OF_BANDS']), int(header['NUMBER_OF_K-POINTS']),
+                                          int(header['NUMBER_OF_SPIN_COMPONENTS']), int(header['NUMBER_OF_ATOMIC_WFC']))
+      continue
+
+    tags.pop()
+    parent = tags[-1] if len(tags) > 0 else None
+
+    if qe_version > 6.5:
+
+      if elem.tag == 'PROJS' and parent == 'EIGENSTATES':
+        ispin,i = nprojs//dims['nkpnts'],local_k(nprojs%dims['nkpnts'])
+        if i is not None:
+          for proj in elem.findall('ATOMIC_WFC'):
+            ind = int(proj.attrib['index'])-1
+            wfc = read_complex(proj.text)
+            wavefunctions[:wfc.size,ind,i,ispin] = wfc
+        nprojs += 1
+        elem.clear()
+
+      elif acbn0 and elem.tag == 'OVPS' and parent == 'OVERLAPS':
+        i = local_k(novps)
+        if i is not None:
+          dim = int(elem.attrib['dim'])
+          ovp = read_complex(elem.text).reshape((-1,dim))
+          overlaps[:ovp.shape[0],:dim,i] = ovp
+        novps += 1
+        elem.clear()
+
+    else:
+
+      if elem.tag == 'HEADER':
+        nbnds = int(elem.find('NUMBER_OF_BANDS').text)
+        nkpnts = int(elem.find('NUMBER_OF_K-POINTS').text)
+        nspin = int(elem.find('NUMBER_OF_SPIN_COMPONENTS').text)
+        nawf = int(elem.find('NUMBER_OF_ATOMIC_WFC').text)
+        wavefunctions,overlaps = allocate(nbnds, nkpnts, nspin, nawf)
+
+      elif parent == 'PROJECTIONS':
+        i = local_k(nprojs)
+        if i is not None:
+          if dims['nspin'] == 1:
+            read_wf(elem, i, 0)
+          else:
+            for ispin in range(dims['nspin']):
+              read_wf(elem.find('SPIN.%d'%(ispin+1)), i, ispin)
+        nprojs += 1
+        elem.clear()
+
+      elif acbn0 and parent == 'OVERLAPS':
+        i = local_k(novps)
+        if i is not None:
+          for ovp in elem:
+            ovp = read_complex(ovp.text).reshape((-1,dims['nbnds']))
+            overlaps[:ovp.shape[0],:,i] = ovp
+        novps += 1
+        elem.clear()
+
+  if verbose and rank == 0:
+    print('Projections read for %d k-points on %d processes'%(dims['nkpnts'],size))
 
   arrys = [('U',wavefunctions)]
   if acbn0:
     arrys += [('Sks',overlaps)]
   for s,v in arrys:
     arry[s] = v
+
+  return dict(arrys)
@@ -0,0 +1,167 @@
+#
+# PAOFLOW
+#
+# Utility to construct and operate on Hamiltonians from the Projections of DFT wfc on Atomic Orbital bases (PAO)
+#
+# Copyright (C) 2016-2018 ERMES group (http://ermes.unt.edu, mbn@unt.edu)
+#
+# Reference:
+# M. Buongiorno Nardelli, F. T. Cerasoli, M. Costa, S Curtarolo,R. De Gennaro, M. Fornari, L. Liyanage, A. Supka and H. Wang,
+# PAOFLOW: A utility to construct and operate on ab initio Hamiltonians from the Projections of electronic wavefunctions on
+# Atomic Orbital bases, including characterization of topological materials, Comp. Mat. Sci. vol. 143, 462 (2018).
+#
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `License'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#
+
+############# Stand-in for mpi4py.MPI #############
+## Used by defs/mpi.py when mpi4py is not installed. It provides the subset of
+## mpi4py.MPI used by PAOFLOW, with the semantics of a communicator holding a
+## single process: collectives copy the send buffer to the receive buffer and
+## pickle based operations return their argument.
+###################################################
+
+import numpy as np
+
+IN_PLACE = object()
+ANY_SOURCE = -1
+COMM_TYPE_SHARED = 1
+SUM = 'SUM'
+MAX = 'MAX'
+MIN = 'MIN'
+PROD = 'PROD'
+
+
+class Datatype:
+
+  def __init__ ( self, char ):
+    self.char = char
+
+  def Get_size ( self ):
+    return np.dtype(self.char).itemsize
+
+INT = Datatype('i')
+DOUBLE = Datatype('d')
+_typedict = {c:Datatype(c) for c in np.typecodes['All'] if c not in 'OSUVMm'}
+
+
+def buffer_array ( buf ):
+  '''
+  Array of a buffer specification (array, or [array, counts, displacements, type])
+  '''
+  if isinstance(buf, (list,tuple)):
+    buf = buf[0]
+  return buf
+
+
+def copy_buffer ( sendbuf, recvbuf ):
+  if sendbuf is IN_PLACE or recvbuf is None:
+    return
+  send,recv = buffer_array(sendbuf),buffer_array(recvbuf)
+  if send is recv:
+    return
+  recv.reshape(-1)[:] = np.asarray(send).reshape(-1)[:recv.size]
+
+
+class Intracomm:
+  '''
+  Communicator of a single process
+  '''
+
+  def __init__ ( self, comm=None ):
+    pass
+
+  def Get_rank ( self ):
+    return 0
+
+  def Get_size ( self ):
+    return 1
+
+  def Barrier ( self ):
+    pass
+
+  def barrier ( self ):
+    pass
+
+  def Split_type ( self, split_type, key=0 ):
+    return self
+
+  def Free ( self ):
+    pass
+
+  def Abort ( self, errorcode=0 ):
+    raise SystemExit(errorcode)
+
+  def Bcast ( self, buf, root=0 ):
+    pass
+
+  def bcast ( self, obj, root=0 ):
+    return obj
+
+  def Reduce ( self, sendbuf, recvbuf, op=SUM, root=0 ):
+    copy_buffer(sendbuf, recvbuf)
+
+  def Allreduce ( self, sendbuf, recvbuf, op=SUM ):
+    copy_buffer(sendbuf, recvbuf)
+
+  def reduce ( self, sendobj, op=SUM, root=0 ):
+    return sendobj
+
+  def allreduce ( self, sendobj, op=SUM ):
+    return sendobj
+
+  def Scatter ( self, sendbuf, recvbuf, root=0 ):
+    copy_buffer(sendbuf, recvbuf)
+
+  def Gather ( self, sendbuf, recvbuf, root=0 ):
+    copy_buffer(sendbuf, recvbuf)
+
+  def Allgather ( self, sendbuf, recvbuf ):
+    copy_buffer(sendbuf, recvbuf)
+
+  def Alltoall ( self, sendbuf, recvbuf ):
+    copy_buffer(sendbuf, recvbuf)
+
+  Scatterv = Scatter
+  Gatherv = Gather
+  Allgatherv = Allgather
+  Alltoallv = Alltoall
+
+  def scatter ( self, sendobj, root=0 ):
+    return sendobj[0]
+
+  def gather ( self, sendobj, root=0 ):
+    return [sendobj]
+
+  def allgather ( self, sendobj ):
+    return [sendobj]
+
+  def Sendrecv ( self, sendbuf, dest, sendtag=0, recvbuf=None, source=ANY_SOURCE, recvtag=-1, status=None ):
+    copy_buffer(sendbuf, recvbuf)
+
+  def point_to_point ( self, *args, **kwargs ):
+    raise RuntimeError('Point to point communication requires mpi4py')
+
+  Send = Recv = send = recv = point_to_point
+
+Comm = Intracomm
+COMM_WORLD = Intracomm()
+
+
+class Win:
+  '''
+  Shared memory window of a single process
+  '''
+
+  def __init__ ( self, nbytes, itemsize ):
+    self.buf = bytearray(max(nbytes,1))
+    self.itemsize = itemsize
+
+  @classmethod
+  def Allocate_shared ( cls, nbytes, itemsize, comm=None ):
+    return cls(nbytes, itemsize)
+
+  def Shared_query ( self, rank ):
+    return self.buf,self.itemsize
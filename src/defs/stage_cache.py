@@ -0,0 +1,201 @@
+#
+# PAOFLOW
+#
+# Utility to construct and operate on Hamiltonians from the Projections of DFT wfc on Atomic Orbital bases (PAO)
+#
+# Copyright (C) 2016-2018 ERMES group (http://ermes.unt.edu, mbn@unt.edu)
+#
+# Reference:
+# M. Buongiorno Nardelli, F. T. Cerasoli, M. Costa, S Curtarolo,R. De Gennaro, M. Fornari, L. Liyanage, A. Supka and H. Wang,
+# PAOFLOW: A utility to construct and operate on ab initio Hamiltonians from the Projections of electronic wavefunctions on
+# Atomic Orbital bases, including characterization of topological materials, Comp. Mat. Sci. vol. 143, 462 (2018).
+#
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `License'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#
+
+import numpy as np
+from os.path import exists,join
+
+# Attributes describing the run environment rather than the data.
+# They are excluded from fingerprints and are not replaced when a stage is loaded.
+volatile_attributes = ('opath', 'workpath', 'outputdir', 'verbose', 'abort_on_exception', 'mpisize')
+
+
+def hash_value ( h, value ):
+  '''
+  Update the hash object 'h' with 'value'. Arrays are hashed by content, other objects,
+  including arrays of Python objects, by their pickled form.
+  '''
+  from pickle import dumps,HIGHEST_PROTOCOL
+
+  if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+    h.update(('%s%s'%(value.dtype.str,value.shape)).encode())
+    h.update(np.ascontiguousarray(value).view(np.uint8).data)
+  elif isinstance(value, dict):
+    for k in sorted(value, key=str):
+      h.update(repr(k).encode())
+      hash_value(h, value[k])
+  elif isinstance(value, (list,tuple)):
+    h.update(('%s%d'%(type(value).__name__,len(value))).encode())
+    for v in value:
+      hash_value(h, v)
+  else:
+    h.update(dumps(value, HIGHEST_PROTOCOL))
+
+
+def state_fingerprint ( data_controller ):
+  '''
+  Fingerprint of the data held by the DataController, combined over every rank.
+  Distributed arrays are hashed locally, so the fingerprint depends on the number of ranks and pools.
+  Must be called by every rank.
+
+  Arguments:
+    data_controller (DataController): The DataController to fingerprint
+
+  Returns:
+    fingerprint (str): Hexadecimal digest
+  '''
+  from hashlib import sha1
+  from .communication import comm
+
+  arry,attr = data_controller.data_dicts()
+
+  h = sha1()
+  hash_value(h, arry)
+  hash_value(h, {k:v for k,v in attr.items() if k not in volatile_attributes})
+
+  h = sha1(''.join(comm.allgather(h.hexdigest())).encode())
+  return h.hexdigest()
+
+
+def stage_key ( fingerprint, stage, arguments ):
+  '''
+  Key of a stage's output, from the fingerprint of its input state, its name and arguments
+
+  Arguments:
+    fingerprint (str): Fingerprint of the input state (see state_fingerprint)
+    stage (str): Name of the stage
+    arguments (dict): Arguments of the stage, including defaults
+
+  Returns:
+    key (str): Hexadecimal digest
+  '''
+  from hashlib import sha1
+
+  h = sha1(fingerprint.encode())
+  h.update(stage.encode())
+  hash_value(h, arguments)
+  return h.hexdigest()
+
+
+def entry_size ( path ):
+  '''
+  Total size in bytes of the files in the cache entry 'path'
+  '''
+  from os import listdir
+  from os.path import getsize
+
+  return sum(getsize(join(path,f)) for f in listdir(path))
+
+
+def evict ( cache_dir, max_size, keep=None ):
+  '''
+  Remove the least recently used cache entries until the cache holds at most 'max_size' bytes.
+  The last use of an entry is the modification time of its manifest.
+
+  Arguments:
+    cache_dir (str): Directory housing the cache
+    max_size (float): Maximum size of the cache in bytes
+    keep (str): Key of an entry which is never removed
+
+  Returns:
+    None
+  '''
+  from os import listdir
+  from shutil import rmtree
+  from os.path import getmtime,isdir
+  from .checkpoint import manifest_file
+
+  entries = []
+  for key in listdir(cache_dir):
+    path = join(cache_dir, key)
+    mfile = join(path, manifest_file)
+    if isdir(path) and exists(mfile):
+      entries.append((getmtime(mfile),key,entry_size(path)))
+
+  total = sum(e[2] for e in entries)
+  for _,key,esize in sorted(entries):
+    if total <= max_size:
+      break
+    if key != keep:
+      rmtree(join(cache_dir,key), ignore_errors=True)
+      total -= esize
+
+
+def cached_stage ( method ):
+  '''
+  Decorator for PAOFLOW methods whose outputs are kept in the stage cache.
+  When the cache is enabled (PAOFLOW.stage_cache is set), the DataController state and the
+  method's arguments are fingerprinted. On a hit the stored state replaces the current one
+  and the method is skipped, otherwise the method runs and its resulting state is stored
+  as a checkpoint (see checkpoint.py). Only the data is restored, files written by the stage are not.
+  '''
+  from functools import wraps
+  from inspect import signature
+
+  sig = signature(method)
+
+  @wraps(method)
+  def wrapper ( self, *args, **kwargs ):
+    from os import makedirs,utime
+    from shutil import rmtree
+    from .checkpoint import manifest_file,read_checkpoint,write_checkpoint
+
+    if self.stage_cache is None:
+      return method(self, *args, **kwargs)
+
+    cache_dir,max_size = self.stage_cache
+
+    bound = sig.bind(self, *args, **kwargs)
+    bound.apply_defaults()
+    arguments = dict(list(bound.arguments.items())[1:])
+
+    key = stage_key(state_fingerprint(self.data_controller), method.__name__, arguments)
+    path = join(cache_dir, key)
+
+    hit = None
+    if self.rank == 0:
+      hit = exists(join(path,manifest_file))
+    hit = self.comm.bcast(hit)
+
+    if hit:
+      attr = self.data_controller.data_attributes
+      volatile = {k:attr[k] for k in volatile_attributes if k in attr}
+      read_checkpoint(self.data_controller, path)
+      self.data_controller.data_attributes.update(volatile)
+      if self.rank == 0:
+        utime(join(path,manifest_file))
+      self.report_module_time('%s (cached)'%method.__name__)
+      return
+
+    method(self, *args, **kwargs)
+
+    if self.rank == 0:
+      makedirs(cache_dir, exist_ok=True)
+    self.comm.Barrier()
+    try:
+      write_checkpoint(self.data_controller, path)
+    except ValueError as e:
+      # The state cannot be checkpointed (e.g. arrays distributed over orbitals), it is not cached
+      if self.rank == 0:
+        print('Stage %s not cached: %s'%(method.__name__,e))
+        rmtree(path, ignore_errors=True)
+      return
+
+    if self.rank == 0:
+      evict(cache_dir, max_size, keep=key)
+
+  return wrapper
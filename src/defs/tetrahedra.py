@@ -0,0 +1,400 @@
+#
+# PAOFLOW
+#
+# Utility to construct and operate on Hamiltonians from the Projections of DFT wfc on Atomic Orbital bases (PAO)
+#
+# Copyright (C) 2016-2018 ERMES group (http://ermes.unt.edu, mbn@unt.edu)
+#
+# Reference:
+# M. Buongiorno Nardelli, F. T. Cerasoli, M. Costa, S Curtarolo,R. De Gennaro, M. Fornari, L. Liyanage, A. Supka and H. Wang,
+# PAOFLOW: A utility to construct and operate on ab initio Hamiltonians from the Projections of electronic wavefunctions on
+# Atomic Orbital bases, including characterization of topological materials, Comp. Mat. Sci. vol. 143, 462 (2018).
+#
+# This file is distributed under the terms of the
+# GNU General Public License. See the file `License'
+# in the root directory of the present distribution,
+# or http://www.gnu.org/copyleft/gpl.txt .
+#
+
+############# Linear tetrahedron method #############
+## Every cell of the k-point grid is split in six tetrahedra sharing its shortest
+## main diagonal, in which the bands are interpolated linearly (P. E. Bloechl,
+## O. Jepsen and O. K. Andersen, Phys. Rev. B 49, 16223 (1994)). Each rank
+## integrates the tetrahedra of the cells whose first corner is one of its
+## k-points, the energies of the corners held by other ranks are exchanged with
+## a Halo (communication.py). The weights of the corners include the corrections
+## of Bloechl, which vanish when summed over the corners of a tetrahedron.
+##
+## Corner energies e (nt,4) of the functions below are sorted along their rows.
+## Weights are those of tetrahedra of unit volume, the volume of a tetrahedron
+## of the grid is 1/(6*nkpnts).
+#####################################################
+
+import numpy as np
+
+# Corners, as offsets from the first corner of a cell, of the six tetrahedra of
+# the cell sharing the diagonal between its corners 0 and 7 (corner c is at
+# offset (c&1, c>>1&1, c>>2&1))
+cell_corners = np.array([[0,0,0],[1,0,0],[0,1,0],[1,1,0],[0,0,1],[1,0,1],[0,1,1],[1,1,1]])
+cell_tetrahedra = np.array([[0,1,3,7],[0,1,5,7],[0,2,3,7],[0,2,6,7],[0,4,5,7],[0,4,6,7]])
+
+# Largest number of (tetrahedron, energy) pairs evaluated at once
+max_pairs = 2**20
+
+
+def tetrahedra_offsets ( b_vectors, nk ):
+  '''
+  Corners of the six tetrahedra of a cell, as offsets (6,4,3) from the first corner
+  of the cell. The tetrahedra share the shortest main diagonal of the cell.
+
+  Arguments:
+    b_vectors (ndarray): Reciprocal lattice vectors (3,3)
+    nk (tuple): Dimensions of the k-point grid
+
+  Returns:
+    offsets (ndarray): Integer offsets (6,4,3)
+  '''
+  edges = b_vectors/np.array(nk, dtype=float)[:,None]
+
+  # Main diagonals run from corner c to corner 7-c
+  lengths = [np.linalg.norm((cell_corners[7-c]-cell_corners[c]).dot(edges)) for c in range(4)]
+  c = int(np.argmin(lengths))
+
+  # Reflecting the cell along the axes where corner c is shifted maps the diagonal (0,7) to (c,7-c)
+  return cell_corners[cell_tetrahedra] ^ cell_corners[c]
+
+
+def tetrahedra_corners ( data_controller ):
+  '''
+  Corners of the tetrahedra of the cells whose first corner is a k-point of this rank
+
+  Arguments:
+    data_controller (DataController): The DataController
+
+  Returns:
+    corners (ndarray): Rows (nk*6,4) of the corners in the concatenation of the k-points of this rank and of its halo
+    halo (Halo): Exchange of the values of the k-points of other ranks read by this rank
+  '''
+  from .communication import Halo,scatter_full_indices
+
+  arry,attr = data_controller.data_dicts()
+
+  nk = (attr['nk1'],attr['nk2'],attr['nk3'])
+  inds = scatter_full_indices(attr['nkpnts'], attr['npool'])
+
+  offsets = tetrahedra_offsets(arry['b_vectors'], nk)
+  ijk = np.array(np.unravel_index(inds, nk)).T
+  corners = np.ravel_multi_index(np.moveaxis(ijk[:,None,None,:]+offsets[None], -1, 0), nk, mode='wrap')
+
+  halo = np.setdiff1d(corners, inds)
+  rows = np.concatenate((inds,halo))
+  order = np.argsort(rows)
+  corners = order[np.searchsorted(rows[order], corners)]
+
+  return corners.reshape(-1,4),Halo(inds, halo)
+
+
+def tetrahedra_pairs ( e, ene ):
+  '''
+  Pairs (tetrahedron, energy) of the energies of the ascending grid ene strictly
+  between the lowest and the highest corner energies of each tetrahedron,
+  yielded in batches of at most max_pairs pairs
+
+  Returns:
+    it,ie (ndarray): Indices of the tetrahedra and of the energies of each pair
+  '''
+  lo = np.searchsorted(ene, e[:,0], side='right')
+  counts = np.maximum(np.searchsorted(ene, e[:,3], side='left')-lo, 0)
+
+  # Batches of whole tetrahedra
+  total = np.cumsum(counts)
+  start = 0
+  while start < e.shape[0]:
+    stop = max(np.searchsorted(total, (total[start-1] if start > 0 else 0)+max_pairs, side='right'), start+1)
+    it = np.repeat(np.arange(start,stop), counts[start:stop])
+    first = np.cumsum(counts[start:stop]) - counts[start:stop]
+    ie = lo[it] + np.arange(it.size) - np.repeat(first, counts[start:stop])
+    yield it,ie
+    start = stop
+
+
+def dos_coefficients ( e ):
+  '''
+  Coefficients (nt,3,3) of the density of states of tetrahedra of unit volume, a
+  quadratic polynomial of x = E-e[:,0] in each of the intervals (e1,e2), (e2,e3)
+  and (e3,e4). Coefficients of empty intervals are not finite and never used.
+  '''
+  e1,e2,e3,e4 = e.T
+  e21,e31,e41,e32,e42,e43 = e2-e1,e3-e1,e4-e1,e3-e2,e4-e2,e4-e3
+
+  c = np.empty(e.shape[:1]+(3,3), dtype=float)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    # 3x^2/(e21*e31*e41)
+    c[:,0,0] = c[:,0,1] = 0.
+    c[:,0,2] = 3./(e21*e31*e41)
+    # (3*e21 + 6*y - 3*K*y^2)/(e31*e41), with y = x-e21 and K = (e31+e42)/(e32*e42)
+    K = (e31+e42)/(e32*e42)
+    c[:,1,0] = -3.*e21*(1.+K*e21)/(e31*e41)
+    c[:,1,1] = 6.*(1.+K*e21)/(e31*e41)
+    c[:,1,2] = -3.*K/(e31*e41)
+    # 3*z^2/(e41*e42*e43), with z = e41-x
+    v = 3./(e41*e42*e43)
+    c[:,2,0] = v*e41**2
+    c[:,2,1] = -2.*v*e41
+    c[:,2,2] = v
+  return c
+
+
+def tetrahedron_dos ( e, E, it, coefficients ):
+  '''
+  Density of states D(E) of the tetrahedra it of unit volume (see dos_coefficients),
+  for energies E strictly between their lowest and highest corner energies
+  '''
+  interval = (E >= e[it,1]).astype(int) + (E >= e[it,2])
+  c = coefficients[it,interval]
+  x = E-e[it,0]
+  return c[:,0] + x*(c[:,1] + x*c[:,2])
+
+
+def delta_weights ( e, E ):
+  '''
+  Weights (n,4) of the corners of tetrahedra of unit volume in the integrals of
+  delta(E-e(k)), for energies strictly between e[:,0] and e[:,3]: the derivatives
+  with respect to E of the occupation weights, Bloechl corrections included. They
+  sum to the density of states of the tetrahedra.
+  '''
+  e1,e2,e3,e4 = e.T
+  w = np.empty(e.shape, dtype=float)
+  ddos = np.empty(E.size, dtype=float)
+
+  # The isoenergy surface is a triangle cutting the edges from corner 1
+  c = E < e2
+  x = E[c]-e1[c]
+  t = x[:,None]/(e[c][:,1:]-e1[c][:,None])
+  v = 1./((e2[c]-e1[c])*(e3[c]-e1[c])*(e4[c]-e1[c]))
+  dos = 3.*x**2*v
+  w[c,1:] = dos[:,None]*t/3.
+  w[c,0] = dos - np.sum(w[c,1:], axis=1)
+  ddos[c] = 6.*x*v
+
+  # The isoenergy surface is a quadrilateral, derivatives of the occupation weights
+  c = (E >= e2) & (E < e3)
+  E2 = E[c]
+  f1,f2,f3,f4 = e1[c],e2[c],e3[c],e4[c]
+  e31,e41,e32,e42 = f3-f1,f4-f1,f3-f2,f4-f2
+  C1 = (E2-f1)**2/(e41*e31)/4.
+  C2 = (E2-f1)*(E2-f2)*(f3-E2)/(e41*e32*e31)/4.
+  C3 = (E2-f2)**2*(f4-E2)/(e42*e32*e41)/4.
+  dC1 = (E2-f1)/(e41*e31)/2.
+  dC2 = ((E2-f2)*(f3-E2) + (E2-f1)*(f3-E2) - (E2-f1)*(E2-f2))/(e41*e32*e31)/4.
+  dC3 = (2.*(E2-f2)*(f4-E2) - (E2-f2)**2)/(e42*e32*e41)/4.
+  w[c,0] = dC1 + (dC1+dC2)*(f3-E2)/e31 - (C1+C2)/e31 + (dC1+dC2+dC3)*(f4-E2)/e41 - (C1+C2+C3)/e41
+  w[c,1] = dC1+dC2+dC3 + (dC2+dC3)*(f3-E2)/e32 - (C2+C3)/e32 + dC3*(f4-E2)/e42 - C3/e42
+  w[c,2] = (dC1+dC2)*(E2-f1)/e31 + (C1+C2)/e31 + (dC2+dC3)*(E2-f2)/e32 + (C2+C3)/e32
+  w[c,3] = (dC1+dC2+dC3)*(E2-f1)/e41 + (C1+C2+C3)/e41 + dC3*(E2-f2)/e42 + C3/e42
+  ddos[c] = (6. - 6.*(e31+e42)*(E2-f2)/(e32*e42))/(e31*e41)
+
+  # The isoenergy surface is a triangle cutting the edges to corner 4
+  c = E >= e3
+  x = e4[c]-E[c]
+  t = x[:,None]/(e4[c][:,None]-e[c][:,:3])
+  v = 1./((e4[c]-e1[c])*(e4[c]-e2[c])*(e4[c]-e3[c]))
+  dos = 3.*x**2*v
+  w[c,:3] = dos[:,None]*t/3.
+  w[c,3] = dos - np.sum(w[c,:3], axis=1)
+  ddos[c] = -6.*x*v
+
+  # Bloechl corrections, derivatives of D(E)/40*sum_j(e_j-e_i)
+  w += ddos[:,None]/40.*(np.sum(e, axis=1)[:,None]-4.*e)
+
+  return w
+
+
+def occupation_weights ( e, E ):
+  '''
+  Weights (n,4) of the corners of tetrahedra of unit volume in the integrals of
+  theta(E-e(k)), Bloechl corrections included. They sum to the fraction of the
+  volume of the tetrahedra below E.
+  '''
+  e1,e2,e3,e4 = e.T
+  w = np.zeros(e.shape, dtype=float)
+  dos = np.zeros(E.size, dtype=float)
+
+  c = (E > e1) & (E < e2)
+  x = E[c]-e1[c]
+  e21,e31,e41 = e2[c]-e1[c],e3[c]-e1[c],e4[c]-e1[c]
+  C = x**3/(e21*e31*e41)/4.
+  w[c,0] = C*(4. - x*(1./e21+1./e31+1./e41))
+  w[c,1] = C*x/e21
+  w[c,2] = C*x/e31
+  w[c,3] = C*x/e41
+  dos[c] = 3.*x**2/(e21*e31*e41)
+
+  c = (E >= e2) & (E < e3)
+  E2 = E[c]
+  f1,f2,f3,f4 = e1[c],e2[c],e3[c],e4[c]
+  e21,e31,e41,e32,e42 = f2-f1,f3-f1,f4-f1,f3-f2,f4-f2
+  C1 = (E2-f1)**2/(e41*e31)/4.
+  C2 = (E2-f1)*(E2-f2)*(f3-E2)/(e41*e32*e31)/4.
+  C3 = (E2-f2)**2*(f4-E2)/(e42*e32*e41)/4.
+  w[c,0] = C1 + (C1+C2)*(f3-E2)/e31 + (C1+C2+C3)*(f4-E2)/e41
+  w[c,1] = C1+C2+C3 + (C2+C3)*(f3-E2)/e32 + C3*(f4-E2)/e42
+  w[c,2] = (C1+C2)*(E2-f1)/e31 + (C2+C3)*(E2-f2)/e32
+  w[c,3] = (C1+C2+C3)*(E2-f1)/e41 + C3*(E2-f2)/e42
+  dos[c] = (3.*e21 + 6.*(E2-f2) - 3.*(e31+e42)*(E2-f2)**2/(e32*e42))/(e31*e41)
+
+  c = (E >= e3) & (E < e4)
+  x = e4[c]-E[c]
+  e41,e42,e43 = e4[c]-e1[c],e4[c]-e2[c],e4[c]-e3[c]
+  C = x**3/(e41*e42*e43)/4.
+  w[c,0] = .25 - C*x/e41
+  w[c,1] = .25 - C*x/e42
+  w[c,2] = .25 - C*x/e43
+  w[c,3] = .25 - C*(4. - x*(1./e41+1./e42+1./e43))
+  dos[c] = 3.*x**2/(e41*e42*e43)
+
+  w[E >= e4] = .25
+
+  # Bloechl corrections
+  w += dos[:,None]/40.*(np.sum(e, axis=1)[:,None]-4.*e)
+
+  return w
+
+
+def sorted_corners ( E_c ):
+  '''
+  Corner energies (nt,4) sorted along the rows, and the permutations sorting them
+  '''
+  order = np.argsort(E_c, axis=1)
+  return np.take_along_axis(E_c, order, axis=1),order
+
+
+def dos_tetrahedra_block ( E_c, ene ):
+  '''
+  Density of states of a block of tetrahedra of unit volume, from the energies of
+  their corners E_c (nt,4,nb), not normalized
+  '''
+  dos = np.zeros(ene.size, dtype=float)
+  for n in range(E_c.shape[2]):
+    e,_ = sorted_corners(E_c[:,:,n])
+    coefficients = dos_coefficients(e)
+    for it,ie in tetrahedra_pairs(e, ene):
+      dos += np.bincount(ie, weights=tetrahedron_dos(e, ene[ie], it, coefficients), minlength=ene.size)
+  return dos
+
+
+def pdos_tetrahedra_block ( E_c, P_c, ene ):
+  '''
+  Projected density of states (nawf,ne) of a block of tetrahedra of unit volume,
+  from the energies E_c (nt,4,nb) and the projections P_c (nt,4,nawf,nb) of their
+  corners, not normalized
+  '''
+  nawf = P_c.shape[2]
+  pdos = np.zeros((ene.size,nawf), dtype=float)
+  for n in range(E_c.shape[2]):
+    e,order = sorted_corners(E_c[:,:,n])
+    p = np.take_along_axis(P_c[:,:,:,n], order[:,:,None], axis=1)
+    for it,ie in tetrahedra_pairs(e, ene):
+      np.add.at(pdos, ie, np.einsum('pi,pim->pm', delta_weights(e[it],ene[ie]), p[it]))
+  return pdos.T
+
+
+def tetrahedra_batch ( nrow ):
+  '''
+  Number of cells of the blocks of the kernels, whose 24 corners each hold 'nrow' values
+  '''
+  return max(1, (max_pairs*8)//(24*nrow))
+
+
+def tetrahedron_weights ( data_controller, ene, ispin, bnd=None, kind='delta' ):
+  '''
+  Weights w_kn(E) of the tetrahedron method for the k-points of this rank, such that
+  sum_kn w_kn(E)*f_kn, summed over the ranks, integrates f over the Brillouin zone
+  (normalized to one) with delta(E-E_kn) ('delta', the Fermi surface integrals of the
+  transport and Hall kernels, in place of a smearing function divided by nkpnts, see
+  tetrahedron_integral) or with theta(E-E_kn) ('occupation'). The delta weights sum to
+  the DoS per cell.
+  Must be called by every rank.
+
+  Arguments:
+    data_controller (DataController): The DataController
+    ene (ndarray): Energies, a few (e.g. the Fermi energy) as the weights are stored for each one
+    ispin (int): Spin index
+    bnd (int): Number of bands, None for 'bnd'
+    kind (str): 'delta' or 'occupation'
+
+  Returns:
+    weights (ndarray): Weights (nk,bnd,ne) of the k-points of this rank
+  '''
+  arry,attr = data_controller.data_dicts()
+
+  if kind not in ['delta', 'occupation']:
+    raise ValueError('Unknown kind of tetrahedron weights \'%s\', use \'delta\' or \'occupation\''%kind)
+
+  bnd = attr['bnd'] if bnd is None else bnd
+  ene = np.atleast_1d(np.asarray(ene, dtype=float))
+  ne = ene.size
+
+  corners,halo = tetrahedra_corners(data_controller)
+  E_k = np.ascontiguousarray(arry['E_k'][:,:bnd,ispin])
+  nk = E_k.shape[0]
+  E = np.concatenate((E_k,halo.exchange(E_k)))
+
+  # Pairs are found on the ascending energies
+  ascending = np.argsort(ene)
+
+  weights = np.zeros((E.shape[0],bnd,ne), dtype=float)
+  for n in range(bnd):
+    e,order = sorted_corners(E[corners,n])
+    rows = np.take_along_axis(corners, order, axis=1)
+    if kind == 'delta':
+      for it,ie in tetrahedra_pairs(e, ene[ascending]):
+        w = delta_weights(e[it], ene[ascending][ie])
+        flat = (rows[it]*ne + ascending[ie][:,None]).ravel()
+        weights[:,n,:] += np.bincount(flat, weights=w.ravel(), minlength=E.shape[0]*ne).reshape(E.shape[0],ne)
+    else:
+      for i in range(ne):
+        w = occupation_weights(e, np.full(e.shape[0],ene[i]))
+        weights[:,n,i] += np.bincount(rows.ravel(), weights=w.ravel(), minlength=E.shape[0])
+
+  weights /= 6.*attr['nkpnts']
+  halo.reduce(weights[:nk], weights[nk:])
+  return weights[:nk]
+
+
+def tetrahedron_integral ( data_controller, values, ene, ispin, alpha=0 ):
+  '''
+  Integrals sum_kn values_kn*(E_kn-E)^alpha*delta(E-E_kn) over the k-points of this rank
+  (to be summed over the ranks) at each energy E of ene, with the delta weights of
+  tetrahedron_weights. The weights are computed for blocks of energies, bounding their size.
+  Must be called by every rank.
+
+  Arguments:
+    data_controller (DataController): The DataController
+    values (ndarray): Values (...,nk,bnd) of the k-points of this rank and the lowest bnd bands
+    ene (ndarray): Energies
+    ispin (int): Spin index
+    alpha (int): Power of E_kn-E
+
+  Returns:
+    integrals (ndarray): Integrals (...,ne)
+  '''
+  from .mpi import MPI
+  from .communication import comm
+
+  arry,attr = data_controller.data_dicts()
+
+  nk,bnd = values.shape[-2:]
+  E = arry['E_k'][:,:bnd,ispin]
+
+  # Every rank computes the weights of the same blocks of energies, the halo exchange is collective
+  nb = max(1, (8*max_pairs)//max(1, comm.allreduce(nk*bnd, op=MPI.MAX)))
+
+  integrals = np.zeros(values.shape[:-2]+(ene.size,), dtype=float)
+  for lo in range(0, ene.size, nb):
+    hi = min(lo+nb, ene.size)
+    w = tetrahedron_weights(data_controller, ene[lo:hi], ispin, bnd)
+    if alpha != 0:
+      w *= np.power(E[:,:,None]-ene[lo:hi], alpha)
+    integrals[...,lo:hi] = np.tensordot(values, w, axes=2)
+  return integrals
@@ -19,8 +19,8 @@
 import numpy as np
 from .get_K_grid_fft import get_K_grid_fft_crystal
 
-from mpi4py import MPI
-comm = MPI.COMM_WORLD
+from .mpi import MPI
+from .communication import comm
 rank = comm.Get_rank()
 
 def write4bt2(data_controller):
@@ -78,9 +78,11 @@ def write4bt2(data_controller):
 		f.close()
 		
 		try:
+			from .do_momentum import momentum_diagonal
+			velkp = momentum_diagonal(arry, 0, attr['nkpnts'])
 			mommat = np.zeros((attr['nkpnts'],attr['nbnds'],3),dtype=float)
 			for ib in range(attr['nbnds']):
-				mommat[:,ib,:] = -np.real(arry['pksp'][:,:,ib,ib,0])/(2*Ry2eV)
+				mommat[:,ib,:] = -velkp[:,:,ib,0]/(2*Ry2eV)
 			return(mommat)
 		except:
 			print('momentum matrix not available')
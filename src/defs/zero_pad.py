@@ -17,7 +17,7 @@ def zero_pad(aux,nk1,nk2,nk3,nfft1,nfft2,nfft3):
         aux[k] and aux[N-k] is preserved.
 
     Arguments:
-        aux (ndarray): unpadded frequency domain data
+        aux (ndarray): unpadded frequency domain data, the last three axes are padded (leading axes index a batch of grids)
         nk1 (int): current size of aux along axis 0
         nk2 (int): current size of aux along axis 1
         nk3 (int): current size of aux along axis 2
@@ -47,28 +47,28 @@ def zero_pad(aux,nk1,nk2,nk3,nfft1,nfft2,nfft3):
     if nfft3 == 0:  p3 = 0
 
     # first dimension
-    auxp1 = np.zeros((nk1,nk2,nk3p),dtype=complex)
-    auxp1[:,:,:sk3+p3]=aux[:,:,:sk3+p3]
-    auxp1[:,:,nfft3+sk3:]=aux[:,:,sk3:]
+    auxp1 = np.zeros(aux.shape[:-3]+(nk1,nk2,nk3p),dtype=complex)
+    auxp1[...,:,:,:sk3+p3]=aux[...,:,:,:sk3+p3]
+    auxp1[...,:,:,nfft3+sk3:]=aux[...,:,:,sk3:]
     # second dimension
-    auxp2 = np.zeros((nk1,nk2p,nk3p),dtype=complex)
-    auxp2[:,:sk2+p2,:]=auxp1[:,:sk2+p2,:]
-    auxp2[:,nfft2+sk2:,:]=auxp1[:,sk2:,:]
+    auxp2 = np.zeros(aux.shape[:-3]+(nk1,nk2p,nk3p),dtype=complex)
+    auxp2[...,:,:sk2+p2,:]=auxp1[...,:,:sk2+p2,:]
+    auxp2[...,:,nfft2+sk2:,:]=auxp1[...,:,sk2:,:]
     # third dimension
-    auxp3 = np.zeros((nk1p,nk2p,nk3p),dtype=complex)
-    auxp3[:sk1+p1,:,:]=auxp2[:sk1+p1,:,:]
-    auxp3[nfft1+sk1:,:,:]=auxp2[sk1:,:,:]
+    auxp3 = np.zeros(aux.shape[:-3]+(nk1p,nk2p,nk3p),dtype=complex)
+    auxp3[...,:sk1+p1,:,:]=auxp2[...,:sk1+p1,:,:]
+    auxp3[...,nfft1+sk1:,:,:]=auxp2[...,sk1:,:,:]
 
     # halve Nyquist axes
     if p1:
-        auxp3[ sk1,:,:] /= 2
-        auxp3[-sk1,:,:] /= 2
+        auxp3[..., sk1,:,:] /= 2
+        auxp3[...,-sk1,:,:] /= 2
     if p2:
-        auxp3[:, sk2,:] /= 2
-        auxp3[:,-sk2,:] /= 2
+        auxp3[...,:, sk2,:] /= 2
+        auxp3[...,:,-sk2,:] /= 2
     if p3:
-        auxp3[:,:, sk3] /= 2
-        auxp3[:,:,-sk3] /= 2
+        auxp3[...,:,:, sk3] /= 2
+        auxp3[...,:,:,-sk3] /= 2
 
     return(auxp3)
 